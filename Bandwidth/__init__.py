@@ -0,0 +1,194 @@
+'''
+Plugin-wide bandwidth scheduler for printers sharing one access point.
+
+Every connection writes through the LinkShare of its printer. Shares are
+of two classes:
+
+- PRIORITY_LIVE: direct streaming, where every delay stalls the planner.
+  Gets its guaranteed rate in any case (from a token bucket per printer)
+  and goes first for everything above it.
+- PRIORITY_BULK: uploads to the SD card, which take what the live streams
+  leave, one write after another in turn.
+
+All of them together stay below the aggregate rate. Without a rate (the
+default) writes aren't delayed at all. In Cura the rate is the plugin's
+"serialwifi/bandwidth_limit" preference. StreamingEngine registers its
+printer with getScheduler() and switches to bulk while writing a file.
+'''
+
+import collections
+import threading
+import time
+
+PRIORITY_LIVE = "live"
+PRIORITY_BULK = "bulk"
+
+LIVE_GUARANTEED = 8192 # bytes/s, about 250 lines/s
+BURST = 0.05 # s of the rate a bucket holds at most
+MIN_BURST = 4096 # bytes a bucket holds at least
+
+class TokenBucket():
+    """rate bytes/s, holding at most burst seconds of them. Consuming may go into debt.
+
+    Only take() locks the bucket. The buckets of a BandwidthScheduler are
+    refilled and consumed under the scheduler's condition instead.
+    """
+    def __init__(self, rate, burst = BURST):
+        self.rate = float(rate)
+        self.capacity = max(self.rate * burst, MIN_BURST)
+        self.tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def refill(self, now = None):
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def need(self, size):
+        """Tokens which have to be there before size bytes may go, larger sizes go into debt."""
+        return min(size, self.capacity)
+
+    def delay(self, size):
+        """Seconds until size bytes may go."""
+        return max(self.need(size) - self.tokens, 0.) / self.rate
+
+    def take(self, size):
+        """Consumes size tokens and sleeps until the debt is paid, eg. for a simulated link."""
+        with self._lock:
+            self.refill()
+            self.tokens -= size
+            wait = -self.tokens / self.rate
+        if wait > 0.:
+            time.sleep(wait)
+
+class LinkShare():
+    """The share of one printer, see BandwidthScheduler.register()."""
+    def __init__(self, scheduler, name, priority, guaranteed, limit):
+        self.scheduler = scheduler
+        self.name = name
+        self.priority = priority
+        self.guaranteed = None # TokenBucket of the guaranteed rate (live only)
+        self.limit = None # TokenBucket of the printer's own cap
+        self.granted = 0 # bytes
+        self.waited = 0. # s
+        self.configure(guaranteed, limit)
+
+    ##  Changes the guaranteed rate and the cap of this printer (bytes/s), None for none.
+    def configure(self, guaranteed = None, limit = None):
+        with self.scheduler._condition:
+            self.guaranteed = TokenBucket(guaranteed) if guaranteed else None
+            self.limit = TokenBucket(limit) if limit else None
+            self.scheduler._condition.notify_all()
+
+    def setPriority(self, priority):
+        self.priority = priority
+
+    ##  Waits until size bytes may be written.
+    def acquire(self, size):
+        self.scheduler._acquire(self, size)
+
+    ##  Gives back what was acquired but not written.
+    def refund(self, size):
+        self.scheduler._refund(self, size)
+
+class BandwidthScheduler():
+    def __init__(self, rate = None):
+        # Guards the waiting shares and owns all buckets: the aggregate one and those of the shares
+        self._condition = threading.Condition()
+        self._bucket = None
+        self._shares = []
+        self._waiting = {PRIORITY_LIVE: collections.deque(), PRIORITY_BULK: collections.deque()}
+        self.setRate(rate)
+
+    ##  Aggregate rate of all printers in bytes/s, None doesn't limit it.
+    def setRate(self, rate):
+        with self._condition:
+            self._bucket = TokenBucket(rate) if rate else None
+            self._condition.notify_all()
+
+    def getRate(self):
+        bucket = self._bucket
+        return bucket.rate if bucket is not None else None
+
+    def register(self, name, priority = PRIORITY_LIVE, guaranteed = LIVE_GUARANTEED, limit = None):
+        share = LinkShare(self, name, priority, guaranteed, limit)
+        with self._condition:
+            self._shares.append(share)
+        return share
+
+    def unregister(self, share):
+        with self._condition:
+            if share in self._shares:
+                self._shares.remove(share)
+            self._condition.notify_all()
+
+    def getShares(self):
+        return list(self._shares)
+
+    def _acquire(self, share, size):
+        if self._bucket is None and share.limit is None:
+            share.granted += size
+            return
+        started = time.monotonic()
+        with self._condition:
+            priority = share.priority
+            waiting = self._waiting[priority]
+            waiting.append(share)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._delay(share, priority, size, now)
+                    if delay == 0.:
+                        break
+                    self._condition.wait(min(max(delay, 0.001), 0.1))
+            finally:
+                waiting.remove(share)
+                self._condition.notify_all()
+            for bucket in (self._bucket, share.limit, share.guaranteed):
+                if bucket is not None:
+                    bucket.tokens -= size
+        share.granted += size
+        share.waited += time.monotonic() - started
+
+    def _delay(self, share, priority, size, now):
+        """Seconds share has to wait at least before writing size bytes, 0 if it may now."""
+        bucket = self._bucket
+        limit = share.limit
+        for refilled in (bucket, limit, share.guaranteed):
+            if refilled is not None:
+                refilled.refill(now)
+        if limit is not None and limit.delay(size):
+            return limit.delay(size)
+        if bucket is None:
+            return 0.
+        if priority == PRIORITY_LIVE:
+            guaranteed = share.guaranteed
+            if guaranteed is not None and not guaranteed.delay(size):
+                # Within the guaranteed rate, the others pay the debt
+                return 0.
+        elif self._waiting[PRIORITY_LIVE]:
+            return bucket.capacity / bucket.rate
+        # One after another within the class
+        if self._waiting[priority][0] is not share:
+            return bucket.capacity / bucket.rate
+        return bucket.delay(size)
+
+    def _refund(self, share, size):
+        if size <= 0:
+            return
+        share.granted -= size
+        if self._bucket is None and share.limit is None:
+            return
+        with self._condition:
+            for bucket in (self._bucket, share.limit, share.guaranteed):
+                if bucket is not None:
+                    bucket.tokens = min(bucket.capacity, bucket.tokens + size)
+            self._condition.notify_all()
+
+_scheduler = BandwidthScheduler()
+
+def getScheduler():
+    """The scheduler all printers of the plugin share."""
+    return _scheduler
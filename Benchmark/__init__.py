@@ -0,0 +1,992 @@
+'''
+Reproducible benchmarks for parsing, encoding and streaming.
+
+Every benchmark returns a dict of named results:
+
+    {"name": {"value": 1234.5, "unit": "lines/s", "higher_is_better": True}}
+
+The synthetic job is generated from a fixed seed and the emulator runs with
+an instantaneous planner, so only the host and the (simulated) link are
+measured. Run with "python -m <plugin folder>.Benchmark --help".
+'''
+
+import collections
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from .. import Bandwidth
+from .. import Bridge
+from .. import Capabilities
+from .. import CommandTables
+from .. import GCodeLibrary
+from .. import Emulator
+from .. import Journal
+from .. import JobAnalysis
+from .. import JobCache
+from .. import JobSource
+from .. import JobValidation
+from .. import Preflight
+from .. import Preprocess
+from .. import Speculation
+from .. import StreamingEngine
+from .. import UpdateAggregator
+from .. import Connection
+from ..Connection import WifiConnectionFactory
+
+DEFAULT_RTTS = (0., 0.001, 0.005, 0.02) # s
+
+IMPORT_BUDGET = 5. # ms the plugin may add to Cura's startup
+# Loaded by Cura before it loads plugins
+CURA_PRELOADED = ("collections", "json", "logging", "socket", "threading", "time", "numpy")
+UM_PRELOADED = ("UM.Logger", "UM.Preferences", "UM.Signal", "UM.OutputDevice.OutputDevicePlugin")
+
+def generateJob(layers = 50, lines_per_layer = 400, seed = 0):
+    """Sliced-looking G-code using only commands known to GCodeLibrary."""
+    rng = random.Random(seed)
+    lines = [";FLAVOR:Marlin",
+             "M140 S60",
+             "M104 S200",
+             "M109 S200",
+             "G28",
+             "G92 E0",
+             "M106 S255",
+             ]
+    extrusion = 0.
+    for layer in range(layers):
+        lines.append(";LAYER:%s" %layer)
+        z = 0.2 + layer * 0.2
+        lines.append("G0 F9000 X%.3f Y%.3f Z%.3f" %(rng.uniform(10, 200), rng.uniform(10, 200), z))
+        for i in range(lines_per_layer):
+            extrusion += rng.uniform(0.01, 0.5)
+            if i % 50 == 0:
+                lines.append("G1 F%s X%.3f Y%.3f E%.5f" %(rng.choice((1200, 1800, 2400)), rng.uniform(10, 200), rng.uniform(10, 200), extrusion))
+            else:
+                lines.append("G1 X%.3f Y%.3f E%.5f" %(rng.uniform(10, 200), rng.uniform(10, 200), extrusion))
+    lines += ["M107", "M104 S0", "M140 S0", "M117 Done"]
+    return lines
+
+def _result(value, unit, higher_is_better = True):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+def _parse(lines):
+    return [command for command in map(GCodeLibrary.identifyLine, lines) if command]
+
+def benchmarkParsing(lines, repeat = 3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for line in lines:
+            GCodeLibrary.identifyLine(line)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {"identify_line": _result(len(lines) / best, "lines/s")}
+
+def benchmarkEncoding(lines, repeat = 3):
+    commands = _parse(lines)
+    best = None
+    encoded_bytes = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        encoded_bytes = 0
+        for command in commands:
+            encoded_bytes += len(bytes(command))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {"encode_line": _result(best / len(commands) * 1e6, "us/line", False),
+            "encode_throughput": _result(encoded_bytes / best / 1e6, "MB/s"),
+            }
+
+def benchmarkCommandFlags(lines, repeat = 3):
+    """Classifying lines for the send loop: type() checks against the flavor's command table."""
+    commands = _parse(lines) + [GCodeLibrary.RawLine(line.encode("utf-8")) for line in lines if line and not line.startswith(";")]
+    table = CommandTables.MARLIN
+    best_types = best_table = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for command in commands:
+            type(command) in (GCodeLibrary.RepRapCommands().M28, GCodeLibrary.RepRapCommands().M29)
+            type(command) is GCodeLibrary.RepRapCommands().M28
+            type(command) is GCodeLibrary.RepRapCommands().M29
+        elapsed = time.perf_counter() - started
+        best_types = elapsed if best_types is None else min(best_types, elapsed)
+        for command in commands:
+            if type(command) is GCodeLibrary.RawLine:
+                # Parsed once per line while sending, not cached across repeats
+                command._opcode = None
+        started = time.perf_counter()
+        for command in commands:
+            flags = table.flags(command.opcode())
+            flags & CommandTables.FLAGS_FILE_WRITE
+            flags & CommandTables.FLAG_ENTERS_FILE_WRITE
+            flags & CommandTables.FLAG_LEAVES_FILE_WRITE
+        elapsed = time.perf_counter() - started
+        best_table = elapsed if best_table is None else min(best_table, elapsed)
+    return {"flags_type_checks": _result(best_types / len(commands) * 1e9, "ns/line", False),
+            "flags_command_table": _result(best_table / len(commands) * 1e9, "ns/line", False),
+            }
+
+def benchmarkQueueMemory(lines):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        queue_gcode = collections.deque(GCodeLibrary.identifyLine(line) for line in lines)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return {"queue_memory": _result((after - before) / len(queue_gcode), "bytes/line", False)}
+
+def benchmarkReceive(count = 20000, line = b"ok T:210.0 /210.0 B:60.0 /60.0 @:0 B@:0\n"):
+    reader, writer = socket.socketpair()
+    reader.setblocking(0)
+    connection = WifiConnectionFactory()
+    connection.connection = reader
+
+    def write():
+        block = line * 100
+        for _ in range(count // 100):
+            writer.sendall(block)
+
+    thread = threading.Thread(target = write, daemon = True)
+    received = 0
+    started = time.perf_counter()
+    thread.start()
+    while received < count // 100 * 100:
+        if connection.receiveLine() is not None:
+            received += 1
+    elapsed = time.perf_counter() - started
+    thread.join()
+    reader.close()
+    writer.close()
+    return {"receive_line": _result(received / elapsed, "lines/s")}
+
+def benchmarkWrites(lines, batch_sizes = (1, 8, 64), limit = 20000):
+    """Lines per syscall and CPU time per MB of the write path, draining into a socketpair."""
+    data = [bytes(command) for command in _parse(lines)[:limit]]
+    results = {}
+    for batch_size in batch_sizes:
+        reader, writer = socket.socketpair()
+        writer.setblocking(0)
+        connection = WifiConnectionFactory()
+        connection.connection = writer
+
+        def drain():
+            while reader.recv(1024 * 1024):
+                pass
+
+        thread = threading.Thread(target = drain, daemon = True)
+        thread.start()
+        sent_bytes = sum(len(line) + 1 for line in data)
+        started = time.perf_counter()
+        for position in range(0, len(data), batch_size):
+            connection.sendLines(data[position:position + batch_size])
+        elapsed = time.perf_counter() - started
+        writer.close()
+        thread.join()
+        reader.close()
+        key = "write_batch_%s" %batch_size
+        results[key + "_lines_per_call"] = _result(len(data) / max(connection.write_calls, 1), "lines/syscall")
+        results[key + "_cpu"] = _result(connection.write_time / sent_bytes * 1e6, "s/MB", False)
+        results[key + "_lines"] = _result(len(data) / elapsed, "lines/s")
+    return results
+
+def benchmarkStreaming(lines, rtts = DEFAULT_RTTS, limit = 2000):
+    """StreamingEngine with its default send window at every round trip time."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(lines[:limit]) + "\n")
+    count = len(_parse(lines[:limit]))
+    results = {}
+    try:
+        for rtt in rtts:
+            with Emulator.EmulatorServer(latency = rtt, speed = 0.) as server:
+                engine = StreamingEngine.StreamingEngine("stream")
+                elapsed = _streamWithEngine(engine, server.host, server.port, path)
+            key = "stream_rtt_%sms" %int(rtt * 1000)
+            results[key + "_lines"] = _result(count / elapsed, "lines/s")
+            results[key + "_bytes"] = _result(engine.getMetrics().bytes_sent / elapsed / 1e3, "kB/s")
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+def benchmarkUpload(lines, rtts = DEFAULT_RTTS, limit = 2000, file_name = "bench.gco"):
+    """StreamingEngine writing the job to the SD card at every round trip time."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(lines[:limit]) + "\n")
+    results = {}
+    try:
+        for rtt in rtts:
+            with Emulator.EmulatorServer(latency = rtt, speed = 0.) as server:
+                engine = StreamingEngine.StreamingEngine("upload")
+                elapsed = _streamWithEngine(engine, server.host, server.port, path, file_name)
+            results["upload_rtt_%sms" %int(rtt * 1000)] = _result(engine.getMetrics().bytes_sent / elapsed / 1e6, "MB/s")
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+def _connectTime(engine, address, port):
+    """Seconds engine.start() takes, including its capability negotiation."""
+    started = time.perf_counter()
+    engine.start(address, port)
+    elapsed = time.perf_counter() - started
+    engine.stop()
+    return elapsed
+
+def benchmarkCapabilities(lines, rtt = 0.005, limit = 2000):
+    """M115 handshake against stored capabilities, and streaming with the negotiated flow control."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(lines[:limit]) + "\n")
+    store_path = os.path.join(directory, "capabilities.json")
+    count = len(_parse(lines[:limit]))
+    results = {}
+    try:
+        with Emulator.EmulatorServer(latency = rtt, speed = 0., advanced_ok = True) as server:
+            engine = StreamingEngine.StreamingEngine("bench")
+            engine.setCapabilityStore(store_path)
+            results["capabilities_handshake"] = _result(_connectTime(engine, server.host, server.port) * 1000., "ms", False)
+            results["capabilities_cached"] = _result(_connectTime(engine, server.host, server.port) * 1000., "ms", False)
+            if engine.getCapabilities().flowControl() != Capabilities.FLOW_ADVANCED_OK:
+                raise AssertionError("ADVANCED_OK wasn't negotiated")
+
+            # Without a handshake the engine assumes the basic capabilities, stop-and-wait
+            basic = StreamingEngine.StreamingEngine("basic")
+            basic.setCapabilityHandshake(False)
+            stop_and_wait = _streamWithEngine(basic, server.host, server.port, path)
+            flow_controlled = _streamWithEngine(engine, server.host, server.port, path)
+        key = "capabilities_rtt_%sms" %int(rtt * 1000)
+        results[key + "_stop_and_wait_lines"] = _result(count / stop_and_wait, "lines/s")
+        results[key + "_advanced_ok_lines"] = _result(count / flow_controlled, "lines/s")
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    return results
+
+def benchmarkReconnect(lines, drop = 0.01, limit = 2000, seed = 0, window = 8):
+    """Streams through an emulator which drops the connection, checks every line ran exactly once."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(lines[:limit]) + "\n")
+    commands = len(_parse(lines[:limit]))
+    random.seed(seed)
+    try:
+        with Emulator.EmulatorServer(speed = 0.) as server:
+            engine = StreamingEngine.StreamingEngine("reconnect")
+            engine.setSendWindow(window)
+            engine.start(server.host, server.port)
+            before = server.firmware.lines_processed
+            server.drop = drop
+            try:
+                started = time.perf_counter()
+                engine.sendFile(path)
+                if not engine.waitForJob(interval = 0.1):
+                    raise RuntimeError("Streaming through the dropping emulator has failed")
+                elapsed = time.perf_counter() - started
+            finally:
+                server.drop = 0.
+                engine.stop()
+            processed = server.firmware.lines_processed - before
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+    if processed != commands:
+        raise AssertionError("%s of %s lines ran after %s reconnects" %(processed, commands, engine.getMetrics().reconnects))
+    metrics = engine.getMetrics()
+    return {"reconnect_lines": _result(commands / elapsed, "lines/s"),
+            "reconnect_count": _result(metrics.reconnects, "reconnects", None),
+            "reconnect_recovery": _result(metrics.reconnect_time / metrics.reconnects * 1000 if metrics.reconnects else 0., "ms", False),
+            }
+
+class _JournaledEngine(StreamingEngine.StreamingEngine):
+    """Engine which journals the job files it sends, like SerialOutputDevice._startJournal."""
+    def __init__(self, name, journal_path, interval = 1.):
+        StreamingEngine.StreamingEngine.__init__(self, name)
+        self.journal_path = journal_path
+        self.interval = interval
+        self.journal = None # kept after stop() closed it
+
+    def sendFile(self, path, *arguments, **options):
+        self.journal = Journal.JobJournal(self.journal_path, path, interval = self.interval).start()
+        self._journal = self.journal
+        StreamingEngine.StreamingEngine.sendFile(self, path, *arguments, **options)
+
+def benchmarkJournal(lines, limit = 20000, interval = 1., repeat = 3):
+    """StreamingEngine with and without job journal at the emulator's full speed."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(lines[:limit]) + "\n")
+    journal_path = os.path.join(directory, "job" + Journal.JOURNAL_SUFFIX)
+    count = min(limit, len(lines))
+    best = {False: None, True: None}
+    checkpoints = syncs = 0
+    sync_time = 0.
+    try:
+        with Emulator.EmulatorServer(speed = 0.) as server:
+            for _ in range(repeat):
+                for journaled in (False, True):
+                    if journaled:
+                        engine = _JournaledEngine("journaled", journal_path, interval)
+                    else:
+                        engine = StreamingEngine.StreamingEngine("plain")
+                    elapsed = _streamWithEngine(engine, server.host, server.port, path)
+                    if journaled:
+                        journal = engine.journal
+                        checkpoints, syncs, sync_time = journal.checkpoints, journal.syncs, journal.sync_time
+                        state = Journal.readJournal(journal_path)
+                        if state is None or state.getOffset() != os.path.getsize(path):
+                            raise RuntimeError("Journal doesn't point to the end of the job")
+                    if best[journaled] is None or elapsed < best[journaled]:
+                        best[journaled] = elapsed
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    return {"journal_overhead": _result((best[True] / best[False] - 1.) * 100., "%", False),
+            "journal_lines": _result(count / best[True], "lines/s"),
+            "journal_sync": _result(sync_time / syncs * 1000. if syncs else 0., "ms/fsync", False),
+            "journal_checkpoints": _result(checkpoints, "checkpoints", None),
+            }
+
+def _consumeSource(source):
+    """Takes all lines like the send loop does, returns (total, first line) time in s."""
+    resend_buffer = Connection.ResendBuffer()
+    first = None
+    started = time.perf_counter()
+    try:
+        while True:
+            command = source.next()
+            if command is JobSource.END:
+                break
+            if command is None:
+                continue
+            command.setDryRun(True)
+            resend_buffer.number(command.encoded(), getattr(command, "body_checksum", None))
+            if first is None:
+                first = time.perf_counter() - started
+    finally:
+        source.close()
+    return time.perf_counter() - started, first or 0.
+
+def benchmarkPreprocess(lines, workers = None, copies = 4, chunk_size = 1024 * 1024):
+    """Line-by-line reading against chunked preprocessing on 0 (in process) to N worker processes.
+
+    N is the number of cores by default. Workers only pay off with a core
+    for each of them next to the send loop, so the results tell how many
+    cores they were measured on.
+    """
+    if workers is None:
+        workers = range(0, (os.cpu_count() or 1) + 1)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        for _ in range(copies):
+            job_file.write("\n".join(lines) + "\n")
+    settings = Preprocess.PreprocessSettings(dry_run = True)
+    results = {}
+    try:
+        count = JobSource.FileJobSource(path).lineCount()
+        baseline, first = _consumeSource(JobSource.FileJobSource(path))
+        results["preprocess_off_lines"] = _result(count / baseline, "lines/s")
+        results["preprocess_off_first_line"] = _result(first * 1000., "ms", False)
+        results["preprocess_cores"] = _result(os.cpu_count() or 1, "cores", None)
+        for worker_count in workers:
+            elapsed, first = _consumeSource(Preprocess.PreprocessedJobSource(path, settings = settings, workers = worker_count, chunk_size = chunk_size))
+            key = "preprocess_%sw" %worker_count
+            results[key + "_lines"] = _result(count / elapsed, "lines/s")
+            results[key + "_speedup"] = _result(baseline / elapsed, "x")
+            results[key + "_first_line"] = _result(first * 1000., "ms", False)
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+def benchmarkCache(lines, copies = 4):
+    """Starting a job for the first time against starting it again from the job cache."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        for _ in range(copies):
+            job_file.write("\n".join(lines) + "\n")
+    settings = Preprocess.PreprocessSettings(dry_run = True)
+    cache = JobCache.JobCache(os.path.join(directory, "cache"))
+    results = {}
+    try:
+        count = JobSource.FileJobSource(path).lineCount()
+        started = time.perf_counter()
+        source = JobSource.FileJobSource(path)
+        estimate = JobAnalysis.estimateJob(source.lines(), stride = JobCache.ESTIMATE_STRIDE)
+        source.close()
+        cold_estimate = time.perf_counter() - started
+        cold, cold_first = _consumeSource(JobSource.FileJobSource(path))
+
+        started = time.perf_counter()
+        key = JobCache.entryKey(JobCache.fileHash(path), settings)
+        cache.store(key, path, settings, estimate = estimate)
+        results["cache_store"] = _result(time.perf_counter() - started, "s", False)
+
+        started = time.perf_counter()
+        entry = cache.lookup(JobCache.entryKey(JobCache.fileHash(path), settings))
+        entry.estimate()
+        warm_start = time.perf_counter() - started
+        warm, warm_first = _consumeSource(entry.open())
+        results["cache_cold_start"] = _result((cold_estimate + cold_first) * 1000., "ms", False)
+        results["cache_warm_start"] = _result((warm_start + warm_first) * 1000., "ms", False)
+        results["cache_cold_lines"] = _result(count / cold, "lines/s")
+        results["cache_warm_lines"] = _result(count / warm, "lines/s")
+        results["cache_size_ratio"] = _result(entry.getSize() / os.path.getsize(path), "x", None)
+    finally:
+        cache.clear()
+        shutil.rmtree(directory, ignore_errors = True)
+    return results
+
+def benchmarkSpeculation(lines, copies = 4):
+    """Time to the first line of a sliced job printed right away against once it was preprocessed in advance.
+
+    Both start from the lines like Cura's gcode_list: hashing them for the
+    cache, then spooling and opening them, or taking the speculated entry
+    with its estimate and link demand.
+    """
+    directory = tempfile.mkdtemp()
+    gcode_list = [line + "\n" for line in lines] * copies
+    settings = Preprocess.PreprocessSettings(dry_run = True)
+    cache = JobCache.JobCache(os.path.join(directory, "cache"))
+    speculator = Speculation.Speculator()
+    results = {}
+    try:
+        started = time.perf_counter()
+        key = JobCache.entryKey(JobCache.linesHash(gcode_list), settings)
+        cache.lookup(key)
+        path = Preprocess.spoolLines(gcode_list, os.path.join(directory, "job.gcode"))
+        _, cold_first = _consumeSource(JobSource.FileJobSource(path))
+        cold_start = time.perf_counter() - started - cold_first
+
+        started = time.perf_counter()
+        job = speculator.sliced(gcode_list, [(cache, settings, directory, 0)])[0]
+        job.wait()
+        prepare = time.perf_counter() - started
+        if job.entry is None:
+            raise RuntimeError("Could not preprocess the job: %s" %(job.error,))
+
+        started = time.perf_counter()
+        key = JobCache.entryKey(JobCache.linesHash(gcode_list), settings)
+        speculator.claim(key)
+        entry = cache.lookup(key)
+        entry.estimate()
+        entry.demand()
+        warm_start = time.perf_counter() - started
+        _, warm_first = _consumeSource(entry.open())
+        results["speculation_prepare"] = _result(prepare, "s", False)
+        results["speculation_cold_start"] = _result((cold_start + cold_first) * 1000., "ms", False)
+        results["speculation_warm_start"] = _result((warm_start + warm_first) * 1000., "ms", False)
+    finally:
+        speculator.invalidate()
+        cache.clear()
+        shutil.rmtree(directory, ignore_errors = True)
+    return results
+
+def benchmarkValidation(lines, repeat = 3, chunk_lines = 65536):
+    """Validation checks alone on parsed moves, and the estimate with and without validating in its pass."""
+    limits = JobValidation.ValidationLimits(JobValidation.BuildVolume.fromMachine(220., 220., 250.))
+    chunks = []
+    state = JobAnalysis.MachineState()
+    for start in range(0, len(lines), chunk_lines):
+        moves = JobAnalysis.extractMoves(lines[start:start + chunk_lines], state)
+        state = JobAnalysis.finalState(moves, JobAnalysis.moveGeometry(moves)[2])
+        chunks.append((start, moves))
+    best_checks = best_estimate = best_both = None
+    for _ in range(repeat):
+        validator = JobValidation.JobValidator(limits)
+        started = time.perf_counter()
+        for start, moves in chunks:
+            validator.addMoves(moves, start)
+        elapsed = time.perf_counter() - started
+        best_checks = elapsed if best_checks is None else min(best_checks, elapsed)
+
+        started = time.perf_counter()
+        JobAnalysis.estimateJob(lines, stride = 64, chunk_lines = chunk_lines)
+        elapsed = time.perf_counter() - started
+        best_estimate = elapsed if best_estimate is None else min(best_estimate, elapsed)
+
+        validator = JobValidation.JobValidator(limits)
+        started = time.perf_counter()
+        JobAnalysis.estimateJob(lines, stride = 64, chunk_lines = chunk_lines, validator = validator)
+        elapsed = time.perf_counter() - started
+        best_both = elapsed if best_both is None else min(best_both, elapsed)
+    if not validator.getReport().isValid():
+        raise AssertionError("The synthetic job failed the validation")
+    return {"validate_checks": _result(len(lines) / best_checks, "lines/s"),
+            "validate_estimate": _result(len(lines) / best_estimate, "lines/s"),
+            "validate_estimate_and_checks": _result(len(lines) / best_both, "lines/s"),
+            }
+
+def _transportEngine(server, transport):
+    """(engine, address, port) streaming to the emulator over one of the transports."""
+    engine = StreamingEngine.StreamingEngine(transport)
+    if transport == "socketpair":
+        engine.setTransport(Connection.createSocketPairConnector(server.attach))
+        return engine, None, None
+    if transport == "serial":
+        engine.setTransport("serial")
+        return engine, server.openPty(), 115200
+    server.start()
+    return engine, server.host, server.port
+
+def _streamWithEngine(engine, address, port, path, upload_name = None):
+    """Seconds the engine takes to stream (or upload) the file, stops it afterwards."""
+    engine.start(address, port)
+    try:
+        started = time.perf_counter()
+        engine.sendFile(path, upload_name)
+        if not engine.waitForJob(interval = 0.1):
+            raise RuntimeError("Streaming %s to %s has failed" %(path, engine.getName()))
+        return time.perf_counter() - started
+    finally:
+        engine.stop()
+
+def benchmarkTransports(lines, transports = ("tcp", "socketpair", "serial"), limit = 5000, window = 8):
+    """The whole StreamingEngine against the emulator over every transport.
+
+    The socketpair has no network and no line discipline in between, so it
+    shows the overhead of the host alone.
+    """
+    if not hasattr(os, "openpty"):
+        transports = [transport for transport in transports if transport != "serial"]
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(lines[:limit]) + "\n")
+    results = {}
+    try:
+        for transport in transports:
+            server = Emulator.EmulatorServer(speed = 0.)
+            engine, address, port = _transportEngine(server, transport)
+            try:
+                engine.setSendWindow(window)
+                elapsed = _streamWithEngine(engine, address, port, path)
+            finally:
+                server.stop()
+            key = "transport_%s" %transport
+            results[key + "_lines"] = _result(min(limit, len(lines)) / elapsed, "lines/s")
+            results[key + "_lines_per_write"] = _result(engine.getMetrics().getSummary()["lines_per_write"], "lines/syscall", None)
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+def benchmarkBridge(lines, rtts = (0.005, 0.02), jitter = 0.5, limit = 1000):
+    """Streaming line by line over WiFi against buffering in the reference bridge.
+
+    The WiFi link has the round trip time rtt with a standard deviation of
+    jitter * rtt, the bridge reaches the emulator over a socketpair.
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(lines[:limit]) + "\n")
+    count = min(limit, len(lines))
+    results = {}
+    try:
+        for rtt in rtts:
+            key = "bridge_rtt_%sms" %int(rtt * 1000)
+            with Emulator.EmulatorServer(latency = rtt, jitter = rtt * jitter, speed = 0.) as server:
+                elapsed = _streamWithEngine(StreamingEngine.StreamingEngine("direct"), server.host, server.port, path)
+            results[key + "_direct_lines"] = _result(count / elapsed, "lines/s")
+
+            server = Emulator.EmulatorServer(speed = 0.)
+            bridge = Bridge.ReferenceBridge(Connection.createSocketPairConnector(server.attach),
+                                            latency = rtt, jitter = rtt * jitter)
+            try:
+                bridge.start()
+                engine = StreamingEngine.StreamingEngine("buffered")
+                engine.setBridgeBuffering(True)
+                elapsed = _streamWithEngine(engine, bridge.host, bridge.port, path)
+            finally:
+                bridge.stop()
+                server.stop()
+            results[key + "_buffered_lines"] = _result(count / elapsed, "lines/s")
+            results[key + "_lines_per_ack"] = _result(count / max(bridge.acks, 1), "lines/ack", None)
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+def _runBandwidthScenario(live_path, bulk_path, live, bulk, link_rate, rate, rtt):
+    """Streams to live printers while bulk ones upload, all behind one link. Returns (live engines, bulk engines, s)."""
+    scheduler = Bandwidth.getScheduler()
+    previous_rate = scheduler.getRate()
+    scheduler.setRate(rate)
+    link = Bandwidth.TokenBucket(link_rate)
+    servers = [Emulator.EmulatorServer(latency = rtt, speed = 0., bandwidth = link).start() for _ in range(live + bulk)]
+    engines = [StreamingEngine.StreamingEngine("printer%s" %index) for index in range(live + bulk)]
+    try:
+        for index, (engine, server) in enumerate(zip(engines, servers)):
+            # Streams are paced by their "ok"s, uploads fill the link
+            engine.setSendWindow(1 if index < live else 16)
+            engine.start(server.host, server.port)
+        started = time.perf_counter()
+        for index, engine in enumerate(engines):
+            if index < live:
+                engine.sendFile(live_path)
+            else:
+                engine.sendFile(bulk_path, "bench.gco")
+        for engine in engines[:live]:
+            if not engine.waitForJob(interval = 0.1):
+                raise RuntimeError("Streaming to %s has failed" %engine.getName())
+        elapsed = time.perf_counter() - started
+        return engines[:live], engines[live:], elapsed
+    finally:
+        for engine in engines:
+            engine.stop()
+        for server in servers:
+            server.stop()
+        scheduler.setRate(previous_rate)
+
+def benchmarkBandwidth(lines, live = 2, bulk = 2, link_rate = 40e3, rtt = 0.005, limit = 1000):
+    """Live streams next to SD uploads on one link of link_rate bytes/s, with and without the scheduler.
+
+    The emulators share a token bucket like printers on one access point.
+    Unscheduled, every printer sends as fast as it can and the link is
+    shared in turns. Scheduled, all printers together stay at 90% of the
+    link and the live streams go first.
+    """
+    directory = tempfile.mkdtemp()
+    live_path = os.path.join(directory, "live.gcode")
+    bulk_path = os.path.join(directory, "bulk.gcode")
+    with open(live_path, "w") as job_file:
+        job_file.write("\n".join(lines[:limit]) + "\n")
+    with open(bulk_path, "w") as job_file:
+        job_file.write("\n".join(lines) + "\n")
+    count = min(limit, len(lines))
+    results = {}
+    try:
+        for name, rate in (("unscheduled", None), ("scheduled", link_rate * 0.9)):
+            live_engines, bulk_engines, elapsed = _runBandwidthScenario(live_path, bulk_path, live, bulk, link_rate, rate, rtt)
+            rtts = [engine.getMetrics().getSummary()["rtt"]["p99"] for engine in live_engines]
+            bulk_bytes = sum(engine.getMetrics().bytes_sent for engine in bulk_engines)
+            key = "bandwidth_%s" %name
+            results[key + "_live_lines"] = _result(count / elapsed, "lines/s")
+            results[key + "_live_rtt_p99"] = _result(max(rtt or 0. for rtt in rtts) * 1000., "ms", False)
+            results[key + "_bulk"] = _result(bulk_bytes / elapsed / 1e3, "kB/s", None)
+    finally:
+        for path in (live_path, bulk_path):
+            os.remove(path)
+        os.rmdir(directory)
+    return results
+
+def benchmarkHeatWaits(lines, heat_rate = 20., limit = 1000, probe_interval = 0.1):
+    """Responsiveness of the link while M190 and M109 heat up, waiting in the firmware and on the host.
+
+    A status query is injected every probe_interval seconds, its round trip
+    shows how long the link is blocked. The heaters warm up by heat_rate
+    degrees/s while the planner is instantaneous.
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(["M140 S60", "M104 S210", "M190 S60", "M109 S210"] + lines[:limit]) + "\n")
+    results = {}
+    try:
+        for name, host in (("firmware", False), ("host", True)):
+            # The emulator's heaters run 1000 times faster without planner speed
+            with Emulator.EmulatorServer(speed = 0., heat_rate = heat_rate / 1000.) as server:
+                engine = StreamingEngine.StreamingEngine(name)
+                engine.setHostHeatWaits(host)
+                engine.start(server.host, server.port)
+                probes = []
+                done = threading.Event()
+                def probe():
+                    while not done.is_set():
+                        started = time.perf_counter()
+                        engine.injectCommand(GCodeLibrary.RawLine(b"M105"), wait = True)
+                        probes.append(time.perf_counter() - started)
+                        done.wait(probe_interval)
+                prober = threading.Thread(target = probe, daemon = True)
+                prober.start()
+                started = time.perf_counter()
+                engine.sendFile(path)
+                engine.waitForJob(interval = 0.05)
+                elapsed = time.perf_counter() - started
+                done.set()
+                prober.join()
+                engine.stop()
+            key = "heat_%s" %name
+            results[key + "_job"] = _result(elapsed, "s", False)
+            results[key + "_probe_max"] = _result(max(probes) * 1000., "ms", False)
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+class _SignalingEngine(StreamingEngine.StreamingEngine):
+    """Engine whose state is shown like by Cura: a signal for every field which changes.
+
+    Changes are applied right away, or posted to aggregator and applied by it.
+    """
+    def __init__(self, name, aggregator = None):
+        StreamingEngine.StreamingEngine.__init__(self, name)
+        self.aggregator = aggregator
+        self.state = {}
+        self.emissions = 0
+
+    def _post(self, field, value):
+        if self.aggregator is None:
+            self.applyUpdates({field: value})
+        else:
+            self.aggregator.post(self, field, value)
+
+    def _updateJobState(self, job_state):
+        StreamingEngine.StreamingEngine._updateJobState(self, job_state)
+        self._post("job_state", job_state)
+
+    def _setJobProgress(self, sent_lines):
+        StreamingEngine.StreamingEngine._setJobProgress(self, sent_lines)
+        self._post("progress", self._stream_progress)
+        self._post("time_elapsed", int(self._stream_elapsed))
+
+    def applyUpdates(self, changes):
+        for field, value in changes.items():
+            if self.state.get(field) != value:
+                self.state[field] = value
+                self.emissions += 1
+
+def benchmarkUiUpdates(lines, printers = (1, 4), limit = 2000, window = 8):
+    """Signals per second for the UI while N printers stream, applied right away against aggregated.
+
+    Every line reports its progress, the engine doesn't throttle it here.
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(lines[:limit]) + "\n")
+    results = {}
+    try:
+        for count in printers:
+            for name in ("direct", "aggregated"):
+                aggregator = UpdateAggregator.UpdateAggregator().start() if name == "aggregated" else None
+                servers = [Emulator.EmulatorServer(speed = 0.) for _ in range(count)]
+                engines = []
+                for index, server in enumerate(servers):
+                    engine = _SignalingEngine("printer %d" %index, aggregator)
+                    engine.setTransport(Connection.createSocketPairConnector(server.attach))
+                    engine.setSendWindow(window)
+                    engine._progress_interval = 0.
+                    engine.start(None, None)
+                    engines.append(engine)
+                try:
+                    started = time.perf_counter()
+                    for engine in engines:
+                        engine.sendFile(path)
+                    for engine in engines:
+                        if not engine.waitForJob(interval = 0.05):
+                            raise RuntimeError("Streaming to %s has failed" %engine.getName())
+                    elapsed = time.perf_counter() - started
+                finally:
+                    for engine in engines:
+                        engine.stop()
+                    for server in servers:
+                        server.stop()
+                    if aggregator is not None:
+                        aggregator.stop()
+                key = "ui_%d_printers_%s" %(count, name)
+                results[key + "_signals"] = _result(sum(engine.emissions for engine in engines) / elapsed, "signals/s", False)
+                results[key + "_lines"] = _result(count * min(limit, len(lines)) / elapsed, "lines/s")
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+def _segmentJob(moves, step, feedrate = 3000, seed = 0):
+    """Zig-zag of moves step mm long, too short for the link or long enough."""
+    rng = random.Random(seed)
+    lines = ["G92 E0", "G1 F%s" %feedrate]
+    x = 100.
+    extrusion = 0.
+    for _ in range(moves):
+        x += rng.choice((-step, step))
+        extrusion += 0.01
+        lines.append("G1 X%.3f Y100 E%.4f" %(x, extrusion))
+    return lines
+
+def benchmarkPreflight(rtts = (0.005, 0.02), jobs = (("tiny", 400, 0.2), ("long", 100, 2.))):
+    """Job time of streaming predicted by the preflight analysis against streaming to the emulator.
+
+    The emulator's planner runs in real time and doesn't accelerate, so
+    the estimate doesn't either. The link is measured by the job itself,
+    like by the jobs before in Cura.
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "job.gcode")
+    results = {}
+    try:
+        for name, moves, step in jobs:
+            lines = _segmentJob(moves, step)
+            with open(path, "w") as job_file:
+                job_file.write("\n".join(lines) + "\n")
+            demand = Preflight.LinkDemand()
+            JobAnalysis.estimateJob(lines, acceleration = 1e9, jerk = 1e9, demand = demand)
+            for rtt in rtts:
+                # Half the delay on the way there, half on the way back
+                server = Emulator.EmulatorServer(latency = rtt / 2., speed = 1.).start()
+                engine = StreamingEngine.StreamingEngine("preflight")
+                try:
+                    engine.start(server.host, server.port)
+                    started = time.perf_counter()
+                    engine.sendFile(path)
+                    if not engine.waitForJob(interval = 0.1):
+                        raise RuntimeError("Streaming the %s job has failed" %name)
+                    while server.firmware.planner.remaining():
+                        time.sleep(0.001)
+                    measured = time.perf_counter() - started
+                    report = Preflight.analyze(demand, engine.getLinkProfile())
+                finally:
+                    engine.stop()
+                    server.stop()
+                key = "preflight_%s_rtt_%sms" %(name, int(rtt * 1000))
+                results[key + "_predicted"] = _result(report.getDirectTime(), "s", None)
+                results[key + "_measured"] = _result(measured, "s", None)
+                results[key + "_error"] = _result(100. * abs(report.getDirectTime() - measured) / measured, "%", False)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
+    return results
+
+_IMPORT_SCRIPT = """
+import importlib
+import sys
+for name in %(preloaded)r:
+    importlib.import_module(name)
+try:
+    for name in %(um_preloaded)r:
+        importlib.import_module(name)
+    has_um = True
+except ImportError:
+    has_um = False
+import %(root)s
+if has_um:
+    # What register() imports
+    import %(root)s.SerialWifiOutputDevicePlugin
+import %(root)s.StreamingEngine
+"""
+
+def _importTimes(root, parent):
+    """{module: cumulative import time in s} of a fresh interpreter importing the plugin like Cura."""
+    script = _IMPORT_SCRIPT %{"preloaded": CURA_PRELOADED, "um_preloaded": UM_PRELOADED, "root": root}
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd = parent,
+                             stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True, check = True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+def benchmarkImport(repeat = 5, budget = IMPORT_BUDGET):
+    """Time the plugin adds to Cura's startup: importing the package and what register() imports.
+
+    Measured in fresh interpreters which already loaded what Cura loads
+    before its plugins; without Cura's modules only the package itself is
+    measured. Raises if the plugin takes longer than budget ms. The
+    headless import of StreamingEngine is reported as well.
+    """
+    root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    root = os.path.basename(root_directory)
+    parent = os.path.dirname(root_directory)
+    best = {}
+    for _ in range(repeat):
+        times = _importTimes(root, parent)
+        for name in (root, root + ".SerialWifiOutputDevicePlugin", root + ".StreamingEngine"):
+            if name in times:
+                best[name] = min(best.get(name, times[name]), times[name])
+    startup = best[root] + best.get(root + ".SerialWifiOutputDevicePlugin", 0.)
+    if startup * 1000. > budget:
+        raise AssertionError("The plugin adds %.1f ms to Cura's startup, more than %.1f ms" %(startup * 1000., budget))
+    return {"import_plugin": _result(startup * 1000., "ms", False),
+            "import_streaming_engine": _result(best.get(root + ".StreamingEngine", 0.) * 1000., "ms", False),
+            }
+
+BENCHMARKS = collections.OrderedDict((("parse", lambda job, options: benchmarkParsing(job)),
+                                      ("encode", lambda job, options: benchmarkEncoding(job)),
+                                      ("flags", lambda job, options: benchmarkCommandFlags(job)),
+                                      ("memory", lambda job, options: benchmarkQueueMemory(job)),
+                                      ("receive", lambda job, options: benchmarkReceive()),
+                                      ("write", lambda job, options: benchmarkWrites(job)),
+                                      ("stream", lambda job, options: benchmarkStreaming(job, options.rtts, options.stream_lines)),
+                                      ("upload", lambda job, options: benchmarkUpload(job, options.rtts, options.stream_lines)),
+                                      ("capabilities", lambda job, options: benchmarkCapabilities(job, limit = options.stream_lines)),
+                                      ("reconnect", lambda job, options: benchmarkReconnect(job, limit = options.stream_lines)),
+                                      ("journal", lambda job, options: benchmarkJournal(job)),
+                                      ("preprocess", lambda job, options: benchmarkPreprocess(job, options.workers)),
+                                      ("cache", lambda job, options: benchmarkCache(job)),
+                                      ("speculate", lambda job, options: benchmarkSpeculation(job)),
+                                      ("validate", lambda job, options: benchmarkValidation(job)),
+                                      ("import", lambda job, options: benchmarkImport()),
+                                      ("transport", lambda job, options: benchmarkTransports(job)),
+                                      ("bridge", lambda job, options: benchmarkBridge(job)),
+                                      ("bandwidth", lambda job, options: benchmarkBandwidth(job)),
+                                      ("heat", lambda job, options: benchmarkHeatWaits(job)),
+                                      ("ui", lambda job, options: benchmarkUiUpdates(job)),
+                                      ("preflight", lambda job, options: benchmarkPreflight()),
+                                      ))
+
+def run(job, names, options):
+    results = collections.OrderedDict()
+    for name in names:
+        results.update(BENCHMARKS[name](job, options))
+    return {"meta": {"python": sys.version.split()[0],
+                     "platform": platform.platform(),
+                     "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     "job_lines": len(job),
+                     "cpu_count": os.cpu_count(),
+                     },
+            "results": results,
+            }
+
+def compare(results, baseline, tolerance = 0.1):
+    """Returns rows of (name, baseline, current, change, regressed)."""
+    rows = []
+    for name, current in results["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous or not previous["value"]:
+            rows.append((name, None, current["value"], None, False))
+            continue
+        change = current["value"] / previous["value"] - 1.
+        if current["higher_is_better"] is None:
+            # Informational only
+            regressed = False
+        elif current["higher_is_better"]:
+            regressed = change < -tolerance
+        else:
+            regressed = change > tolerance
+        rows.append((name, previous["value"], current["value"], change, regressed))
+    return rows
+
+def loadJob(path):
+    with open(path) as gcode_file:
+        return [line for line in gcode_file.read().split("\n") if line]
+
+def writeResults(results, path):
+    with open(path, "w") as result_file:
+        json.dump(results, result_file, indent = 2)
+
+def loadResults(path):
+    with open(path) as result_file:
+        return json.load(result_file)
@@ -0,0 +1,41 @@
+import argparse
+import sys
+
+from . import BENCHMARKS, DEFAULT_RTTS, compare, generateJob, loadJob, loadResults, run, writeResults
+
+parser = argparse.ArgumentParser(description = "Benchmarks for parsing, encoding and streaming G-code.")
+parser.add_argument("benchmarks", nargs = "*", default = [],
+                    help = "benchmarks to run, all by default: %s" %", ".join(BENCHMARKS.keys()))
+parser.add_argument("--gcode", help = "G-code file to use instead of the synthetic job")
+parser.add_argument("--layers", type = int, default = 50, help = "layers of the synthetic job")
+parser.add_argument("--rtts", type = float, nargs = "+", default = list(DEFAULT_RTTS), help = "simulated round trip times in s")
+parser.add_argument("--stream-lines", type = int, default = 2000, help = "lines to stream/upload per round trip time")
+parser.add_argument("--workers", type = int, nargs = "+", help = "preprocessing workers to compare, 0 to the number of cores by default")
+parser.add_argument("--output", help = "write the results as JSON to this file")
+parser.add_argument("--compare", metavar = "BASELINE", help = "compare against stored results, exit with 1 on regressions")
+parser.add_argument("--tolerance", type = float, default = 0.1, help = "allowed relative change before a result counts as regression")
+options = parser.parse_args()
+for name in options.benchmarks:
+    if name not in BENCHMARKS:
+        parser.error("unknown benchmark: %s" %name)
+
+job = loadJob(options.gcode) if options.gcode else generateJob(options.layers)
+results = run(job, options.benchmarks or list(BENCHMARKS.keys()), options)
+
+if options.output:
+    writeResults(results, options.output)
+
+regressions = 0
+if options.compare:
+    print("%-28s %14s %14s %9s" %("benchmark", "baseline", "current", "change"))
+    for name, previous, current, change, regressed in compare(results, loadResults(options.compare), options.tolerance):
+        if previous is None:
+            print("%-28s %14s %14.3f %9s" %(name, "-", current, "new"))
+            continue
+        print("%-28s %14.3f %14.3f %+8.1f%% %s" %(name, previous, current, change * 100, "REGRESSION" if regressed else ""))
+        regressions += regressed
+else:
+    for name, result in results["results"].items():
+        print("%-28s %14.3f %s" %(name, result["value"], result["unit"]))
+
+sys.exit(1 if regressions else 0)
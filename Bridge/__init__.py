@@ -0,0 +1,320 @@
+'''
+Reference WiFi serial bridge with the buffering protocol.
+
+A plain bridge forwards TCP to the printer's serial port: every "ok" goes
+printer -> bridge -> WiFi -> Cura before the next line can go out, so
+WiFi jitter starves the planner. A bridge advertising the Zeroconf TXT
+property "buffer" (Connection.BRIDGE_BUFFER_PROPERTY, the lines it can
+buffer) offers this instead:
+
+- the host sends "@buffer on", the bridge answers "@buffer <lines>"
+- from then on the bridge queues the host's lines and writes them to the
+  printer one by one, each after the "ok" of the one before
+- plain "ok"s are counted instead of forwarded, "@ok <count>" reports
+  them every ack_interval seconds or every ack_every "ok"s
+- everything else the printer says is forwarded right away, after an
+  "@ok" for the lines before it
+- "Resend:" requests are answered from the bridge's copy of the written
+  lines, the host only sees the ones the bridge can't answer
+
+Lines the host sends before "@buffer on" are forwarded unbuffered, like
+by any other bridge. The printer side is one of Connection's transports,
+eg. a SerialConnection or a SocketPairConnection to the Emulator. Run
+with "python -m <plugin folder>.Bridge --help".
+'''
+
+import collections
+import heapq
+import random
+import socket
+import threading
+import time
+
+from .. import Connection
+from .. import GCodeLibrary
+from ..Log import Logger
+
+HISTORY_SIZE = 1024 # written lines kept for resend requests
+
+def isPlainOk(line):
+    """"ok" without a value for the host, eg. "ok" or the "ok N12 P15 B3" of ADVANCED_OK."""
+    return line == "ok" or Connection.parseAdvancedOk(line) is not None
+
+def lineNumber(data):
+    """Line number of a numbered line like b"N12 G1 X10*85", otherwise None."""
+    if data[:1] != b"N":
+        return None
+    try:
+        return int(bytes(data[1:12]).split(None, 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+class BridgeSession():
+    """One host connection: reads its lines and writes the (delayed) answers."""
+    def __init__(self, bridge, connection):
+        self.bridge = bridge
+        self.connection = connection
+        self.alive = True
+        self.buffered = False
+        self.pending_oks = 0
+        self._answers = []
+        self._answers_due = 0.
+        self._answers_sequence = 0
+        self._answers_condition = threading.Condition()
+
+    def output(self, line):
+        bridge = self.bridge
+        delay = bridge.latency
+        if bridge.jitter:
+            delay = max(0., delay + random.gauss(0., bridge.jitter))
+        with self._answers_condition:
+            # Answers never overtake each other
+            self._answers_due = max(self._answers_due, time.monotonic() + delay)
+            self._answers_sequence += 1
+            heapq.heappush(self._answers, (self._answers_due, self._answers_sequence, (line + "\n").encode("utf-8")))
+            self._answers_condition.notify()
+
+    def acknowledge(self):
+        self.pending_oks += 1
+        if self.pending_oks >= self.bridge.ack_every:
+            self.flushAcks()
+
+    def flushAcks(self):
+        if self.pending_oks:
+            self.output("@ok %d" %self.pending_oks)
+            self.bridge.acks += 1
+            self.pending_oks = 0
+
+    def _writer(self):
+        while self.alive:
+            with self._answers_condition:
+                if not self._answers:
+                    self._answers_condition.wait(0.1)
+                    continue
+                due = self._answers[0][0]
+                now = time.monotonic()
+                if due > now:
+                    self._answers_condition.wait(due - now)
+                    continue
+                data = b""
+                while self._answers and self._answers[0][0] <= now:
+                    data += heapq.heappop(self._answers)[2]
+            try:
+                self.connection.sendall(data)
+            except OSError:
+                self.alive = False
+
+    def _acker(self):
+        bridge = self.bridge
+        while self.alive:
+            time.sleep(bridge.ack_interval)
+            with bridge._condition:
+                self.flushAcks()
+
+    def serve(self):
+        bridge = self.bridge
+        threading.Thread(target = self._writer, daemon = True).start()
+        threading.Thread(target = self._acker, daemon = True).start()
+        buffer = b""
+        try:
+            while self.alive:
+                position = buffer.find(b"\n")
+                if position == -1:
+                    data = self.connection.recv(65536)
+                    if not data:
+                        break
+                    buffer += data
+                    continue
+                line = buffer[:position].rstrip(b"\r")
+                buffer = buffer[position + 1:]
+                if not line:
+                    continue
+                if line == Connection.BRIDGE_BUFFER_ON:
+                    self.buffered = True
+                    self.output("@buffer %d" %bridge.buffer_size)
+                elif line[:1] == b"@":
+                    self.output("@error unknown message")
+                elif self.buffered:
+                    bridge.enqueue(line)
+                else:
+                    bridge.writePrinter(line)
+        except OSError:
+            pass
+        finally:
+            self.alive = False
+            bridge.sessionClosed(self)
+            try:
+                self.connection.close()
+            except OSError:
+                pass
+
+class ReferenceBridge():
+    """Serves the printer reached by connector() (a Connection.StreamConnection) on a TCP port."""
+    def __init__(self, connector, printer_address = None, printer_port = None, host = "127.0.0.1", port = 0,
+                 buffer_size = 512, ack_every = 32, ack_interval = 0.02, ok_timeout = 30., latency = 0., jitter = 0.):
+        self.connector = connector
+        self.printer_address = printer_address
+        self.printer_port = printer_port
+        self.host = host
+        self.port = port
+        self.buffer_size = buffer_size # lines
+        self.ack_every = ack_every # "ok"s, reported at once
+        self.ack_interval = ack_interval # s, reported at the latest
+        self.ok_timeout = ok_timeout # s without anything from the printer until an "ok" is given up on
+        self.latency = latency # s, simulated WiFi delay of the answers
+        self.jitter = jitter # s, its standard deviation
+        self.printer = None
+        self.session = None
+        self.running = False
+        self.acks = 0
+        self.local_resends = 0
+
+        self._condition = threading.Condition()
+        self._queue = collections.deque() # lines of the host for the printer
+        self._outstanding = None # (session, monotonic time) of the written line waiting for its "ok"
+        self._history = collections.OrderedDict() # line number: written line
+        self._skip_oks = 0 # "ok"s following resends the bridge answered itself
+        self._forward_oks = 0 # "ok"s following resends for the host
+        self._printer_active_at = 0.
+        self._printer_lock = threading.Lock()
+        self._socket = None
+
+    def getProperties(self):
+        """Zeroconf TXT properties advertising the buffer."""
+        return {Connection.BRIDGE_BUFFER_PROPERTY: str(self.buffer_size).encode("utf-8")}
+
+    def start(self):
+        self.printer = self.connector()
+        self.printer.connect(self.printer_address, self.printer_port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(1)
+        self.port = self._socket.getsockname()[1]
+        self.running = True
+        for target in (self._accept, self._readPrinter, self._writePrinter):
+            threading.Thread(target = target, daemon = True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        with self._condition:
+            self._condition.notify_all()
+        if self.session is not None:
+            self.session.alive = False
+        if self._socket is not None:
+            sock = self._socket
+            self._socket = None
+            sock.close()
+        if self.printer is not None:
+            self.printer.disconnect()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _accept(self):
+        while self._socket is not None:
+            try:
+                connection, address = self._socket.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._condition:
+                # Like any serial bridge: only the newest host is served
+                if self.session is not None:
+                    self.session.alive = False
+                self.session = BridgeSession(self, connection)
+            threading.Thread(target = self.session.serve, daemon = True).start()
+
+    def sessionClosed(self, session):
+        with self._condition:
+            if session is self.session:
+                # Not written yet, the host sends them again after reconnecting
+                self._queue.clear()
+
+    def enqueue(self, line):
+        with self._condition:
+            self._queue.append(line)
+            self._condition.notify()
+
+    def writePrinter(self, line):
+        with self._printer_lock:
+            self.printer.send(line)
+
+    def _linesFrom(self, number):
+        if number not in self._history:
+            return None
+        return [data for line_number, data in self._history.items() if line_number >= number]
+
+    def _writePrinter(self):
+        while self.running:
+            with self._condition:
+                if self._outstanding is not None:
+                    started = max(self._outstanding[1], self._printer_active_at)
+                    if time.monotonic() - started > self.ok_timeout:
+                        Logger.log("w", "No answer of the printer for %ss, writing the next line", self.ok_timeout)
+                        self._outstanding = None
+                if self._outstanding is not None or not self._queue:
+                    self._condition.wait(0.1)
+                    continue
+                data = self._queue.popleft()
+                if b"M110" in data:
+                    # Numbering starts over
+                    self._history.clear()
+                number = lineNumber(data)
+                if number is not None:
+                    self._history[number] = data
+                    self._history.move_to_end(number)
+                    if len(self._history) > HISTORY_SIZE:
+                        self._history.popitem(last = False)
+                self._outstanding = (self.session, time.monotonic())
+            self.writePrinter(data)
+
+    def _readPrinter(self):
+        while self.running:
+            printer = self.printer
+            if not printer.isConnected():
+                Logger.log("e", "Lost the printer")
+                self.running = False
+                break
+            line = printer.receiveLine()
+            if line is None:
+                continue
+            with self._condition:
+                self._printer_active_at = time.monotonic()
+                self._answer(line)
+
+    def _answer(self, line):
+        """Handles a line of the printer (called with _condition held)."""
+        session = self.session
+        if self._outstanding is not None:
+            resend = Connection.parseResend(line)
+            if resend is not None:
+                lines = self._linesFrom(resend)
+                if lines is not None:
+                    # Written by the bridge, so it writes them again
+                    self.local_resends += 1
+                    self._skip_oks += 1
+                    self._queue.extendleft(reversed(lines))
+                    return
+                self._forward_oks += 1
+            elif GCodeLibrary.isOk(line):
+                owner = self._outstanding[0]
+                self._outstanding = None
+                self._condition.notify()
+                if self._skip_oks:
+                    self._skip_oks -= 1
+                    return
+                if self._forward_oks:
+                    self._forward_oks -= 1
+                elif isPlainOk(line):
+                    if owner is session and session is not None:
+                        session.acknowledge()
+                    # Otherwise the line came from a former connection, whose host doesn't wait anymore
+                    return
+        if session is not None and session.alive:
+            session.flushAcks()
+            session.output(line)
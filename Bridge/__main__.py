@@ -0,0 +1,60 @@
+import argparse
+import logging
+import socket
+import time
+
+from .. import Connection
+from .. import Emulator
+from .. import StreamingEngine
+from . import ReferenceBridge
+
+parser = argparse.ArgumentParser(description = "WiFi serial bridge with the buffering protocol, for tests and benchmarks.")
+printer = parser.add_mutually_exclusive_group(required = True)
+printer.add_argument("--serial", metavar = "DEVICE", help = "serial port of the printer, eg. /dev/ttyUSB0")
+printer.add_argument("--emulate", action = "store_true", help = "bridge to an emulated printer in this process")
+parser.add_argument("--baudrate", type = int, default = 115200)
+parser.add_argument("--host", default = "127.0.0.1")
+parser.add_argument("--port", type = int, default = 2323)
+parser.add_argument("--buffer", type = int, default = 512, help = "lines buffered for the host")
+parser.add_argument("--latency", type = float, default = 0., help = "simulated WiFi delay of every answer in s")
+parser.add_argument("--jitter", type = float, default = 0., help = "standard deviation of the delay in s")
+parser.add_argument("--advertise", metavar = "NAME", help = "announce the bridge with Zeroconf under this name")
+parser.add_argument("-v", "--verbose", action = "store_true", help = "log the details")
+options = parser.parse_args()
+
+logging.basicConfig(level = logging.DEBUG if options.verbose else logging.WARNING,
+                    format = "%(asctime)s %(levelname)s %(message)s")
+
+if options.emulate:
+    server = Emulator.EmulatorServer(speed = 0.)
+    bridge = ReferenceBridge(Connection.createSocketPairConnector(server.attach))
+else:
+    bridge = ReferenceBridge(Connection.SerialConnection, options.serial, options.baudrate)
+bridge.host = options.host
+bridge.port = options.port
+bridge.buffer_size = options.buffer
+bridge.latency = options.latency
+bridge.jitter = options.jitter
+bridge.start()
+print("Bridging to the printer on %s:%s" %(bridge.host, bridge.port))
+
+zero_conf = None
+if options.advertise:
+    from zeroconf import Zeroconf, ServiceInfo
+    zero_conf = Zeroconf()
+    zero_conf.register_service(ServiceInfo(StreamingEngine.SERVICE_TYPE,
+                                           "%s.%s" %(options.advertise, StreamingEngine.SERVICE_TYPE),
+                                           addresses = [socket.inet_aton(bridge.host)],
+                                           port = bridge.port,
+                                           properties = bridge.getProperties(),
+                                           ))
+try:
+    while bridge.running:
+        time.sleep(1)
+except KeyboardInterrupt:
+    pass
+finally:
+    if zero_conf is not None:
+        zero_conf.unregister_all_services()
+        zero_conf.close()
+    bridge.stop()
@@ -0,0 +1,124 @@
+'''
+Firmware capabilities reported by M115, remembered per printer.
+
+The answer of M115 is a FIRMWARE_NAME line followed by one "Cap:NAME:value"
+line per capability (Marlin and compatibles). The result is stored on disk
+keyed by the printer's Zeroconf name and the firmware it reported, so later
+connects pick the transfer and flow control modes without asking again.
+A firmware update shows up as a new firmware name (if the bridge advertises
+it) or is picked up with forget() and a new handshake.
+'''
+
+import json
+import os
+import threading
+import time
+
+STORE_VERSION = 1
+
+# Flow control
+FLOW_STOP_AND_WAIT = "stop_and_wait" # one line per "ok", or the configured send window
+FLOW_ADVANCED_OK = "advanced_ok" # window sized by the free buffer slots of every "ok"
+
+# SD upload
+TRANSFER_TEXT = "text" # M28 and every line answered by "ok"
+
+class FirmwareCapabilities():
+    def __init__(self, firmware_info = None, capabilities = None, negotiated_at = None):
+        self.firmware_info = dict(firmware_info or {})
+        self.capabilities = dict(capabilities or {})
+        self.negotiated_at = negotiated_at
+
+    @classmethod
+    def fromM115(cls, command):
+        """Capabilities of a finished GCodeLibrary.RepRapCommands.M115."""
+        return cls(command.getFirmwareInfo(), command.getCapabilities(), time.time())
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(data.get("firmware"), data.get("capabilities"), data.get("negotiated_at"))
+
+    def toDict(self):
+        return {"firmware": self.firmware_info,
+                "capabilities": self.capabilities,
+                "negotiated_at": self.negotiated_at,
+                }
+
+    def toProperties(self):
+        """Entries for the Zeroconf properties of a device, bytes like those."""
+        properties = {b"firmware": self.getFirmwareName().encode("utf-8")}
+        for name, value in self.capabilities.items():
+            properties[("cap_" + name.lower()).encode("utf-8")] = str(value).encode("utf-8")
+        return properties
+
+    def getFirmwareName(self):
+        """Name and version as reported, eg. "Marlin 2.0.9 (Github)", "" if unknown."""
+        return self.firmware_info.get("FIRMWARE_NAME", "")
+
+    def has(self, name):
+        """Whether the firmware reported the capability at all."""
+        return name in self.capabilities
+
+    def supports(self, name):
+        return bool(self.capabilities.get(name, 0))
+
+    def getValue(self, name, default = None):
+        return self.capabilities.get(name, default)
+
+    def flowControl(self):
+        if self.supports("ADVANCED_OK"):
+            return FLOW_ADVANCED_OK
+        return FLOW_STOP_AND_WAIT
+
+    def transferMode(self):
+        # BINARY_FILE_TRANSFER is recorded, but Marlin's binary protocol isn't implemented yet
+        return TRANSFER_TEXT
+
+class CapabilityStore():
+    """JSON file of {printer name: {firmware name: capabilities}}."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as store_file:
+                data = json.load(store_file)
+            if data.get("version") == STORE_VERSION:
+                return data
+        except (OSError, ValueError, AttributeError):
+            pass
+        return {"version": STORE_VERSION, "printers": {}}
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as store_file:
+            json.dump(data, store_file, indent = 1, sort_keys = True)
+        os.replace(temporary, self.path)
+
+    def lookup(self, name, firmware = None):
+        """Capabilities of a printer, of the given firmware or of the last negotiated one."""
+        with self._lock:
+            known = self._read()["printers"].get(name, {})
+        if firmware is not None:
+            entry = known.get(firmware)
+            return FirmwareCapabilities.fromDict(entry) if entry is not None else None
+        if not known:
+            return None
+        latest = max(known.values(), key = lambda entry: entry.get("negotiated_at") or 0.)
+        return FirmwareCapabilities.fromDict(latest)
+
+    def store(self, name, capabilities):
+        with self._lock:
+            data = self._read()
+            data["printers"].setdefault(name, {})[capabilities.getFirmwareName()] = capabilities.toDict()
+            self._write(data)
+
+    def forget(self, name):
+        with self._lock:
+            data = self._read()
+            if data["printers"].pop(name, None) is not None:
+                self._write(data)
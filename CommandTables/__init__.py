@@ -0,0 +1,166 @@
+'''
+Command tables of firmware flavors.
+
+A table maps the integer opcode of a command (GCodeLibrary.opcode()) to
+flags describing how the firmware treats it: whether it is acknowledged
+by "ok", whether it starts or ends writing to a file on the SD card, and
+which timeout class it belongs to. The send and receive loops look these
+up per line, so the tables are built once at import and are plain dicts.
+
+Commands which aren't listed are acknowledged by "ok" with the default
+timeout, which is what all supported firmwares do for unknown commands.
+Further flavors can be added with registerTable().
+'''
+
+from .. import GCodeLibrary
+
+FLAG_ACKS_OK = 0x1
+FLAG_ENTERS_FILE_WRITE = 0x2 # following lines go into a file, each answered by "ok"
+FLAG_LEAVES_FILE_WRITE = 0x4
+FLAG_BLOCKING = 0x8 # the firmware doesn't take commands until it is done
+
+FLAGS_FILE_WRITE = FLAG_ENTERS_FILE_WRITE | FLAG_LEAVES_FILE_WRITE
+
+# Timeout classes, stored above the flags
+TIMEOUT_SHIFT = 8
+TIMEOUT_DEFAULT = 0 # the device's send timeout
+TIMEOUT_LONG = 1 # eg. homing or probing
+TIMEOUT_UNLIMITED = 2 # eg. waiting for temperatures
+
+DEFAULT_TIMEOUTS = {TIMEOUT_DEFAULT: None,
+                    TIMEOUT_LONG: 600., # s
+                    TIMEOUT_UNLIMITED: -1,
+                    }
+
+def entry(acks_ok = True, enters_file_write = False, leaves_file_write = False, blocking = False, timeout = TIMEOUT_DEFAULT):
+    """Flags of a command as stored in a table."""
+    return ((FLAG_ACKS_OK if acks_ok else 0) |
+            (FLAG_ENTERS_FILE_WRITE if enters_file_write else 0) |
+            (FLAG_LEAVES_FILE_WRITE if leaves_file_write else 0) |
+            (FLAG_BLOCKING if blocking else 0) |
+            timeout << TIMEOUT_SHIFT)
+
+def commands(**entries):
+    """{opcode: flags} of keyword arguments like M109 = entry(...)."""
+    return {GCodeLibrary.opcode(name[0], int(name[1:])): flags for name, flags in entries.items()}
+
+class CommandTable():
+    def __init__(self, name, flavor, commands, sd_card_ok = (), sd_card_failed = (), firmware_names = (), timeouts = None):
+        self.name = name
+        self.flavor = flavor # GCodeLibrary.GCodeFlavors
+        self.commands = dict(commands)
+        self.default_flags = entry()
+        self.sd_card_ok = frozenset(sd_card_ok) # answers to M21
+        self.sd_card_failed = frozenset(sd_card_failed)
+        self.firmware_names = tuple(firmware_names) # beginnings of FIRMWARE_NAME in M115
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+
+    def derive(self, name, flavor, commands = None, **overrides):
+        """New table based on this one, with more or other commands and settings."""
+        table = CommandTable(name, flavor, self.commands,
+                             overrides.get("sd_card_ok", self.sd_card_ok),
+                             overrides.get("sd_card_failed", self.sd_card_failed),
+                             overrides.get("firmware_names", ()),
+                             overrides.get("timeouts", self.timeouts))
+        if commands:
+            table.commands.update(commands)
+        return table
+
+    ##  Hot path: flags of an opcode.
+    def flags(self, opcode):
+        return self.commands.get(opcode, self.default_flags)
+
+    def timeout(self, opcode, default = None):
+        """Timeout in s of a command, -1 for none; default for commands of the default class."""
+        value = self.timeouts[self.commands.get(opcode, self.default_flags) >> TIMEOUT_SHIFT]
+        if value is None:
+            return default
+        return value
+
+    def isSdCardOk(self, answer):
+        return answer in self.sd_card_ok
+
+    def isSdCardFailed(self, answer):
+        return answer in self.sd_card_failed
+
+_tables = {} # by GCodeLibrary.GCodeFlavors value
+
+def registerTable(table):
+    _tables[table.flavor] = table
+    return table
+
+def getTable(flavor):
+    return _tables.get(flavor)
+
+def getTables():
+    return list(_tables.values())
+
+def tableForFirmware(firmware_name):
+    """Table of the firmware reporting this FIRMWARE_NAME, None if it's unknown."""
+    for table in _tables.values():
+        for name in table.firmware_names:
+            if firmware_name.startswith(name):
+                return table
+    return None
+
+# Cura's machine_gcode_flavor, "RepRap (Marlin/Sprinter)" and "RepRap (Volumetric)" being Marlin
+CURA_FLAVORS = {"RepRap (Marlin/Sprinter)": GCodeLibrary.GCodeFlavors.Marlin,
+                "RepRap (Volumetric)": GCodeLibrary.GCodeFlavors.Marlin,
+                "Repetier": GCodeLibrary.GCodeFlavors.Repetier,
+                "RepRap (RepRap)": GCodeLibrary.GCodeFlavors.RepRapFirmware,
+                }
+
+def tableForCuraFlavor(machine_gcode_flavor):
+    return _tables.get(CURA_FLAVORS.get(machine_gcode_flavor))
+
+_WAIT_FOR_TEMPERATURE = entry(blocking = True, timeout = TIMEOUT_UNLIMITED)
+_LONG = entry(blocking = True, timeout = TIMEOUT_LONG)
+
+MARLIN = registerTable(CommandTable("Marlin", GCodeLibrary.GCodeFlavors.Marlin,
+                                    commands(G4 = _LONG,
+                                             G28 = _LONG,
+                                             G29 = _LONG, # bed leveling
+                                             G33 = _LONG, # delta calibration
+                                             M28 = entry(enters_file_write = True),
+                                             M29 = entry(leaves_file_write = True),
+                                             M109 = _WAIT_FOR_TEMPERATURE,
+                                             M190 = _WAIT_FOR_TEMPERATURE,
+                                             M191 = _WAIT_FOR_TEMPERATURE, # chamber
+                                             M303 = _WAIT_FOR_TEMPERATURE, # PID autotune
+                                             M400 = entry(blocking = True, timeout = TIMEOUT_UNLIMITED), # waits for all moves
+                                             M600 = entry(blocking = True, timeout = TIMEOUT_UNLIMITED), # filament change
+                                             M800 = _WAIT_FOR_TEMPERATURE,
+                                             ),
+                                    sd_card_ok = ("echo:SD card ok",),
+                                    sd_card_failed = ("echo:SD init fail", "Error:volume.init failed", "echo:No SD card"),
+                                    firmware_names = ("Marlin",),
+                                    ))
+
+REPETIER = registerTable(MARLIN.derive("Repetier", GCodeLibrary.GCodeFlavors.Repetier,
+                                       commands(M116 = _WAIT_FOR_TEMPERATURE, # waits for all heaters
+                                                ),
+                                       sd_card_ok = ("SD card ok", "SD card inserted"),
+                                       sd_card_failed = ("SD init fail", "SD card removed"),
+                                       firmware_names = ("Repetier",),
+                                       ))
+
+REPRAPFIRMWARE = registerTable(MARLIN.derive("RepRapFirmware", GCodeLibrary.GCodeFlavors.RepRapFirmware,
+                                             commands(G30 = _LONG, # probing
+                                                      G32 = _LONG, # bed leveling
+                                                      M116 = _WAIT_FOR_TEMPERATURE,
+                                                      ),
+                                             sd_card_ok = ("SD card mounted in slot 0",),
+                                             sd_card_failed = ("Error: Cannot initialise SD card 0",),
+                                             firmware_names = ("RepRapFirmware",),
+                                             ))
+
+SMOOTHIE = registerTable(MARLIN.derive("Smoothie", GCodeLibrary.GCodeFlavors.Smoothie,
+                                       commands(G30 = _LONG,
+                                                G32 = _LONG,
+                                                ),
+                                       sd_card_ok = ("SD card ok",),
+                                       sd_card_failed = (),
+                                       firmware_names = ("Smoothieware",),
+                                       ))
@@ -0,0 +1,467 @@
+'''
+Connections to the printer, independent of Qt.
+
+StreamConnection is the buffered line reader and writer every transport
+shares: lines are queued without copying, written with as few syscalls as
+possible and read in blocks. The transports only open, read, write and
+close:
+
+- TcpConnection: the WiFi serial bridge, a TCP socket (WifiConnectionFactory)
+- SocketPairConnection: one end of an in-process socketpair, the other end
+  is handed to a peer like Emulator.EmulatorServer.attach. Measures the
+  host without any network in between.
+- SerialConnection: a serial port or pty in raw mode, like USB links
+'''
+
+from ..Log import Logger
+
+import collections
+import itertools
+import os
+import select
+import socket
+import time
+
+from .. import GCodeLibrary
+
+# Buffers per sendmsg()/writev() call, the usual IOV_MAX
+IOV_MAX = 1024
+
+# Buffering protocol of bridges, see Bridge
+BRIDGE_BUFFER_PROPERTY = b"buffer" # Zeroconf TXT property: lines the bridge can buffer
+BRIDGE_BUFFER_ON = b"@buffer on"
+
+class StreamConnection():
+    connection = None # handle of the transport, None while not connected
+    metrics = None
+    trace = None
+    share = None # Bandwidth.LinkShare every write waits for
+
+    write_wait = 1. # s to wait for the transport to become writable per try
+    read_wait = 0.01 # s receiveLine() waits for data, keeps the receive loop from spinning
+    read_size = 65536 # bytes read at once at most
+
+    address = None
+
+    def __init__(self):
+        self.outgoing = collections.deque() # buffers not written yet, possibly partially
+        self.buffer = bytearray() # received data not returned as line yet
+        self.write_calls = 0
+        self.write_time = 0.
+
+    # Transports
+
+    def _open(self, address, port):
+        """Opens the transport and returns its handle."""
+        raise NotImplementedError()
+
+    def _close(self, connection):
+        raise NotImplementedError()
+
+    def _write(self, buffers):
+        """Writes some of the buffers, returns the number of bytes written."""
+        raise NotImplementedError()
+
+    def _read(self):
+        """Returns up to read_size bytes, b"" when closed by the other side."""
+        raise NotImplementedError()
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    # Shared by all transports
+
+    def isConnected(self):
+        return self.connection is not None
+
+    ##  Records every sent and received line to the given Trace.TraceRecorder (or None to stop).
+    def setTraceRecorder(self, recorder):
+        self.trace = recorder
+
+    ##  Options of the transport, only TCP has some.
+    def setSocketOptions(self, **options):
+        pass
+
+    def connect(self, address, port):
+        self.address = (address, port)
+        self.connection = self._open(address, port)
+        self.outgoing.clear()
+        del self.buffer[:]
+        if self.trace:
+            self.trace.recordEvent("connect %s:%s" %(address, port))
+        return self.connection
+
+    def disconnect(self):
+        if self.trace:
+            self.trace.recordEvent("disconnect")
+        if self.connection is not None:
+            self._close(self.connection)
+        self.connection = None
+        self.outgoing.clear()
+
+    ##  Connects again to the last address, raises OSError if that fails.
+    def reconnect(self):
+        if self.trace:
+            self.trace.recordEvent("reconnect")
+        self._lost()
+        return self.connect(*self.address)
+
+    def _lost(self):
+        connection = self.connection
+        self.connection = None
+        if connection is not None:
+            try:
+                self._close(connection)
+            except OSError:
+                pass
+
+    def _queue(self, data):
+        """Appends one line to the outgoing buffers without copying it."""
+        if type(data) is not bytes and type(data) is not memoryview:
+            encoded = getattr(data, "encoded", None)
+            data = encoded() if encoded else bytes(data)
+        size = len(data)
+        self.outgoing.append(data)
+        if data[-1:] != b"\n":
+            self.outgoing.append(b"\n")
+            size += 1
+        if self.trace:
+            self.trace.recordSent(bytes(data))
+        if self.metrics:
+            self.metrics.countSent(size)
+
+    def send(self, data):
+        #Logger.log("e", "Sending: %s", data)
+        self._queue(data)
+        return self.flush()
+
+    ##  Sends several lines with as few syscalls as possible.
+    def sendLines(self, lines):
+        for data in lines:
+            self._queue(data)
+        return self.flush()
+
+    ##  Writes all outgoing buffers, coping with partial writes and a full transport buffer.
+    def flush(self):
+        outgoing = self.outgoing
+        if not outgoing:
+            return True
+        started = time.thread_time()
+        calls = 0
+        try:
+            while outgoing:
+                if self.connection is None:
+                    raise ConnectionError("Not connected")
+                size = 0
+                if self.share is not None:
+                    size = sum(len(buffer) for buffer in itertools.islice(outgoing, IOV_MAX))
+                    self.share.acquire(size)
+                try:
+                    sent = self._write(outgoing)
+                    calls += 1
+                except (BlockingIOError, InterruptedError):
+                    if size:
+                        self.share.refund(size)
+                    select.select([], [self], [], self.write_wait)
+                    continue
+                if size > sent:
+                    self.share.refund(size - sent)
+                while sent:
+                    size = len(outgoing[0])
+                    if sent < size:
+                        outgoing[0] = memoryview(outgoing[0])[sent:]
+                        break
+                    outgoing.popleft()
+                    sent -= size
+            return True
+        except Exception:
+            Logger.logException("e", "An exception occured while sending data!")
+            self._lost()
+            outgoing.clear()
+            return False
+        finally:
+            cpu_time = time.thread_time() - started
+            self.write_calls += calls
+            self.write_time += cpu_time
+            if self.metrics:
+                self.metrics.countWrite(calls, cpu_time)
+
+    ##  Reads what has arrived into the buffer, waiting up to wait seconds for it.
+    #   Returns the number of bytes read, None if there was nothing or the connection is gone.
+    def receive(self, wait = 0.):
+        if self.connection is None:
+            return None
+        try:
+            if wait and not select.select([self], [], [], wait)[0]:
+                return None
+            data = self._read()
+            if not data:
+                # Closed by the other side
+                Logger.log("w", "Connection closed by the printer")
+                self._lost()
+                return None
+            self.buffer += data
+            return len(data)
+        except (BlockingIOError, InterruptedError):
+            return None
+        except Exception:
+            if self.connection is None:
+                # Closed by the send thread meanwhile
+                return None
+            Logger.logException("e", "An exception occured while receiving data!")
+            self._lost()
+            return None
+
+    def receiveLine(self):
+        position = self.buffer.find(b"\n")
+        if position == -1:
+            if not self.receive(self.read_wait):
+                return None
+            position = self.buffer.find(b"\n")
+            if position == -1:
+                return None
+        data = bytes(self.buffer[:position])
+        del self.buffer[:position + 1]
+        # Serial firmwares may end lines with "\r\n"
+        line = data.decode("utf-8", "replace").rstrip("\r")
+        if self.trace:
+            self.trace.recordReceived(line)
+        if self.metrics:
+            self.metrics.countReceived(position + 1)
+        return line
+
+class SocketConnection(StreamConnection):
+    """Reading and writing of the socket based transports."""
+    def _close(self, connection):
+        connection.close()
+
+    def _write(self, buffers):
+        if len(buffers) == 1:
+            return self.connection.send(buffers[0])
+        if hasattr(self.connection, "sendmsg"):
+            return self.connection.sendmsg(list(itertools.islice(buffers, IOV_MAX)))
+        # Windows, one copy instead of a syscall per buffer
+        return self.connection.send(b"".join(itertools.islice(buffers, IOV_MAX)))
+
+    def _read(self):
+        return self.connection.recv(self.read_size)
+
+class TcpConnection(SocketConnection):
+    # TCP options, applied on connect
+    nodelay = True
+    keepalive = True
+    keepalive_idle = 10 # s without traffic before probing
+    keepalive_interval = 5 # s between probes
+    keepalive_count = 3 # failed probes until the connection is dropped
+
+    connect_timeout = 5. # s
+
+    ##  Changes TCP options, None keeps the current value. Applied immediately when connected.
+    def setSocketOptions(self, nodelay = None, keepalive = None, keepalive_idle = None, keepalive_interval = None, keepalive_count = None):
+        for name, value in (("nodelay", nodelay),
+                            ("keepalive", keepalive),
+                            ("keepalive_idle", keepalive_idle),
+                            ("keepalive_interval", keepalive_interval),
+                            ("keepalive_count", keepalive_count),
+                            ):
+            if value is not None:
+                setattr(self, name, value)
+        if self.connection:
+            self._applySocketOptions()
+
+    def _applySocketOptions(self):
+        options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay)),
+                   (socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(self.keepalive)),
+                   ]
+        if self.keepalive:
+            # Not available everywhere, eg. TCP_KEEPIDLE is called TCP_KEEPALIVE on macOS
+            for name, value in (("TCP_KEEPIDLE", self.keepalive_idle),
+                                ("TCP_KEEPALIVE", self.keepalive_idle),
+                                ("TCP_KEEPINTVL", self.keepalive_interval),
+                                ("TCP_KEEPCNT", self.keepalive_count),
+                                ):
+                option = getattr(socket, name, None)
+                if option is not None:
+                    options.append((socket.IPPROTO_TCP, option, int(value)))
+        for level, option, value in options:
+            try:
+                self.connection.setsockopt(level, option, value)
+            except OSError:
+                Logger.log("w", "Could not set socket option %s to %s", option, value)
+
+    def _open(self, ip, port):
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connection.settimeout(self.connect_timeout)
+        try:
+            connection.connect((ip, port),)
+        except OSError:
+            connection.close()
+            raise
+        connection.setblocking(0)
+        self.connection = connection
+        self._applySocketOptions()
+        return connection
+
+# The plugin's name of the TCP connection
+WifiConnectionFactory = TcpConnection
+
+class SocketPairConnection(SocketConnection):
+    """In-process link: connect() hands the other end of a new socketpair to peer(socket)."""
+    def __init__(self, peer):
+        super().__init__()
+        self.peer = peer
+
+    def _open(self, address = None, port = None):
+        connection, other = socket.socketpair()
+        connection.setblocking(0)
+        self.peer(other)
+        return connection
+
+class SerialConnection(StreamConnection):
+    """Serial port or pty in raw mode, connect(device path, baud rate)."""
+    rtscts = False # hardware flow control
+
+    def fileno(self):
+        return self.connection
+
+    def _open(self, path, baudrate):
+        try:
+            import termios
+        except ImportError:
+            raise OSError("Serial ports need termios, which isn't available on this platform")
+        speed = getattr(termios, "B%d" %int(baudrate), None)
+        if speed is None:
+            raise OSError("Unsupported baud rate: %s" %baudrate)
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+            # Raw: no echo, no line editing, no translation of CR and LF
+            iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP | termios.INLCR |
+                       termios.IGNCR | termios.ICRNL | termios.IXON | termios.IXOFF | termios.IXANY)
+            oflag &= ~termios.OPOST
+            lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+            cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB)
+            cflag |= termios.CS8 | termios.CLOCAL | termios.CREAD
+            if hasattr(termios, "CRTSCTS"):
+                if self.rtscts:
+                    cflag |= termios.CRTSCTS
+                else:
+                    cflag &= ~termios.CRTSCTS
+            cc[termios.VMIN] = 1
+            cc[termios.VTIME] = 0
+            termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+            # Whatever the device said before isn't an answer to us
+            termios.tcflush(fd, termios.TCIFLUSH)
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def _close(self, connection):
+        os.close(connection)
+
+    def _write(self, buffers):
+        if len(buffers) == 1:
+            return os.write(self.connection, buffers[0])
+        return os.writev(self.connection, list(itertools.islice(buffers, IOV_MAX)))
+
+    def _read(self):
+        return os.read(self.connection, self.read_size)
+
+TRANSPORTS = {"tcp": TcpConnection,
+              "serial": SerialConnection,
+              }
+
+def createSocketPairConnector(peer):
+    """Returns a callable which can be used as StreamingEngine.serial_connector, see SocketPairConnection."""
+    return lambda: SocketPairConnection(peer)
+
+##  Tries to reconnect until it works, waiting twice as long after every failed attempt.
+#   Gives up after timeout seconds or as soon as keep_trying() returns False.
+def reconnectWithBackoff(connection, delay = 0.05, max_delay = 5., timeout = 120., keep_trying = lambda: True):
+    started = time.monotonic()
+    attempts = 0
+    while keep_trying():
+        attempts += 1
+        try:
+            connection.reconnect()
+            Logger.log("i", "Reconnected after %s attempt(s) and %.3fs", attempts, time.monotonic() - started)
+            return True
+        except OSError as error:
+            Logger.log("w", "Reconnect attempt %s failed: %s", attempts, error)
+        if time.monotonic() - started + delay > timeout:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+    return False
+
+def parseResend(line):
+    """Line number requested by "Resend: 12" or "rs 12", otherwise None."""
+    if line.startswith("Resend:"):
+        number = line[7:]
+    elif line.startswith("rs "):
+        number = line[3:]
+    else:
+        return None
+    try:
+        return int(number.strip().split()[0])
+    except (IndexError, ValueError):
+        return None
+
+def parseAdvancedOk(line):
+    """{"N": last line number, "P": free planner slots, "B": free command buffer slots} of an ADVANCED_OK "ok".
+
+    Returns None for a plain "ok" and other lines.
+    """
+    if not line.startswith("ok "):
+        return None
+    values = {}
+    for word in line[3:].split():
+        if word[:1] in ("N", "P", "B"):
+            try:
+                values[word[:1]] = int(word[1:])
+            except ValueError:
+                # Eg. the "B:" of a temperature report
+                return None
+    return values or None
+
+def parseBridgeMessage(line):
+    """(name, arguments) of a message of the bridge like "@ok 16", None for the lines of the printer."""
+    if not line.startswith("@"):
+        return None
+    words = line[1:].split()
+    if not words:
+        return None
+    return words[0], words[1:]
+
+class ResendBuffer():
+    """Numbers outgoing lines and keeps the latest ones for resend requests."""
+    def __init__(self, size = 1024):
+        self.lines = collections.deque(maxlen = size) # numbered data, lines[0] being line number first
+        self.first = 1
+        self.last = 0
+
+    ##  Starts over, the returned line makes the firmware expect number + 1 next.
+    def reset(self, number = 0):
+        self.lines.clear()
+        self.first = number + 1
+        self.last = number
+        return b"M110 N%d" %number
+
+    def number(self, data, data_checksum = None):
+        """Returns (line number, numbered line) for the data of a line."""
+        self.last += 1
+        numbered = GCodeLibrary.numberLine(self.last, data, data_checksum)
+        if len(self.lines) == self.lines.maxlen:
+            self.first += 1
+        self.lines.append(numbered)
+        return self.last, numbered
+
+    def has(self, number):
+        return self.first <= number <= self.last + 1
+
+    def linesFrom(self, number):
+        """Numbered lines from number on, None if they aren't kept anymore."""
+        if not self.has(number):
+            return None
+        return list(itertools.islice(self.lines, number - self.first, None))
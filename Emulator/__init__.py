@@ -0,0 +1,674 @@
+'''
+Local printer emulator for exercising the send path without hardware.
+
+FirmwareEmulator models a Marlin-like firmware: a planner buffer which
+executes moves in (scaled) real time, heaters, line numbers and checksums,
+SD card commands and busy messages during blocking commands.
+EmulatorServer exposes it on a local TCP port like a serial WiFi bridge
+and adds configurable answer latency, jitter, lost "ok"s and dropped
+connections. It also serves one end of a socketpair (attach) or a pty
+(openPty) for the other transports of Connection. A bandwidth (a
+Bandwidth.TokenBucket, which several servers may share like printers on
+one access point) limits how fast the host's data arrives.
+
+Binary transfer is a simplified framing, not Marlin's packet protocol:
+after "M28 B1 <file>" the host sends frames of a 4 byte big-endian length
+followed by the payload, each answered by "ok". An empty frame closes
+the file.
+'''
+
+import collections
+import heapq
+import math
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+FRAME_HEADER = struct.Struct(">I")
+
+class PlannerBuffer():
+    def __init__(self, size = 16, speed = 1.):
+        self.size = size
+        self.speed = speed
+        self.moves = collections.deque() # end times of queued moves
+        self.end = time.monotonic()
+
+    def _retire(self, now):
+        while self.moves and self.moves[0] <= now:
+            self.moves.popleft()
+
+    def add(self, duration):
+        """Queues a move, blocks while the buffer is full."""
+        if self.speed:
+            duration /= self.speed
+        else:
+            duration = 0.
+        now = time.monotonic()
+        self._retire(now)
+        while len(self.moves) >= self.size:
+            time.sleep(max(self.moves[0] - now, 0.))
+            now = time.monotonic()
+            self._retire(now)
+        self.end = max(self.end, now) + duration
+        self.moves.append(self.end)
+
+    def free(self):
+        self._retire(time.monotonic())
+        return self.size - len(self.moves)
+
+    def remaining(self):
+        return max(self.end - time.monotonic(), 0.)
+
+class Heater():
+    def __init__(self, ambient = 24., rate = 5.):
+        self.ambient = ambient
+        self.rate = rate # degrees per second
+        self.temperature = ambient
+        self.target = 0.
+        self.updated = time.monotonic()
+
+    def update(self, speed = 1.):
+        now = time.monotonic()
+        step = (now - self.updated) * self.rate * (speed or 1000.)
+        self.updated = now
+        goal = self.target if self.target else self.ambient
+        if self.temperature < goal:
+            self.temperature = min(self.temperature + step, goal)
+        else:
+            self.temperature = max(self.temperature - step, goal)
+        return self.temperature
+
+    def reached(self):
+        return abs(self.temperature - (self.target or self.ambient)) < 1.
+
+def checksum(data):
+    value = 0
+    for byte in data:
+        value ^= byte
+    return value
+
+def parseWords(line):
+    """'G1 X1 Y2.5' -> ('G1', {'X': 1., 'Y': 2.5})"""
+    words = line.split()
+    if not words:
+        return None, {}
+    code = words[0].upper()
+    values = {}
+    for word in words[1:]:
+        try:
+            values[word[0].upper()] = float(word[1:]) if len(word) > 1 else None
+        except ValueError:
+            values[word[0].upper()] = word[1:]
+    return code, values
+
+class FirmwareEmulator():
+    firmware_name = "Marlin 1.1.0 (Emulator)"
+    busy_interval = 2. # s, like Marlin's DEFAULT_KEEPALIVE_INTERVAL
+
+    def __init__(self, planner_size = 16, speed = 1., heat_rate = 5., homing_time = 3.,
+                 advanced_ok = False, binary_transfer = False, capabilities = None):
+        self.speed = speed
+        self.planner = PlannerBuffer(planner_size, speed)
+        self.hotend = Heater(rate = heat_rate)
+        self.bed = Heater(rate = heat_rate / 4.)
+        self.homing_time = homing_time
+        self.advanced_ok = advanced_ok
+        self.binary_transfer = binary_transfer
+        self.capabilities = {"AUTOREPORT_TEMP": 1,
+                             "ADVANCED_OK": int(advanced_ok),
+                             "BINARY_FILE_TRANSFER": int(binary_transfer),
+                             "EEPROM": 0,
+                             }
+        if capabilities:
+            self.capabilities.update(capabilities)
+
+        self.position = {"X": 0., "Y": 0., "Z": 0., "E": 0.}
+        self.feedrate = 1500.
+        self.absolute = True
+        self.absolute_extrusion = True
+        self.last_line_number = 0
+        self.lines_processed = 0
+        self.moves_processed = 0
+
+        # SD card
+        self.sd_files = {}
+        self.sd_ready = False
+        self.sd_write_file = None
+        self.sd_binary = False
+        self.sd_selected = None
+        self.sd_position = 0
+        self.sd_printing = False
+        self._sd_thread = None
+
+        self.autoreport_interval = 0
+        self._lock = threading.RLock()
+
+    # Helpers for answers: output(line) is set by the transport
+    output = staticmethod(lambda line: None)
+
+    def _ok(self):
+        if self.advanced_ok:
+            return "ok N%s P%s B%s" %(self.last_line_number, self.planner.free(), 4)
+        return "ok"
+
+    def _busyWait(self, done, limit = None):
+        started = last_busy = time.monotonic()
+        while not done():
+            now = time.monotonic()
+            if limit is not None and now - started >= limit:
+                return
+            if now - last_busy >= self.busy_interval:
+                self.output("echo:busy: processing")
+                last_busy = now
+            time.sleep(0.01)
+
+    def temperatureReport(self):
+        return "T:%.1f /%.1f B:%.1f /%.1f @:0 B@:0" %(self.hotend.update(self.speed), self.hotend.target,
+                                                       self.bed.update(self.speed), self.bed.target)
+
+    ##  Processes one received line and returns the answers, the final one being "ok" (if any)
+    def processLine(self, raw_line):
+        with self._lock:
+            return self._processLine(raw_line)
+
+    def _processLine(self, raw_line):
+        line = raw_line.split(";", 1)[0].strip()
+        command = line.partition(" ")[2] if line.startswith("N") else line
+        if self.sd_write_file is not None and not command.upper().startswith("M29"):
+            # Marlin writes the raw line (including line number and checksum) into the file
+            self.sd_files[self.sd_write_file] += raw_line.encode("utf-8") + b"\n"
+            if line.startswith("N"):
+                self.last_line_number = int(line.split()[0][1:])
+            return [self._ok()]
+        if not line:
+            return []
+
+        # Line number and checksum
+        if line.startswith("N"):
+            if "*" in line:
+                body, given = line.rsplit("*", 1)
+                body = body.strip()
+                try:
+                    given = int(given)
+                except ValueError:
+                    given = -1
+                if checksum(body.encode("utf-8")) != given:
+                    return ["Error:checksum mismatch, Last Line: %s" %self.last_line_number,
+                            "Resend: %s" %(self.last_line_number + 1),
+                            self._ok()]
+                line = body
+            number_word, _, line = line.partition(" ")
+            number = int(number_word[1:])
+            code, values = parseWords(line)
+            if code == "M110":
+                self.last_line_number = number
+                return [self._ok()]
+            if number != self.last_line_number + 1:
+                return ["Error:Line Number is not Last Line Number+1, Last Line: %s" %self.last_line_number,
+                        "Resend: %s" %(self.last_line_number + 1),
+                        self._ok()]
+            self.last_line_number = number
+        else:
+            code, values = parseWords(line)
+
+        self.lines_processed += 1
+        handler = getattr(self, "_do" + code, None) if code else None
+        if handler is None:
+            return ["echo:Unknown command: \"%s\"" %line, self._ok()]
+        answers = handler(values, line)
+        if answers is None:
+            answers = []
+        return answers + [self._ok()]
+
+    # Motion
+    def _move(self, values):
+        feedrate = values.get("F")
+        if feedrate:
+            self.feedrate = feedrate
+        distance = 0.
+        for axis in ("X", "Y", "Z"):
+            if axis in values and values[axis] is not None:
+                target = values[axis] if self.absolute else self.position[axis] + values[axis]
+                distance += (target - self.position[axis]) ** 2
+                self.position[axis] = target
+        distance = math.sqrt(distance)
+        if "E" in values and values["E"] is not None:
+            extrusion = values["E"] if self.absolute_extrusion else self.position["E"] + values["E"]
+            if not distance:
+                distance = abs(extrusion - self.position["E"])
+            self.position["E"] = extrusion
+        self.moves_processed += 1
+        if distance and self.feedrate:
+            self.planner.add(distance / (self.feedrate / 60.))
+
+    def _doG0(self, values, line):
+        self._move(values)
+
+    _doG1 = _doG0
+
+    def _doG4(self, values, line):
+        seconds = (values.get("P") or 0) / 1000. + (values.get("S") or 0)
+        if self.speed:
+            seconds /= self.speed
+        self._busyWait(lambda: not self.planner.remaining(), None)
+        end = time.monotonic() + seconds
+        self._busyWait(lambda: time.monotonic() >= end)
+
+    def _doG28(self, values, line):
+        self._busyWait(lambda: not self.planner.remaining())
+        end = time.monotonic() + (self.homing_time / self.speed if self.speed else 0.)
+        self._busyWait(lambda: time.monotonic() >= end)
+        for axis in ("X", "Y", "Z"):
+            if not values or axis in values:
+                self.position[axis] = 0.
+
+    def _doG90(self, values, line):
+        self.absolute = True
+        self.absolute_extrusion = True
+
+    def _doG91(self, values, line):
+        self.absolute = False
+        self.absolute_extrusion = False
+
+    def _doG92(self, values, line):
+        for axis in ("X", "Y", "Z", "E"):
+            if axis in values:
+                self.position[axis] = values[axis] or 0.
+
+    def _doM82(self, values, line):
+        self.absolute_extrusion = True
+
+    def _doM83(self, values, line):
+        self.absolute_extrusion = False
+
+    def _doM84(self, values, line):
+        pass
+
+    _doM18 = _doM84
+
+    def _doM400(self, values, line):
+        self._busyWait(lambda: not self.planner.remaining())
+
+    # Temperatures and fans
+    def _doM104(self, values, line):
+        self.hotend.update(self.speed)
+        self.hotend.target = values.get("S") or 0.
+
+    def _doM140(self, values, line):
+        self.bed.update(self.speed)
+        self.bed.target = values.get("S") or 0.
+
+    def _waitForHeater(self, heater):
+        last_report = time.monotonic()
+        def reached():
+            nonlocal last_report
+            heater.update(self.speed)
+            if time.monotonic() - last_report >= 1.:
+                last_report = time.monotonic()
+                self.output(self.temperatureReport())
+            return heater.reached()
+        self._busyWait(reached)
+
+    def _doM109(self, values, line):
+        self._doM104(values, line)
+        self._waitForHeater(self.hotend)
+
+    def _doM190(self, values, line):
+        self._doM140(values, line)
+        self._waitForHeater(self.bed)
+
+    def _doM105(self, values, line):
+        return [self.temperatureReport()]
+
+    def _doM155(self, values, line):
+        self.autoreport_interval = values.get("S") or 0
+
+    def _doM106(self, values, line):
+        pass
+
+    _doM107 = _doM106
+    _doM117 = _doM106
+
+    def _doM110(self, values, line):
+        if values.get("N") is not None:
+            self.last_line_number = int(values["N"])
+
+    def _doM115(self, values, line):
+        answers = ["FIRMWARE_NAME:%s SOURCE_CODE_URL:https://github.com/MarlinFirmware/Marlin PROTOCOL_VERSION:1.0 MACHINE_TYPE:Emulator EXTRUDER_COUNT:1" %self.firmware_name]
+        for name in sorted(self.capabilities.keys()):
+            answers.append("Cap:%s:%s" %(name, self.capabilities[name]))
+        return answers
+
+    # SD card
+    def _doM20(self, values, line):
+        answers = ["Begin file list"]
+        for name in sorted(self.sd_files.keys()):
+            answers.append("%s %s" %(name, len(self.sd_files[name])))
+        answers.append("End file list")
+        return answers
+
+    def _doM21(self, values, line):
+        self.sd_ready = True
+        return ["echo:SD card ok"]
+
+    def _doM22(self, values, line):
+        self.sd_ready = False
+        return ["echo:SD card released"]
+
+    def _fileName(self, line):
+        parts = line.split()[1:]
+        if parts and parts[0].upper() == "B1":
+            parts = parts[1:]
+        return " ".join(parts)
+
+    def _doM23(self, values, line):
+        name = self._fileName(line)
+        if not self.sd_ready or name not in self.sd_files:
+            return ["open failed, File: %s." %name]
+        self.sd_selected = name
+        self.sd_position = 0
+        return ["File opened: %s Size: %s" %(name, len(self.sd_files[name])), "File selected"]
+
+    def _doM24(self, values, line):
+        if self.sd_selected is None:
+            return []
+        self.sd_printing = True
+        if self._sd_thread is None or not self._sd_thread.is_alive():
+            self._sd_thread = threading.Thread(target = self._sdPrint, daemon = True)
+            self._sd_thread.start()
+
+    def _doM25(self, values, line):
+        self.sd_printing = False
+
+    def _doM26(self, values, line):
+        self.sd_position = int(values.get("S") or 0)
+
+    def _doM27(self, values, line):
+        if self.sd_printing and self.sd_selected in self.sd_files:
+            size = len(self.sd_files[self.sd_selected])
+            return ["SD printing byte %s/%s" %(min(self.sd_position, size), size)]
+        return ["Not SD printing"]
+
+    def _doM28(self, values, line):
+        name = self._fileName(line)
+        if not self.sd_ready:
+            return ["echo:SD init fail"]
+        self.sd_binary = self.binary_transfer and line.split()[1:2] == ["B1"]
+        self.sd_files[name] = bytearray()
+        self.sd_write_file = name
+        return ["Writing to file: %s" %name]
+
+    def _doM29(self, values, line):
+        self.sd_write_file = None
+        self.sd_binary = False
+        return ["Done saving file."]
+
+    def _doM30(self, values, line):
+        name = self._fileName(line)
+        if self.sd_files.pop(name, None) is None:
+            return ["Deletion failed, File: %s." %name]
+        return ["File deleted:%s" %name]
+
+    def writeBinary(self, payload):
+        """One frame of a binary transfer, an empty frame closes the file."""
+        with self._lock:
+            if not payload:
+                self.sd_write_file = None
+                self.sd_binary = False
+                return ["Done saving file.", "ok"]
+            self.sd_files[self.sd_write_file] += payload
+            return ["ok"]
+
+    def _sdPrint(self):
+        while self.sd_printing:
+            data = self.sd_files.get(self.sd_selected)
+            if data is None or self.sd_position >= len(data):
+                self.sd_printing = False
+                self.output("Done printing file")
+                return
+            end = data.find(b"\n", self.sd_position)
+            if end == -1:
+                end = len(data)
+            line = data[self.sd_position:end].decode("utf-8", "replace")
+            self.sd_position = end + 1
+            # Strip line numbers and checksums as the firmware does while reading from SD
+            line = line.split("*", 1)[0]
+            if line.startswith("N"):
+                line = line.partition(" ")[2]
+            with self._lock:
+                code, values = parseWords(line.split(";", 1)[0])
+                handler = getattr(self, "_do" + code, None) if code else None
+                if handler is not None and code not in ("M24", "M28", "M29"):
+                    handler(values, line)
+
+class EmulatorSession():
+    """Serves one host connection: reads lines and writes delayed answers."""
+    def __init__(self, server, connection):
+        self.server = server
+        self.connection = connection
+        self.alive = True
+        self._answers = []
+        self._answers_due = 0.
+        self._answers_sequence = 0
+        self._answers_condition = threading.Condition()
+
+    def output(self, line):
+        server = self.server
+        if server.loss and line.startswith("ok") and random.random() < server.loss:
+            return
+        delay = server.latency
+        if server.jitter:
+            delay = max(0., delay + random.gauss(0., server.jitter))
+        with self._answers_condition:
+            # Answers never overtake each other
+            self._answers_due = max(self._answers_due, time.monotonic() + delay)
+            self._answers_sequence += 1
+            heapq.heappush(self._answers, (self._answers_due, self._answers_sequence, (line + "\n").encode("utf-8")))
+            self._answers_condition.notify()
+
+    def _writer(self):
+        while self.alive:
+            with self._answers_condition:
+                if not self._answers:
+                    self._answers_condition.wait(0.1)
+                    continue
+                due = self._answers[0][0]
+                now = time.monotonic()
+                if due > now:
+                    self._answers_condition.wait(due - now)
+                    continue
+                data = b""
+                while self._answers and self._answers[0][0] <= now:
+                    data += heapq.heappop(self._answers)[2]
+            try:
+                self.connection.sendall(data)
+            except OSError:
+                self.alive = False
+
+    def _autoreporter(self, firmware):
+        last = time.monotonic()
+        while self.alive:
+            time.sleep(0.1)
+            interval = firmware.autoreport_interval
+            if interval and time.monotonic() - last >= interval:
+                last = time.monotonic()
+                self.output(firmware.temperatureReport())
+
+    def _recv(self):
+        bandwidth = self.server.bandwidth
+        if bandwidth is None:
+            return self.connection.recv(65536)
+        # Small reads, the link is shared in turns
+        data = self.connection.recv(1024)
+        bandwidth.take(len(data))
+        return data
+
+    def serve(self):
+        firmware = self.server.firmware
+        firmware.output = self.output
+        writer = threading.Thread(target = self._writer, daemon = True)
+        writer.start()
+        threading.Thread(target = self._autoreporter, args = (firmware,), daemon = True).start()
+        buffer = b""
+        try:
+            while self.alive:
+                if firmware.sd_binary:
+                    if len(buffer) < FRAME_HEADER.size:
+                        data = self._recv()
+                        if not data:
+                            break
+                        buffer += data
+                        continue
+                    size = FRAME_HEADER.unpack_from(buffer)[0]
+                    if len(buffer) < FRAME_HEADER.size + size:
+                        data = self._recv()
+                        if not data:
+                            break
+                        buffer += data
+                        continue
+                    payload = buffer[FRAME_HEADER.size:FRAME_HEADER.size + size]
+                    buffer = buffer[FRAME_HEADER.size + size:]
+                    for answer in firmware.writeBinary(payload):
+                        self.output(answer)
+                    continue
+                position = buffer.find(b"\n")
+                if position == -1:
+                    data = self._recv()
+                    if not data:
+                        break
+                    buffer += data
+                    continue
+                line = buffer[:position].decode("utf-8", "replace").rstrip("\r")
+                buffer = buffer[position + 1:]
+                for answer in firmware.processLine(line):
+                    self.output(answer)
+                if self.server.drop and random.random() < self.server.drop:
+                    # Like a WiFi drop: the firmware carries on, unsent answers are lost
+                    self.server.drops += 1
+                    break
+        except OSError:
+            pass
+        finally:
+            self.alive = False
+            writer.join(1.)
+            try:
+                self.connection.close()
+            except OSError:
+                pass
+
+class PtyEndpoint():
+    """The master side of a pty with the socket methods EmulatorSession uses."""
+    def __init__(self, master):
+        self.master = master
+
+    def recv(self, size):
+        try:
+            return os.read(self.master, size)
+        except OSError:
+            # EIO once the pty is gone
+            return b""
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def shutdown(self, how):
+        self.close()
+
+    def close(self):
+        master, self.master = self.master, -1
+        if master >= 0:
+            os.close(master)
+
+class EmulatorServer():
+    def __init__(self, host = "127.0.0.1", port = 0, latency = 0., jitter = 0., loss = 0., drop = 0., firmware = None,
+                 bandwidth = None, **firmware_options):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.drop = drop # probability to drop the connection after a line
+        self.drops = 0
+        self.bandwidth = bandwidth # Bandwidth.TokenBucket of the link, None is unlimited
+        self.firmware = firmware if firmware is not None else FirmwareEmulator(**firmware_options)
+        self.session = None
+        self._socket = None
+        self._thread = None
+        self._pty_slave = None
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(1)
+        self.port = self._socket.getsockname()[1]
+        self._thread = threading.Thread(target = self._accept, daemon = True)
+        self._thread.start()
+        return self
+
+    def _accept(self):
+        while self._socket is not None:
+            try:
+                connection, address = self._socket.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Like a serial bridge: only the newest host is served
+            if self.session is not None:
+                self.session.alive = False
+            self.attach(connection)
+
+    ##  Serves an already connected socket, eg. one end of a socketpair
+    def attach(self, connection):
+        self.session = EmulatorSession(self, connection)
+        thread = threading.Thread(target = self.session.serve, daemon = True)
+        thread.start()
+        return self.session
+
+    ##  Serves a new pty, returns the path of its device for Connection.SerialConnection.
+    def openPty(self):
+        import tty
+        master, slave = os.openpty()
+        # Kept open, the master would fail with EIO whenever the host closes the device
+        tty.setraw(slave)
+        if self._pty_slave is not None:
+            os.close(self._pty_slave)
+        self._pty_slave = slave
+        if self.session is not None:
+            self.session.alive = False
+        self.attach(PtyEndpoint(master))
+        return os.ttyname(slave)
+
+    ##  Closes the current host connection, the firmware keeps its state.
+    def dropConnection(self):
+        session = self.session
+        if session is not None:
+            session.alive = False
+            self.drops += 1
+            try:
+                session.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        if self.session is not None:
+            self.session.alive = False
+        if self._socket is not None:
+            sock = self._socket
+            self._socket = None
+            sock.close()
+        if self._pty_slave is not None:
+            os.close(self._pty_slave)
+            self._pty_slave = None
+        self.firmware.sd_printing = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
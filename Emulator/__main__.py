@@ -0,0 +1,29 @@
+import argparse
+import time
+
+from .. import Emulator
+
+parser = argparse.ArgumentParser(description = "Marlin-like printer emulator listening on a local TCP port.")
+parser.add_argument("--host", default = "127.0.0.1")
+parser.add_argument("--port", type = int, default = 2323)
+parser.add_argument("--latency", type = float, default = 0., help = "delay of every answer in s")
+parser.add_argument("--jitter", type = float, default = 0., help = "standard deviation of the delay in s")
+parser.add_argument("--loss", type = float, default = 0., help = "probability of losing an 'ok'")
+parser.add_argument("--drop", type = float, default = 0., help = "probability of dropping the connection after a line")
+parser.add_argument("--speed", type = float, default = 1., help = "motion speed-up, 0 executes moves instantly")
+parser.add_argument("--planner-size", type = int, default = 16)
+parser.add_argument("--advanced-ok", action = "store_true")
+parser.add_argument("--binary", action = "store_true", help = "support binary SD transfer")
+arguments = parser.parse_args()
+
+server = Emulator.EmulatorServer(arguments.host, arguments.port,
+                                 latency = arguments.latency, jitter = arguments.jitter, loss = arguments.loss, drop = arguments.drop,
+                                 planner_size = arguments.planner_size, speed = arguments.speed,
+                                 advanced_ok = arguments.advanced_ok, binary_transfer = arguments.binary)
+server.start()
+print("Emulating printer on %s:%s" %(server.host, server.port))
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    server.stop()
@@ -94,6 +94,7 @@ class CodeCommand(object):
         if self.command_family is None:
             raise ValueError("command_family not set!")
         self.command_class = int(self.__class__.__name__[1:])
+        self._opcode = opcode(self.command_family, self.command_class)
         
         self.finished = False
         self.timedOut = False
@@ -118,6 +119,10 @@ class CodeCommand(object):
         
         return
     
+    def opcode(self):
+        """Integer of letter and number, the key of CommandTables."""
+        return self._opcode
+
     def isOkCommand(self, mode = None):
         if self.okCommand is None:
             raise NotImplementedError("Not implemented!")
@@ -171,7 +176,7 @@ class CodeCommand(object):
             self.options = options
             
     def parseAnswer(self, answer):
-        if self.isOkCommand() and answer == "ok":
+        if self.isOkCommand() and isOk(answer):
             self.finished = True
     
     def hasFinished(self):
@@ -274,6 +279,9 @@ class CodeCommand(object):
 
     def __str__(self):
         return str(self.line())
+
+    def encoded(self):
+        return bytes(self)
     
     def __bytes__(self):
         return bytes(self.__str__().encode(encoding='utf_8'))
@@ -326,7 +334,18 @@ class GCodeCommands():
         pass
     
     class G28(GCodeOkCommand):
-        pass
+        supportedOptions = [GCodeOptions.X_Axis,
+                            GCodeOptions.Y_Axis,
+                            GCodeOptions.Z_Axis,
+                            ]
+
+    class G90(GCodeOkCommand):
+        "Absolute positioning"
+        supportedOptions = []
+
+    class G91(GCodeOkCommand):
+        "Relative positioning"
+        supportedOptions = []
     
     class G92(GCodeOkCommand):
         supportedOptions = [GCodeOptions.X_Axis,
@@ -419,7 +438,27 @@ class RepRapCommands():
         "Status of SD printing"
         
         "Not SD printing" # Answer 
+        "SD printing byte 123/4567" # Answer
         supportedOptions = []
+        sd_printing = None
+        sd_position = None
+
+        def parseAnswer(self, answer):
+            super().parseAnswer(answer)
+
+            if answer.startswith("SD printing byte"):
+                position, size = answer.split()[-1].split("/")
+                self.sd_printing = True
+                self.sd_position = (int(position), int(size))
+            elif answer == "Not SD printing":
+                self.sd_printing = False
+
+        def isSDPrinting(self):
+            return self.sd_printing
+
+        def getSDPosition(self):
+            """(byte offset, file size) of the running SD print"""
+            return self.sd_position
     
     class M28(RepRapOkCommand):
         "Begin write to SD card"
@@ -471,6 +510,14 @@ class RepRapCommands():
         "Select file and start SD print"
         supportedOptions = []
 
+    class M82(RepRapOkCommand):
+        "Absolute extrusion"
+        supportedOptions = []
+
+    class M83(RepRapOkCommand):
+        "Relative extrusion"
+        supportedOptions = []
+
     class M104(RepRapOkCommand):
         supportedOptions = [GCodeOptions.LETTER_S]
         
@@ -497,6 +544,41 @@ class RepRapCommands():
             self.options[GCodeOptions.LETTER_S] = 50
             return super().setDryRun(mode)
     
+    class M115(RepRapOkCommand):
+        "Firmware info and capabilities"
+
+        "FIRMWARE_NAME:Marlin 2.0.9 (Github) SOURCE_CODE_URL:... PROTOCOL_VERSION:1.0 MACHINE_TYPE:... EXTRUDER_COUNT:1" # Answer
+        "Cap:ADVANCED_OK:1" # Answer, one per capability
+        supportedOptions = []
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.firmware_info = {}
+            self.capabilities = {}
+
+        def parseAnswer(self, answer):
+            super().parseAnswer(answer)
+
+            if answer.startswith("FIRMWARE_NAME:"):
+                self.firmware_info = parseFirmwareInfo(answer)
+            elif answer.startswith("Cap:"):
+                name, _, value = answer[4:].partition(":")
+                try:
+                    self.capabilities[name.strip()] = int(value)
+                except ValueError:
+                    self.capabilities[name.strip()] = value.strip()
+
+        def reset(self):
+            super().reset()
+            self.firmware_info = {}
+            self.capabilities = {}
+
+        def getFirmwareInfo(self):
+            return self.firmware_info
+
+        def getCapabilities(self):
+            return self.capabilities
+
     class M117(RepRapOkCommand):
         supportedOptions = str()
         
@@ -514,6 +596,15 @@ class RepRapCommands():
             self.options[GCodeOptions.LETTER_S] = 50
             return super().setDryRun(mode)
 
+    class M190(RepRapOkCommand):
+        "Wait for bed temperature"
+        supportedOptions = [GCodeOptions.LETTER_S]
+        recommendedTimeOut = -1
+
+        def setDryRun(self, mode):
+            self.options[GCodeOptions.LETTER_S] = 50
+            return super().setDryRun(mode)
+
     class M800(RepRapOkCommand):
         supportedOptions = []
         recommendedTimeOut = -1
@@ -521,6 +612,163 @@ class RepRapCommands():
     class M801(RepRapOkCommand):
         supportedOptions = []
 
+class RawLine(object):
+    """A line which is sent as it is, eg. a memoryview into a memory-mapped file.
+
+    It is only decoded if needed: dry run is applied on bytes level with
+    the same rules as CodeCommand, which copies the line. Without dry run
+    the data goes straight out.
+    """
+    __slots__ = ("data", "okCommand", "dryRun", "finished", "timedOut", "_command", "_opcode")
+
+    blockingCommands = (b"M109", b"M190", b"M800")
+    dryRunTemperatureCommands = (b"M104", b"M109", b"M140", b"M190")
+
+    def __init__(self, data):
+        self.data = data
+        self.okCommand = True
+        self.dryRun = False
+        self.finished = False
+        self.timedOut = False
+        self._command = None
+        self._opcode = None
+
+    def command(self):
+        """First word of the line as bytes, eg. b"G1"."""
+        if self._command is None:
+            head = bytes(self.data[:8]).split(None, 1)
+            self._command = head[0].upper() if head else b""
+        return self._command
+
+    def opcode(self):
+        if self._opcode is None:
+            self._opcode = parseOpcode(self.command())
+        return self._opcode
+
+    @property
+    def recommendedTimeOut(self):
+        if self.command() in self.blockingCommands:
+            return -1
+        return None
+
+    def isOkCommand(self, mode = None):
+        if not mode is None:
+            self.okCommand = mode
+        return self.okCommand
+
+    def parseAnswer(self, answer):
+        if self.okCommand and isOk(answer):
+            self.finished = True
+
+    def hasFinished(self):
+        if not self.okCommand:
+            return True
+        return self.finished
+
+    def hasTimedOut(self, state = None):
+        if not state is None:
+            self.timedOut = state
+        return self.timedOut
+
+    def reset(self):
+        self.finished = False
+        self.timedOut = False
+
+    def setDryRun(self, mode):
+        self.dryRun = mode
+
+    def getDryRun(self):
+        return self.dryRun
+
+    def line(self):
+        return bytes(self).decode("utf-8")
+
+    def encoded(self):
+        """Data to send, copied only with dry run on."""
+        if not self.dryRun:
+            return self.data
+        return bytes(self)
+
+    def __str__(self):
+        return self.line()
+
+    def __bytes__(self):
+        if not self.dryRun:
+            return bytes(self.data)
+        return applyDryRun(self.data)
+
+class EncodedLine(RawLine):
+    """A line prepared by Preprocess: its transforms are applied and its checksum is known."""
+    __slots__ = ("body_checksum",)
+
+    def __init__(self, data, body_checksum = None):
+        RawLine.__init__(self, data)
+        self.body_checksum = body_checksum
+
+    def setDryRun(self, mode):
+        # Decided while preprocessing
+        pass
+
+def opcode(letter, number):
+    """ord(letter) << 16 | number, eg. for "G1" or "M104"."""
+    return ord(letter) << 16 | number
+
+def parseOpcode(command):
+    """Opcode of a command word as bytes (eg. b"M104"), 0 if it isn't one."""
+    try:
+        return command[0] << 16 | int(command[1:])
+    except (IndexError, ValueError):
+        return 0
+
+def isOk(answer):
+    """"ok" alone or followed by values, eg. "ok N12 P15 B3" (ADVANCED_OK) or "ok T:210.0 /210.0"."""
+    return answer == "ok" or answer.startswith("ok ")
+
+def parseFirmwareInfo(line):
+    """{"FIRMWARE_NAME": "Marlin 2.0.9 (Github)", ...} of the first M115 answer, values may contain spaces."""
+    info = {}
+    key = None
+    for word in line.split(" "):
+        head, separator, tail = word.partition(":")
+        if separator and head and head.replace("_", "").isalnum() and head.isupper():
+            key = head
+            info[key] = tail
+        elif key is not None:
+            info[key] += " " + word
+    return info
+
+def applyDryRun(data):
+    """Line as bytes without extrusion and with temperatures set to 50, like CodeCommand's dry run."""
+    words = bytes(data).split()
+    if not words:
+        return b""
+    if words[0].upper() in RawLine.dryRunTemperatureCommands:
+        words = [words[0]] + [b"S50" if word[:1] in (b"S", b"s") else word for word in words[1:]]
+    else:
+        words = [word for word in words if word[:1] not in (b"E", b"e")]
+    return b" ".join(words)
+
+def checksum(data):
+    """XOR of all bytes of a line, the value expected behind "*" by the firmware."""
+    # Folding halves of one big integer is much cheaper than a loop over the bytes
+    value = int.from_bytes(data, "little")
+    width = len(data) * 8
+    while width > 8:
+        width = (width + 15) // 16 * 8
+        value = (value ^ (value >> width)) & ((1 << width) - 1)
+    return value
+
+def numberLine(number, data, data_checksum = None):
+    """b"N<number> <data>*<checksum>" of a line given as bytes-like object.
+
+    With the checksum of data already known only the prefix is added to it.
+    """
+    prefix = b"N%d " %number
+    if data_checksum is None:
+        line = prefix + data
+        return b"%s*%d" %(line, checksum(line))
+    return b"%s%s*%d" %(prefix, data, checksum(prefix) ^ data_checksum)
+
 def identifyLine(line):
     line = line.split()
     if not line:
@@ -538,7 +786,11 @@ def identifyLine(line):
         return None
 
 if __name__ == "__main__":
-    test_gcode = open("/home/thopiekar/Desktop/BH2_Origami_2.gcode").read()
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: %s <file.gcode>" %sys.argv[0])
+        sys.exit(1)
+    test_gcode = open(sys.argv[1]).read()
     test_gcode = test_gcode.split("\n")
     for line in test_gcode:
         print(repr(line))
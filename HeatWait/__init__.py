@@ -0,0 +1,118 @@
+'''
+Waits for temperatures on the host instead of in the firmware.
+
+M109, M190 and M191 keep the firmware busy until the heater reached its
+target. Sent as they are, the send loop can't get anything through to the
+printer for minutes: no status query, no injected command, no cancel. With
+host waits the engine sends the non-blocking M104, M140 or M141 instead,
+holds the job's following lines back and releases them as soon as the
+temperature reports say the target is reached. Reports are the answers to
+M105, which the engine asks for while waiting, or the firmware's own
+autoreports (M155).
+
+Like in Marlin, "S" waits only while heating up and "R" also while
+cooling down.
+'''
+
+import re
+import time
+
+TOLERANCE = 1. # degrees, like Marlin's TEMP_WINDOW
+MIN_POLL_INTERVAL = 0.05 # s, reports are asked for more often close to the target
+
+# Blocking command: (non-blocking command setting the same target, heater in the reports)
+WAITS = {b"M109": (b"M104", "T"),
+         b"M190": (b"M140", "B"),
+         b"M191": (b"M141", "C"),
+         }
+
+# eg. "T:209.8 /210.0", "B:60.1 /60.0" or "T1:24.0 /0.0"
+_REPORT = re.compile(r"(?:^|\s)([TBC]\d*):\s*(-?\d+(?:\.\d*)?)\s*/\s*(-?\d+(?:\.\d*)?)")
+
+def parseTemperatures(line):
+    """{heater: (current, target)} of a temperature report like "ok T:209.8 /210.0 B:60.0 /60.0 @:0 B@:0"."""
+    if not ":" in line:
+        return {}
+    return {heater: (float(current), float(target)) for heater, current, target in _REPORT.findall(line)}
+
+def rewrite(command, tolerance = TOLERANCE, residency = 0.):
+    """(data of the non-blocking command, HeatWait) replacing a blocking heat wait, None for any other command."""
+    words = bytes(command).split(b";", 1)[0].split()
+    if not words or not words[0].upper() in WAITS:
+        return None
+    replacement, heater = WAITS[words[0].upper()]
+    target = None
+    cooling = False
+    for word in words[1:]:
+        letter = word[:1].upper()
+        try:
+            if letter in (b"S", b"R"):
+                target = float(word[1:])
+                cooling = letter == b"R"
+            elif letter == b"T" and heater == "T":
+                # Another tool, eg. "M109 T1 S210"
+                heater = "T%d" %int(word[1:])
+        except ValueError:
+            return None
+    return b" ".join([replacement] + words[1:]), HeatWait(command, heater, target, cooling, tolerance, residency)
+
+class HeatWait():
+    """Wait of a rewritten command until heater reached target (None: the target the reports give)."""
+    def __init__(self, command, heater, target = None, cooling = False, tolerance = TOLERANCE, residency = 0.):
+        self.command = command # the original command, sent as it is if there are no reports
+        self.heater = heater
+        self.target = target
+        self.cooling = cooling
+        self.tolerance = tolerance
+        self.residency = residency # s the temperature has to stay there, like Marlin's TEMP_RESIDENCY_TIME
+        self.position = None # job position of the command, acknowledged when the wait is over
+        self.started = time.monotonic()
+        self.reported_at = None # monotonic time of the last report of the heater
+        self.temperature = None
+        self.rate = None # degrees/s between the last reports
+        self._reached_at = None
+
+    def update(self, temperatures, now = None):
+        """Takes the parsed report of parseTemperatures(), returns True once the wait is over."""
+        report = temperatures.get(self.heater)
+        if report is None and self.heater[1:]:
+            # Single extruders only report "T"
+            report = temperatures.get(self.heater[0])
+        if report is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        temperature, reported_target = report
+        if self.reported_at is not None and now > self.reported_at:
+            self.rate = (temperature - self.temperature) / (now - self.reported_at)
+        self.reported_at = now
+        self.temperature = temperature
+        target = self.target if self.target is not None else reported_target
+        if self.cooling:
+            reached = abs(self.temperature - target) <= self.tolerance
+        else:
+            # Turned off or cooler than the current temperature doesn't wait
+            reached = not target or self.temperature >= target - self.tolerance
+        if not reached:
+            self._reached_at = None
+            return False
+        if self._reached_at is None:
+            self._reached_at = now
+        return now - self._reached_at >= self.residency
+
+    def pollInterval(self, interval):
+        """s until the next report should be asked for, at most interval: shorter when the target is about to be reached."""
+        if self.rate is None or self.target is None:
+            return interval
+        remaining = self.target - self.tolerance - self.temperature
+        if self.cooling and remaining < 0.:
+            remaining = self.temperature - self.target - self.tolerance
+            rate = -self.rate
+        else:
+            rate = self.rate
+        if rate <= 0.:
+            return interval
+        return min(interval, max(remaining / rate, MIN_POLL_INTERVAL))
+
+    def getElapsed(self):
+        return time.monotonic() - self.started
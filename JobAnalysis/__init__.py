@@ -0,0 +1,311 @@
+'''
+Offline analysis of G-code jobs based on NumPy arrays.
+
+extractMoves() does the only per-line Python pass: it splits the lines into
+words and fills preallocated arrays. Everything after that, like absolute
+positions, move lengths and durations, is computed vectorized.
+'''
+
+import numpy
+
+# Defaults close to Marlin's configuration
+DEFAULT_ACCELERATION = 1000. # mm/s^2
+DEFAULT_JERK = 10. # mm/s
+DEFAULT_FEEDRATE = 1500. # mm/min
+DEFAULT_HOMING_TIME = 10. # s
+DEFAULT_HEATING_RATE = 2. # degrees/s
+DEFAULT_BED_HEATING_RATE = 0.5 # degrees/s
+AMBIENT_TEMPERATURE = 20.
+
+# Line kinds
+KIND_OTHER = 0
+KIND_MOVE = 1
+KIND_SET_POSITION = 2
+
+AXES = ("X", "Y", "Z", "E")
+
+class Moves():
+    """Per-line arrays of a job, all of the same length as the given lines."""
+    def __init__(self, count, state = None):
+        self.count = count
+        self.state = state if state is not None else MachineState()
+        self.kind = numpy.zeros(count, numpy.uint8)
+        self.opcode = numpy.zeros(count, numpy.int32) # ord(letter) << 16 | number, 0 for comments
+        self.values = {axis: numpy.full(count, numpy.nan) for axis in AXES}
+        self.relative = {axis: numpy.zeros(count, numpy.bool_) for axis in AXES}
+        self.feedrate = numpy.full(count, numpy.nan)
+        self.fixed_duration = numpy.zeros(count) # dwell, homing and heating
+        self.temperature = numpy.full(count, numpy.nan) # hotend target set on this line
+        self.bed_temperature = numpy.full(count, numpy.nan)
+        self.lengths = numpy.zeros(count, numpy.int64) # bytes including the line break
+        self._positions = None
+
+    def positions(self):
+        """Absolute X, Y, Z and E after every line."""
+        if self._positions is None:
+            self._positions = {axis: _accumulate(self.values[axis], self.relative[axis], self.kind, self.state.position[axis]) for axis in AXES}
+        return self._positions
+
+    def moveMask(self):
+        return self.kind == KIND_MOVE
+
+class MachineState():
+    """State carried from one chunk of lines to the next."""
+    def __init__(self):
+        self.position = {axis: 0. for axis in AXES}
+        self.feedrate = DEFAULT_FEEDRATE
+        self.relative_axes = False
+        self.relative_extrusion = False
+        self.hotend = AMBIENT_TEMPERATURE
+        self.bed = AMBIENT_TEMPERATURE
+
+    def copy(self):
+        state = MachineState()
+        state.__dict__.update(self.__dict__)
+        state.position = dict(self.position)
+        return state
+
+def opcode(letter, number):
+    return ord(letter) << 16 | number
+
+def _accumulate(values, relative, kind, initial = 0.):
+    """Absolute positions from absolute values, relative deltas and resets."""
+    count = len(values)
+    given = ~numpy.isnan(values)
+    is_delta = given & relative & (kind == KIND_MOVE)
+    is_reset = given & ~is_delta
+    deltas = numpy.where(is_delta, values, 0.)
+    summed = numpy.cumsum(deltas)
+
+    index = numpy.arange(count)
+    last_reset = numpy.maximum.accumulate(numpy.where(is_reset, index, -1))
+    has_reset = last_reset >= 0
+    safe_reset = numpy.where(has_reset, last_reset, 0)
+    base = numpy.where(has_reset, values[safe_reset], initial)
+    base_sum = numpy.where(has_reset, summed[safe_reset], 0.)
+    return base + summed - base_sum
+
+def extractMoves(lines, state = None):
+    """Arrays of the given lines; state is the machine state in front of them."""
+    state = state.copy() if state is not None else MachineState()
+    moves = Moves(len(lines), state.copy())
+    values = moves.values
+    relative_axes = state.relative_axes
+    relative_extrusion = state.relative_extrusion
+    hotend = state.hotend
+    bed = state.bed
+    for index, line in enumerate(lines):
+        if line is None:
+            continue
+        if type(line) is not str:
+            line = bytes(line).decode("utf-8", "replace")
+        moves.lengths[index] = len(line) + 1
+        words = line.split(";", 1)[0].split()
+        if words and words[0][0] == "N":
+            words = words[1:]
+        if not words:
+            continue
+        command = words[0]
+        letter = command[0].upper()
+        try:
+            number = int(command[1:])
+        except ValueError:
+            continue
+        moves.opcode[index] = opcode(letter, number)
+        if letter == "G":
+            if number in (0, 1, 92):
+                moves.kind[index] = KIND_MOVE if number != 92 else KIND_SET_POSITION
+                for word in words[1:]:
+                    axis = word[0].upper()
+                    try:
+                        value = float(word[1:])
+                    except ValueError:
+                        continue
+                    if axis in values:
+                        values[axis][index] = value
+                        if number != 92:
+                            moves.relative[axis][index] = relative_extrusion if axis == "E" else relative_axes
+                    elif axis == "F" and number != 92:
+                        moves.feedrate[index] = value
+            elif number == 4:
+                for word in words[1:]:
+                    try:
+                        if word[0] in "Pp":
+                            moves.fixed_duration[index] += float(word[1:]) / 1000.
+                        elif word[0] in "Ss":
+                            moves.fixed_duration[index] += float(word[1:])
+                    except ValueError:
+                        pass
+            elif number == 28:
+                moves.fixed_duration[index] = DEFAULT_HOMING_TIME
+                moves.kind[index] = KIND_SET_POSITION
+                homed = [word[0].upper() for word in words[1:]] or ["X", "Y", "Z"]
+                for axis in homed:
+                    if axis in ("X", "Y", "Z"):
+                        values[axis][index] = 0.
+            elif number == 90:
+                relative_axes = relative_extrusion = False
+            elif number == 91:
+                relative_axes = relative_extrusion = True
+        elif letter == "M":
+            if number == 82:
+                relative_extrusion = False
+            elif number == 83:
+                relative_extrusion = True
+            elif number in (104, 109, 140, 190):
+                target = None
+                for word in words[1:]:
+                    if word[0] in "SsRr":
+                        try:
+                            target = float(word[1:])
+                        except ValueError:
+                            pass
+                if target is None:
+                    continue
+                if number in (104, 109):
+                    moves.temperature[index] = target
+                    if number == 109:
+                        moves.fixed_duration[index] = abs(target - hotend) / DEFAULT_HEATING_RATE
+                    hotend = target
+                else:
+                    moves.bed_temperature[index] = target
+                    if number == 190:
+                        moves.fixed_duration[index] = abs(target - bed) / DEFAULT_BED_HEATING_RATE
+                    bed = target
+    state.relative_axes = relative_axes
+    state.relative_extrusion = relative_extrusion
+    state.hotend = hotend
+    state.bed = bed
+    moves.final_state = state
+    return moves
+
+def finalState(moves, feedrate):
+    """Machine state after the moves, feedrate being the result of moveGeometry."""
+    state = moves.final_state
+    if moves.count:
+        positions = moves.positions()
+        for axis in AXES:
+            state.position[axis] = float(positions[axis][-1])
+        state.feedrate = float(feedrate[-1]) * 60.
+    return state
+
+def forwardFill(values, initial = numpy.nan):
+    given = ~numpy.isnan(values)
+    index = numpy.where(given, numpy.arange(len(values)), -1)
+    numpy.maximum.accumulate(index, out = index)
+    return numpy.where(index >= 0, values[numpy.maximum(index, 0)], initial)
+
+def moveGeometry(moves):
+    """Returns (travel length of XYZ, extruded length, feedrate in mm/s) per line."""
+    positions = moves.positions()
+    is_move = moves.moveMask()
+    deltas = {}
+    for axis in AXES:
+        previous = numpy.concatenate(([moves.state.position[axis]], positions[axis][:-1]))
+        deltas[axis] = numpy.where(is_move, positions[axis] - previous, 0.)
+    travel = numpy.sqrt(deltas["X"] ** 2 + deltas["Y"] ** 2 + deltas["Z"] ** 2)
+    feedrate = forwardFill(moves.feedrate, moves.state.feedrate) / 60.
+    return travel, deltas["E"], feedrate
+
+def trapezoidDurations(distance, speed, acceleration = DEFAULT_ACCELERATION, jerk = DEFAULT_JERK):
+    """Time for moves starting and ending at the jerk speed, accelerating to speed if possible."""
+    speed = numpy.maximum(speed, 1e-3)
+    junction = numpy.minimum(speed, jerk)
+    ramp = (speed ** 2 - junction ** 2) / (2. * acceleration)
+    full = 2. * ramp <= distance
+    cruise_time = 2. * (speed - junction) / acceleration + (distance - 2. * ramp) / speed
+    peak = numpy.sqrt(acceleration * distance + junction ** 2)
+    triangle_time = 2. * (peak - junction) / acceleration
+    return numpy.where(distance > 0., numpy.where(full, cruise_time, triangle_time), 0.)
+
+class JobEstimate():
+    """Cumulative time and bytes, sampled every stride lines to keep huge jobs small."""
+    def __init__(self, lines, cumulative_time, cumulative_bytes, stride = 1):
+        self.count = lines
+        self.stride = stride
+        # Sample i describes the first positions[i] lines
+        self.positions = numpy.minimum(numpy.arange(len(cumulative_time) + 1) * stride, lines)
+        self.cumulative = numpy.concatenate(([0.], cumulative_time))
+        self.offsets = numpy.concatenate(([0], cumulative_bytes))
+        self.total = float(self.cumulative[-1])
+        self.size = int(self.offsets[-1])
+
+    @classmethod
+    def fromDurations(cls, durations, lengths):
+        return cls(len(durations), numpy.cumsum(durations), numpy.cumsum(lengths))
+
+    def __len__(self):
+        return self.count
+
+    def elapsedAt(self, sent_lines):
+        """Estimated print time of the first sent_lines lines."""
+        if sent_lines <= 0 or not self.count:
+            return 0.
+        return float(numpy.interp(min(sent_lines, self.count), self.positions, self.cumulative))
+
+    def remainingAt(self, sent_lines):
+        return self.total - self.elapsedAt(sent_lines)
+
+    def progressAt(self, sent_lines):
+        """Progress between 0 and 1 by time."""
+        if not self.total:
+            return min(max(sent_lines, 0) / self.count, 1.) if self.count else 1.
+        return self.elapsedAt(sent_lines) / self.total
+
+    def linesAtByte(self, byte_offset, file_size = None):
+        """Lines completed at a byte offset, scaled if the file on the printer has a different size."""
+        if file_size and self.size:
+            byte_offset = byte_offset * self.size / file_size
+        return int(numpy.interp(byte_offset, self.offsets, self.positions))
+
+    def progressAtByte(self, byte_offset, file_size = None):
+        return self.progressAt(self.linesAtByte(byte_offset, file_size))
+
+def estimateMoves(moves, acceleration = DEFAULT_ACCELERATION, jerk = DEFAULT_JERK):
+    travel, extrusion, feedrate = moveGeometry(moves)
+    distance = numpy.where(travel > 0., travel, numpy.abs(extrusion))
+    finalState(moves, feedrate)
+    return trapezoidDurations(distance, feedrate, acceleration, jerk) + moves.fixed_duration
+
+def estimateJob(lines, acceleration = DEFAULT_ACCELERATION, jerk = DEFAULT_JERK, stride = 1, chunk_lines = 65536, validator = None,
+                demand = None):
+    """Estimates an iterable of lines chunk by chunk.
+
+    Only every stride-th cumulative value is kept, which is precise enough
+    for progress and keeps the memory of huge jobs small. A given
+    JobValidation.JobValidator checks the same chunks on the way, a given
+    Preflight.LinkDemand adds up their durations.
+    """
+    chunk_lines = max(chunk_lines // stride, 1) * stride
+    state = MachineState()
+    time_samples = []
+    byte_samples = []
+    elapsed = 0.
+    size = 0
+    count = 0
+    iterator = iter(lines)
+    while True:
+        chunk = [line for _, line in zip(range(chunk_lines), iterator)]
+        if not chunk:
+            break
+        moves = extractMoves(chunk, state)
+        if validator is not None:
+            validator.addMoves(moves, count)
+        durations = estimateMoves(moves, acceleration, jerk)
+        if demand is not None:
+            demand.addMoves(moves, durations, count)
+        state = moves.final_state
+        cumulative_time = numpy.cumsum(durations) + elapsed
+        cumulative_bytes = numpy.cumsum(moves.lengths) + size
+        elapsed = float(cumulative_time[-1])
+        size = int(cumulative_bytes[-1])
+        count += len(chunk)
+        # Copies, slices would keep the whole chunk alive
+        time_samples.append(cumulative_time[stride - 1::stride].copy())
+        byte_samples.append(cumulative_bytes[stride - 1::stride].copy())
+        if len(chunk) % stride:
+            time_samples.append(cumulative_time[-1:])
+            byte_samples.append(cumulative_bytes[-1:])
+    if not count:
+        return JobEstimate(0, numpy.zeros(0), numpy.zeros(0, numpy.int64), stride)
+    return JobEstimate(count, numpy.concatenate(time_samples), numpy.concatenate(byte_samples), stride)
@@ -0,0 +1,377 @@
+'''
+Persistent cache of encoded jobs, shared by all printers and kept across jobs.
+
+An entry is keyed by a hash of the job's content and the transform
+settings (Preprocess.PreprocessSettings.key(), which includes the flavor).
+It holds a copy of the job, the encoded lines in the buffer layout of
+Preprocess (which has the checksum of every line precomputed) and the
+metadata which otherwise takes a pass over the job: line count, the print
+time estimate, the layer index and the link demand of Preflight. Sending a job again opens the entry
+through a memory map and starts with the first line right away.
+
+Line numbers aren't part of the encoded lines, they are added while
+sending, so the same entry serves jobs with and without checksums.
+
+Each entry is a directory named after its key, which only appears once it
+is complete. The modification time of its entry file is the last use,
+the least recently used entries are evicted once the cache grows above its
+size limit.
+'''
+
+import bisect
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+
+import numpy
+
+from .. import JobAnalysis
+from .. import JobSource
+from .. import LayerIndex
+from .. import Preflight
+from .. import Preprocess
+
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024 # bytes
+
+SOURCE_NAME = "source.gcode"
+LINES_NAME = "lines.bin" # Preprocess buffer layout over all lines of the job
+METADATA_NAME = "metadata.npz" # layer index, estimate and link demand
+ENTRY_NAME = "entry.json" # written last, its modification time is the last use
+
+ESTIMATE_STRIDE = 64 # lines, like the estimate of streamed jobs
+STALE_TEMPORARY_AGE = 3600. # s, leftovers of interrupted stores
+
+def fileHash(path):
+    """Hash of the whole content of a file."""
+    digest = hashlib.blake2b(digest_size = 20)
+    with open(path, "rb") as source_file:
+        for block in iter(lambda: source_file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def linesHash(lines):
+    """Hash of lines (eg. Cura's gcode_list), equal to fileHash() of them spooled."""
+    digest = hashlib.blake2b(digest_size = 20)
+    for data in Preprocess.spoolData(lines):
+        digest.update(data)
+    return digest.hexdigest()
+
+def entryKey(content_hash, settings):
+    digest = hashlib.blake2b(digest_size = 20)
+    digest.update(("%d:%s:%s" %(CACHE_VERSION, content_hash, settings.key())).encode("utf-8"))
+    return digest.hexdigest()
+
+def _countLines(path, end):
+    """Line breaks in front of a byte offset."""
+    count = 0
+    with open(path, "rb") as source_file:
+        while end > 0:
+            block = source_file.read(min(end, 1024 * 1024))
+            if not block:
+                break
+            count += block.count(b"\n")
+            end -= len(block)
+    return count
+
+class StoreCancelled(Exception):
+    """Raised by JobCache.store() when its cancelled event was set."""
+
+def _indexLayers(path):
+    """Worker: layer index of a file."""
+    return LayerIndex.LayerIndex.forFile(path, use_cache = False).layers
+
+def _estimateFile(path):
+    """Worker: (estimate, Preflight.LinkDemand) of a file."""
+    source = JobSource.FileJobSource(path)
+    demand = Preflight.LinkDemand()
+    try:
+        return JobAnalysis.estimateJob(source.lines(), stride = ESTIMATE_STRIDE, demand = demand), demand
+    finally:
+        source.close()
+
+class CachedJobSource(Preprocess.PreprocessedJobSource):
+    """PreprocessedJobSource over the single, memory-mapped chunk of a cache entry."""
+    def __init__(self, entry, start_offset = 0, prelude = ()):
+        JobSource.FileJobSource.__init__(self, entry.source_path, start_offset, prelude)
+        self.settings = None
+        self._chunks = (chunk for chunk in ())
+        self._chunk = entry.chunk()
+        self._index = bisect.bisect_right(self._chunk.input_ends, start_offset)
+        self._input_line = _countLines(entry.source_path, start_offset) if start_offset else 0
+        self._retired = []
+        self._line_count = self._prelude_count + self._chunk.input_lines - self._input_line
+
+class CacheEntry():
+    def __init__(self, directory, info):
+        self.directory = directory
+        self.info = info
+        self.key = info["key"]
+        self.source_path = os.path.join(directory, SOURCE_NAME)
+        self._metadata = None
+
+    def getLineCount(self):
+        """Lines of the job, including those without a command."""
+        return self.info["input_lines"]
+
+    def getSize(self):
+        return self.info["size"]
+
+    def _loadMetadata(self):
+        if self._metadata is None:
+            with numpy.load(os.path.join(self.directory, METADATA_NAME), allow_pickle = False) as metadata:
+                self._metadata = {name: metadata[name] for name in metadata.files}
+        return self._metadata
+
+    def estimate(self):
+        """JobAnalysis.JobEstimate of the whole job."""
+        metadata = self._loadMetadata()
+        return JobAnalysis.JobEstimate(int(metadata["estimate_lines"]), metadata["estimate_time"],
+                                       metadata["estimate_bytes"], int(metadata["estimate_stride"]))
+
+    def layerIndex(self):
+        return LayerIndex.LayerIndex(self._loadMetadata()["layers"])
+
+    def demand(self):
+        """Preflight.LinkDemand of the whole job, None if it was stored without."""
+        metadata = self._loadMetadata()
+        if not "demand_counts" in metadata:
+            return None
+        demand = Preflight.LinkDemand(int(metadata["demand_block_lines"]))
+        demand.lines = int(metadata["demand_lines"])
+        demand.starts = metadata["demand_starts"].tolist()
+        demand.counts = metadata["demand_counts"].tolist()
+        demand.sizes = metadata["demand_sizes"].tolist()
+        demand.times = metadata["demand_times"].tolist()
+        return demand
+
+    def chunk(self):
+        """All encoded lines as a single Preprocess.EncodedChunk."""
+        with open(os.path.join(self.directory, LINES_NAME), "rb") as lines_file:
+            mapping = mmap.mmap(lines_file.fileno(), 0, access = mmap.ACCESS_READ)
+        return Preprocess.EncodedChunk(memoryview(mapping), self.info["data_size"], self.info["count"],
+                                       self.info["input_lines"], 0, self.info["source_size"], mapping)
+
+    def open(self, start_offset = 0, prelude = (), start_layer = None):
+        """CachedJobSource like JobSource.openFile, optionally starting at a layer."""
+        if start_layer is not None:
+            index = self.layerIndex()
+            return CachedJobSource(self, index.getOffset(start_layer), index.resumeCommands(start_layer))
+        return CachedJobSource(self, start_offset, prelude)
+
+class JobCache():
+    def __init__(self, directory, max_size = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _entryDirectory(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load(self, key):
+        directory = self._entryDirectory(key)
+        info_path = os.path.join(directory, ENTRY_NAME)
+        try:
+            with open(info_path, "r") as info_file:
+                info = json.load(info_file)
+            if info["version"] != CACHE_VERSION or os.path.getsize(os.path.join(directory, SOURCE_NAME)) != info["source_size"]:
+                raise ValueError("Outdated entry")
+            os.utime(info_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return CacheEntry(directory, info)
+
+    def lookup(self, key):
+        """CacheEntry of the key, None if there is none; marks the entry as used."""
+        entry = self._load(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def store(self, key, source_path, settings, workers = 0, estimate = None, layers = None, demand = None, cancelled = None):
+        """Encodes a job into a new entry and evicts old ones, returns the CacheEntry.
+
+        The layer index and the estimate (with the link demand) are computed
+        unless given. With workers they are computed in worker processes next
+        to the encoding, so storing doesn't compete with the send loop for
+        this process. Setting the threading.Event cancelled stops the store
+        between chunks with StoreCancelled.
+        """
+        entry = self._load(key)
+        if entry is not None:
+            return entry
+        source_size = os.path.getsize(source_path)
+        if 3 * source_size > self.max_size:
+            # Source, encoded lines and arrays wouldn't leave space for anything else
+            return None
+        temporary = "%s.tmp-%d-%d" %(self._entryDirectory(key), os.getpid(), threading.get_ident())
+        os.makedirs(temporary)
+        executor = None
+        try:
+            copy_path = os.path.join(temporary, SOURCE_NAME)
+            shutil.copyfile(source_path, copy_path)
+            if workers and (estimate is None or layers is None):
+                executor = concurrent.futures.ProcessPoolExecutor(1, mp_context = Preprocess._context())
+                estimate_future = executor.submit(_estimateFile, copy_path) if estimate is None else None
+                layers_future = executor.submit(_indexLayers, copy_path) if layers is None else None
+
+            info = self._writeLines(copy_path, os.path.join(temporary, LINES_NAME), settings, workers, cancelled)
+            if executor is not None:
+                if estimate_future is not None:
+                    estimate, demand = estimate_future.result()
+                layers = layers_future.result() if layers_future is not None else layers
+            if estimate is None:
+                estimate, demand = _estimateFile(copy_path)
+            if layers is None:
+                layers = _indexLayers(copy_path)
+            if cancelled is not None and cancelled.is_set():
+                raise StoreCancelled()
+            metadata = {"layers": layers,
+                        "estimate_lines": numpy.int64(estimate.count),
+                        "estimate_stride": numpy.int64(estimate.stride),
+                        "estimate_time": estimate.cumulative[1:],
+                        "estimate_bytes": estimate.offsets[1:],
+                        }
+            if demand is not None:
+                metadata.update({"demand_block_lines": numpy.int64(demand.block_lines),
+                                 "demand_lines": numpy.int64(demand.lines),
+                                 "demand_starts": numpy.array(demand.starts, numpy.int64),
+                                 "demand_counts": numpy.array(demand.counts, numpy.int64),
+                                 "demand_sizes": numpy.array(demand.sizes, numpy.int64),
+                                 "demand_times": numpy.array(demand.times, numpy.float64),
+                                 })
+            with open(os.path.join(temporary, METADATA_NAME), "wb") as metadata_file:
+                numpy.savez(metadata_file, **metadata)
+
+            info.update({"version": CACHE_VERSION,
+                         "key": key,
+                         "settings": settings.key(),
+                         "source_size": source_size,
+                         "created": time.time(),
+                         })
+            info["size"] = sum(os.path.getsize(os.path.join(temporary, name)) for name in os.listdir(temporary))
+            with open(os.path.join(temporary, ENTRY_NAME), "w") as info_file:
+                json.dump(info, info_file)
+            os.rename(temporary, self._entryDirectory(key))
+        except StoreCancelled:
+            shutil.rmtree(temporary, ignore_errors = True)
+            raise
+        except Exception:
+            # Another store of the same job won, or the disk is full
+            shutil.rmtree(temporary, ignore_errors = True)
+            entry = self._load(key)
+            if entry is None:
+                raise
+            return entry
+        finally:
+            if executor is not None:
+                # Not started yet after an error (shutdown()'s cancel_futures needs Python 3.9)
+                for future in (estimate_future, layers_future):
+                    if future is not None:
+                        future.cancel()
+                # A cancelled store doesn't wait for the estimate
+                executor.shutdown(wait = cancelled is None or not cancelled.is_set())
+        self.stores += 1
+        self.evict(keep = key)
+        return self._load(key)
+
+    def _writeLines(self, source_path, lines_path, settings, workers, cancelled = None):
+        """Concatenates the encoded chunks of the source into one buffer, returns its layout."""
+        offsets = [numpy.zeros(1, numpy.uint64)]
+        line_indexes = []
+        input_ends = []
+        checksums = []
+        data_size = 0
+        input_lines = 0
+        chunks = Preprocess.encodeChunks(source_path, 0, settings, workers)
+        with open(lines_path, "wb") as lines_file:
+            for chunk in chunks:
+                if cancelled is not None and cancelled.is_set():
+                    chunk.close()
+                    chunks.close()
+                    raise StoreCancelled()
+                try:
+                    lines_file.write(chunk.data)
+                    offsets.append(numpy.frombuffer(chunk.offsets, numpy.uint64)[1:] + numpy.uint64(data_size))
+                    line_indexes.append(numpy.frombuffer(chunk.line_indexes, numpy.uint64) + numpy.uint64(input_lines))
+                    input_ends.append(numpy.frombuffer(chunk.input_ends, numpy.uint64).copy())
+                    checksums.append(bytes(chunk.checksums))
+                    data_size += len(chunk.data)
+                    input_lines += chunk.input_lines
+                finally:
+                    chunk.close()
+            for arrays in (offsets, line_indexes, input_ends):
+                for array in arrays:
+                    lines_file.write(array.astype("<u8").tobytes())
+            for data in checksums:
+                lines_file.write(data)
+        return {"data_size": data_size,
+                "count": sum(len(data) for data in checksums),
+                "input_lines": input_lines,
+                }
+
+    def _entries(self):
+        """(last use, size, directory) of all complete entries."""
+        entries = []
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            directory = os.path.join(self.directory, name)
+            if ".tmp-" in name:
+                try:
+                    if now - os.path.getmtime(directory) > STALE_TEMPORARY_AGE:
+                        shutil.rmtree(directory, ignore_errors = True)
+                except OSError:
+                    pass
+                continue
+            info_path = os.path.join(directory, ENTRY_NAME)
+            try:
+                with open(info_path, "r") as info_file:
+                    size = json.load(info_file)["size"]
+                entries.append((os.path.getmtime(info_path), size, directory))
+            except (OSError, ValueError, KeyError):
+                continue
+        return entries
+
+    def getSize(self):
+        return sum(size for _, size, _ in self._entries())
+
+    ##  Removes the least recently used entries until the cache fits its size limit.
+    def evict(self, keep = None):
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, directory in entries:
+                if total <= self.max_size:
+                    break
+                if os.path.basename(directory) == keep:
+                    continue
+                # Jobs still streaming from the entry keep their open mappings
+                shutil.rmtree(directory, ignore_errors = True)
+                total -= size
+                self.evictions += 1
+            return total
+
+    ##  Removes the entry of key, eg. one stored in advance which wasn't used.
+    def discard(self, key):
+        with self._lock:
+            shutil.rmtree(self._entryDirectory(key), ignore_errors = True)
+
+    def clear(self):
+        for _, _, directory in self._entries():
+            shutil.rmtree(directory, ignore_errors = True)
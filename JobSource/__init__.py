@@ -0,0 +1,123 @@
+'''
+Job sources which feed the send queue lazily.
+
+FileJobSource memory-maps a G-code file and hands out one line at a time
+as GCodeLibrary.RawLine wrapping a memoryview of the mapping, so neither
+the file nor its lines are ever copied into Python strings. Sent as dry run
+(StreamingEngine.setDryRun), each line is copied once to apply it;
+otherwise the memoryview goes to the socket as it is. Pages which
+have been sent are given back to the kernel, keeping the resident memory
+of huge jobs at a few windows.
+'''
+
+import collections
+import mmap
+
+from .. import GCodeLibrary
+from .. import LayerIndex
+
+# Returned by next() once the source is exhausted
+END = object()
+
+RELEASE_WINDOW = 16 * 1024 * 1024 # bytes, multiple of the page size
+
+class FileJobSource():
+    def __init__(self, path, start_offset = 0, prelude = ()):
+        self.path = path
+        self.start_offset = start_offset
+        self.prelude = collections.deque(prelude)
+        self._prelude_count = len(self.prelude)
+        self.buffer = LayerIndex.mapFile(path)
+        self.size = len(self.buffer)
+        self.view = memoryview(self.buffer)
+        self.position = start_offset
+        self._released = start_offset - start_offset % RELEASE_WINDOW
+        self._line_count = None
+        self._advise(getattr(mmap, "MADV_SEQUENTIAL", None), 0, self.size)
+
+    def _advise(self, option, start, length):
+        if option is None or not length or type(self.buffer) is not mmap.mmap:
+            return
+        try:
+            self.buffer.madvise(option, start, length)
+        except (AttributeError, OSError, ValueError):
+            pass
+
+    def _release(self):
+        """Drops pages which are behind the read position from memory."""
+        while self.position - self._released >= 2 * RELEASE_WINDOW:
+            self._advise(getattr(mmap, "MADV_DONTNEED", None), self._released, RELEASE_WINDOW)
+            self._released += RELEASE_WINDOW
+
+    def lineCount(self):
+        """Number of items next() returns before END."""
+        if self._line_count is None:
+            # Plain reads, so the pages don't end up in the mapping of this process
+            count = 0
+            last = b"\n"
+            with open(self.path, "rb") as gcode_file:
+                gcode_file.seek(self.start_offset)
+                for block in iter(lambda: gcode_file.read(1024 * 1024), b""):
+                    count += block.count(b"\n")
+                    last = block[-1:]
+            if last != b"\n":
+                count += 1
+            self._line_count = self._prelude_count + count
+        return self._line_count
+
+    def lines(self):
+        """All lines from the start, as str for the prelude and memoryview for the file."""
+        yield from list(self.prelude)
+        position = self.start_offset
+        released = position - position % RELEASE_WINDOW
+        while position < self.size:
+            end = self.buffer.find(b"\n", position)
+            if end == -1:
+                end = self.size
+            yield self.view[position:end]
+            position = end + 1
+            if position - released >= 2 * RELEASE_WINDOW:
+                # Dropping pages is harmless for a read-only mapping, at worst they are read again
+                self._advise(getattr(mmap, "MADV_DONTNEED", None), released, RELEASE_WINDOW)
+                released += RELEASE_WINDOW
+
+    def next(self):
+        """Next line to send, None for lines without a command and END when exhausted."""
+        if self.prelude:
+            return GCodeLibrary.identifyLine(self.prelude.popleft())
+        start = self.position
+        if start >= self.size:
+            return END
+        buffer = self.buffer
+        end = buffer.find(b"\n", start)
+        if end == -1:
+            end = self.size
+        self.position = end + 1
+        self._release()
+
+        comment = buffer.find(b";", start, end)
+        if comment != -1:
+            end = comment
+        while end > start and buffer[end - 1] in b" \t\r":
+            end -= 1
+        while start < end and buffer[start] in b" \t":
+            start += 1
+        if start == end:
+            return None
+        return GCodeLibrary.RawLine(self.view[start:end])
+
+    def close(self):
+        try:
+            self.view.release()
+            if type(self.buffer) is mmap.mmap:
+                self.buffer.close()
+        except BufferError:
+            # Lines are still referenced, the mapping goes with them
+            pass
+
+def openFile(path, start_layer = None):
+    """FileJobSource for a file, seeking to a layer using the (cached) layer index."""
+    if start_layer is None:
+        return FileJobSource(path)
+    index = LayerIndex.LayerIndex.forFile(path)
+    return FileJobSource(path, index.getOffset(start_layer), index.resumeCommands(start_layer))
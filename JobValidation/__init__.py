@@ -0,0 +1,225 @@
+'''
+Offline validation of G-code jobs on the arrays of JobAnalysis.
+
+The checks run vectorized over JobAnalysis.Moves, chunk by chunk:
+
+- moves leaving the build volume
+- opcodes no supported firmware knows
+- extrusion steps which don't fit the extrusion mode, like an absolute E
+  value sent in relative mode (a huge extrusion) or the other way round
+- temperatures above the limits and extrusion below the minimum
+  extrusion temperature
+
+Besides the issues it sums up extrusion, retraction and travel. The only
+per-line Python pass is JobAnalysis.extractMoves(), which the estimate
+does anyway: JobAnalysis.estimateJob(lines, validator = ...) validates in
+the same pass.
+'''
+
+import collections
+
+import numpy
+
+from .. import CommandTables
+from .. import GCodeLibrary
+from .. import JobAnalysis
+
+SEVERITY_ERROR = "error"
+SEVERITY_WARNING = "warning"
+
+ISSUE_OUT_OF_BOUNDS = "out_of_bounds"
+ISSUE_UNKNOWN_COMMAND = "unknown_command"
+ISSUE_EXTRUSION_JUMP = "extrusion_jump"
+ISSUE_RETRACTION_JUMP = "retraction_jump"
+ISSUE_HOTEND_TEMPERATURE = "hotend_temperature"
+ISSUE_BED_TEMPERATURE = "bed_temperature"
+ISSUE_COLD_EXTRUSION = "cold_extrusion"
+
+MESSAGES = {ISSUE_OUT_OF_BOUNDS: "%d move(s) outside of the build volume",
+            ISSUE_UNKNOWN_COMMAND: "%d line(s) with unknown commands",
+            ISSUE_EXTRUSION_JUMP: "%d move(s) extruding more than expected, relative and absolute extrusion mixed up?",
+            ISSUE_RETRACTION_JUMP: "%d move(s) retracting more than expected, relative and absolute extrusion mixed up?",
+            ISSUE_HOTEND_TEMPERATURE: "%d hotend temperature(s) above the limit",
+            ISSUE_BED_TEMPERATURE: "%d bed temperature(s) above the limit",
+            ISSUE_COLD_EXTRUSION: "%d move(s) extruding below the minimum extrusion temperature",
+            }
+
+SEVERITIES = {ISSUE_OUT_OF_BOUNDS: SEVERITY_ERROR,
+              ISSUE_UNKNOWN_COMMAND: SEVERITY_WARNING,
+              ISSUE_EXTRUSION_JUMP: SEVERITY_ERROR,
+              ISSUE_RETRACTION_JUMP: SEVERITY_WARNING,
+              ISSUE_HOTEND_TEMPERATURE: SEVERITY_ERROR,
+              ISSUE_BED_TEMPERATURE: SEVERITY_ERROR,
+              ISSUE_COLD_EXTRUSION: SEVERITY_ERROR,
+              }
+
+# Commands of Marlin and the other supported firmwares beyond those in GCodeLibrary and CommandTables
+COMMON_COMMANDS = ("G2", "G3", "G5", "G10", "G11", "G12", "G17", "G18", "G19", "G20", "G21", "G26", "G27", "G30",
+                   "G34", "G35", "G38", "G42", "G53", "G54", "G60", "G61", "G76", "G80",
+                   "M0", "M1", "M3", "M4", "M5", "M7", "M8", "M9", "M16", "M17", "M18", "M20", "M33", "M42", "M43",
+                   "M73", "M75", "M76", "M77", "M78", "M80", "M81", "M84", "M85", "M92", "M100", "M108", "M110",
+                   "M111", "M112", "M113", "M114", "M118", "M119", "M120", "M121", "M125", "M141", "M149", "M150",
+                   "M155", "M163", "M164", "M165", "M200", "M201", "M203", "M204", "M205", "M206", "M207", "M208",
+                   "M209", "M211", "M217", "M218", "M220", "M221", "M226", "M240", "M250", "M280", "M290", "M300",
+                   "M301", "M302", "M304", "M350", "M351", "M355", "M380", "M381", "M401", "M402", "M404", "M405",
+                   "M406", "M407", "M410", "M412", "M413", "M420", "M421", "M422", "M425", "M428", "M486", "M500",
+                   "M501", "M502", "M503", "M504", "M510", "M511", "M512", "M524", "M540", "M569", "M575", "M592",
+                   "M593", "M603", "M605", "M665", "M666", "M672", "M701", "M702", "M710", "M851", "M871", "M876",
+                   "M900", "M906", "M907", "M908", "M909", "M910", "M911", "M912", "M913", "M914", "M915", "M916",
+                   "M917", "M918", "M928", "M951", "M995", "M997", "M999",
+                   )
+
+def _knownOpcodes():
+    names = set(COMMON_COMMANDS)
+    for commands in (GCodeLibrary.GCodeCommands, GCodeLibrary.RepRapCommands):
+        names.update(name for name in vars(commands) if name[:1] in ("G", "M") and name[1:].isdigit())
+    opcodes = set(GCodeLibrary.opcode(name[0], int(name[1:])) for name in names)
+    for table in CommandTables.getTables():
+        opcodes.update(table.commands.keys())
+    return numpy.array(sorted(opcodes), numpy.int32)
+
+KNOWN_OPCODES = _knownOpcodes()
+TOOL_LETTER = ord("T")
+
+class BuildVolume():
+    def __init__(self, minimum, maximum):
+        self.minimum = dict(minimum) # {"X": mm, "Y": mm, "Z": mm}
+        self.maximum = dict(maximum)
+
+    @classmethod
+    def fromMachine(cls, width, depth, height, center_is_zero = False):
+        """Volume of Cura's machine_width, machine_depth, machine_height and machine_center_is_zero."""
+        if center_is_zero:
+            return cls({"X": -width / 2., "Y": -depth / 2., "Z": 0.}, {"X": width / 2., "Y": depth / 2., "Z": height})
+        return cls({"X": 0., "Y": 0., "Z": 0.}, {"X": width, "Y": depth, "Z": height})
+
+class ValidationLimits():
+    def __init__(self, volume = None, max_hotend = 300., max_bed = 130., min_extrusion_temperature = 170.,
+                 max_extrusion = 50., max_retraction = 20., tolerance = 0.5, known_opcodes = None):
+        self.volume = volume # BuildVolume, None doesn't check bounds
+        self.max_hotend = max_hotend # degrees
+        self.max_bed = max_bed
+        self.min_extrusion_temperature = min_extrusion_temperature
+        self.max_extrusion = max_extrusion # mm of filament per move
+        self.max_retraction = max_retraction
+        self.tolerance = tolerance # mm outside of the volume still accepted
+        self.known_opcodes = known_opcodes if known_opcodes is not None else KNOWN_OPCODES
+
+class Issue():
+    def __init__(self, kind, line, count = 1):
+        self.kind = kind
+        self.severity = SEVERITIES.get(kind, SEVERITY_WARNING)
+        self.line = line # first line (0-based) with the issue
+        self.count = count
+
+    def getMessage(self):
+        return (MESSAGES.get(self.kind, self.kind + ": %d") %self.count) + ", first in line %d" %(self.line + 1)
+
+    def __repr__(self):
+        return "<Issue %s: %s>" %(self.severity, self.getMessage())
+
+class ValidationReport():
+    def __init__(self, issues, lines, extrusion, retraction, travel, extruding_travel, minimum, maximum):
+        self.issues = issues
+        self.lines = lines
+        self.extrusion = extrusion # mm of filament pushed
+        self.retraction = retraction # mm of filament pulled back
+        self.travel = travel # mm moved without extruding
+        self.extruding_travel = extruding_travel # mm moved while extruding
+        self.minimum = minimum # corner of the extruded part, None without extrusion
+        self.maximum = maximum
+
+    def getErrors(self):
+        return [issue for issue in self.issues if issue.severity == SEVERITY_ERROR]
+
+    def getWarnings(self):
+        return [issue for issue in self.issues if issue.severity == SEVERITY_WARNING]
+
+    def isValid(self):
+        return not self.getErrors()
+
+class JobValidator():
+    """Collects the issues and totals of Moves handed over in job order."""
+    def __init__(self, limits = None):
+        self.limits = limits or ValidationLimits()
+        self._issues = collections.OrderedDict()
+        self.lines = 0
+        self.extrusion = 0.
+        self.retraction = 0.
+        self.travel = 0.
+        self.extruding_travel = 0.
+        self._minimum = None
+        self._maximum = None
+
+    def _add(self, kind, mask, first_line):
+        count = int(numpy.count_nonzero(mask))
+        if not count:
+            return
+        issue = self._issues.get(kind)
+        if issue is None:
+            self._issues[kind] = Issue(kind, first_line + int(numpy.argmax(mask)), count)
+        else:
+            issue.count += count
+
+    def addMoves(self, moves, first_line):
+        """Checks Moves of the lines starting with first_line (0-based)."""
+        limits = self.limits
+        positions = moves.positions()
+        is_move = moves.moveMask()
+        travel, extrusion, feedrate = JobAnalysis.moveGeometry(moves)
+        extruding = is_move & (extrusion > 0.)
+
+        if limits.volume is not None:
+            outside = numpy.zeros(moves.count, numpy.bool_)
+            for axis in ("X", "Y", "Z"):
+                outside |= positions[axis] < limits.volume.minimum[axis] - limits.tolerance
+                outside |= positions[axis] > limits.volume.maximum[axis] + limits.tolerance
+            self._add(ISSUE_OUT_OF_BOUNDS, outside & is_move, first_line)
+
+        opcodes = moves.opcode
+        unknown = (opcodes != 0) & (opcodes >> 16 != TOOL_LETTER) & ~numpy.isin(opcodes, limits.known_opcodes)
+        self._add(ISSUE_UNKNOWN_COMMAND, unknown, first_line)
+
+        self._add(ISSUE_EXTRUSION_JUMP, is_move & (extrusion > limits.max_extrusion), first_line)
+        self._add(ISSUE_RETRACTION_JUMP, is_move & (extrusion < -limits.max_retraction), first_line)
+
+        # NaN compares False, lines without a temperature pass
+        self._add(ISSUE_HOTEND_TEMPERATURE, moves.temperature > limits.max_hotend, first_line)
+        self._add(ISSUE_BED_TEMPERATURE, moves.bed_temperature > limits.max_bed, first_line)
+        hotend = JobAnalysis.forwardFill(moves.temperature, moves.state.hotend)
+        self._add(ISSUE_COLD_EXTRUSION, extruding & (hotend < limits.min_extrusion_temperature), first_line)
+
+        self.lines = max(self.lines, first_line + moves.count)
+        self.extrusion += float(extrusion[extruding].sum())
+        self.retraction -= float(extrusion[is_move & (extrusion < 0.)].sum())
+        self.travel += float(travel[~extruding].sum())
+        self.extruding_travel += float(travel[extruding].sum())
+        if extruding.any():
+            minimum = numpy.array([positions[axis][extruding].min() for axis in ("X", "Y", "Z")])
+            maximum = numpy.array([positions[axis][extruding].max() for axis in ("X", "Y", "Z")])
+            self._minimum = minimum if self._minimum is None else numpy.minimum(self._minimum, minimum)
+            self._maximum = maximum if self._maximum is None else numpy.maximum(self._maximum, maximum)
+
+    def getReport(self):
+        minimum = maximum = None
+        if self._minimum is not None:
+            minimum = dict(zip(("X", "Y", "Z"), self._minimum.tolist()))
+            maximum = dict(zip(("X", "Y", "Z"), self._maximum.tolist()))
+        return ValidationReport(list(self._issues.values()), self.lines, self.extrusion, self.retraction,
+                                self.travel, self.extruding_travel, minimum, maximum)
+
+def validateJob(lines, limits = None, chunk_lines = 65536):
+    """ValidationReport of an iterable of lines, see JobAnalysis.estimateJob for estimating at the same time."""
+    validator = JobValidator(limits)
+    state = JobAnalysis.MachineState()
+    first_line = 0
+    iterator = iter(lines)
+    while True:
+        chunk = [line for _, line in zip(range(chunk_lines), iterator)]
+        if not chunk:
+            break
+        moves = JobAnalysis.extractMoves(chunk, state)
+        validator.addMoves(moves, first_line)
+        state = JobAnalysis.finalState(moves, JobAnalysis.moveGeometry(moves)[2])
+        first_line += len(chunk)
+    return validator.getReport()
@@ -0,0 +1,274 @@
+'''
+Crash-safe journal of the job which is being streamed.
+
+The journal is an append-only file of records, each framed by its length,
+a CRC32 and a type. A torn write at the end (eg. Cura being killed while
+writing) only loses that record, reading stops at the first damaged one.
+
+The send loop only hands over the last acknowledged line and byte offset.
+A background thread turns that into a checkpoint once per interval: it
+follows the machine state by parsing the lines since the last checkpoint,
+appends a record and syncs the file, so there is a single fsync per
+interval whatever the line rate is.
+
+A checkpoint stores the state as LayerIndex.LAYER_DTYPE entry, which
+directly gives the offset to seek to and LayerIndex.resumeCommands().
+'''
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy
+
+from .. import LayerIndex
+
+JOURNAL_VERSION = 1
+JOURNAL_SUFFIX = ".journal"
+
+RECORD_HEADER = struct.Struct("<IIB") # payload length, CRC32 of type and payload, type
+CHECKPOINT_TIME = struct.Struct("<d")
+
+RECORD_JOB = 1 # JSON describing the job
+RECORD_CHECKPOINT = 2 # wall time and a LAYER_DTYPE entry
+RECORD_FINISHED = 3
+
+SAMPLE_SIZE = 64 * 1024 # bytes
+SAMPLE_COUNT = 16
+
+def sourceHash(path):
+    """Hash of size and samples spread over the file, cheap even for huge jobs."""
+    digest = hashlib.blake2b(digest_size = 16)
+    size = os.path.getsize(path)
+    digest.update(struct.pack("<Q", size))
+    with open(path, "rb") as source_file:
+        if size <= SAMPLE_SIZE * SAMPLE_COUNT:
+            digest.update(source_file.read())
+        else:
+            step = (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+            for sample in range(SAMPLE_COUNT):
+                source_file.seek(sample * step)
+                digest.update(source_file.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+def _record(record_type, payload):
+    checksum = zlib.crc32(bytes((record_type,)) + payload)
+    return RECORD_HEADER.pack(len(payload), checksum, record_type) + payload
+
+def readRecords(path):
+    """Yields (type, payload) of all intact records."""
+    with open(path, "rb") as journal_file:
+        data = journal_file.read()
+    position = 0
+    while position + RECORD_HEADER.size <= len(data):
+        length, checksum, record_type = RECORD_HEADER.unpack_from(data, position)
+        start = position + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) != length or zlib.crc32(bytes((record_type,)) + payload) != checksum:
+            return
+        yield record_type, payload
+        position = start + length
+
+class JournalState():
+    """What a journal says about its job."""
+    def __init__(self, job, checkpoint = None, checkpoint_time = None, finished = False):
+        self.job = job
+        self.checkpoint = checkpoint # LAYER_DTYPE entry
+        self.checkpoint_time = checkpoint_time
+        self.finished = finished
+
+    def getSourcePath(self):
+        return self.job["source"]
+
+    def getOffset(self):
+        if self.checkpoint is None:
+            return self.job["start_offset"]
+        return int(self.checkpoint["offset"])
+
+    def getLine(self):
+        if self.checkpoint is None:
+            return self.job.get("start_line", 0)
+        return int(self.checkpoint["line"])
+
+    def resumeCommands(self, home_xy = True):
+        """Lines to send in front of the file from getOffset() on."""
+        if self.checkpoint is None:
+            return list(self.job["prelude"])
+        return LayerIndex.resumeCommands(self.checkpoint, home_xy)
+
+    def matchesSource(self):
+        """Whether the file is still the one which was printed."""
+        try:
+            return sourceHash(self.getSourcePath()) == self.job["hash"]
+        except OSError:
+            return False
+
+def readJournal(path):
+    """JournalState of a journal file, None if it doesn't describe a job."""
+    state = None
+    try:
+        for record_type, payload in readRecords(path):
+            if record_type == RECORD_JOB:
+                state = JournalState(json.loads(payload.decode("utf-8")))
+            elif record_type == RECORD_CHECKPOINT and state is not None:
+                state.checkpoint_time = CHECKPOINT_TIME.unpack_from(payload)[0]
+                state.checkpoint = numpy.frombuffer(payload, LayerIndex.LAYER_DTYPE, 1, CHECKPOINT_TIME.size)[0]
+            elif record_type == RECORD_FINISHED and state is not None:
+                state.finished = True
+    except (OSError, ValueError):
+        return None
+    return state
+
+def safeName(name):
+    """Printer name usable as file name."""
+    return "".join(character if character.isalnum() or character in "-_." else "_" for character in name)
+
+def journalPath(directory, name):
+    return os.path.join(directory, safeName(name) + JOURNAL_SUFFIX)
+
+def findUnfinished(directory, name):
+    """JournalState of an interrupted job of the named printer, None if there is none."""
+    path = journalPath(directory, name)
+    if not os.path.exists(path):
+        return None
+    state = readJournal(path)
+    if state is None or state.finished:
+        return None
+    return state
+
+class JobJournal():
+    def __init__(self, path, source_path, start_offset = 0, prelude = (), start_line = 0, interval = 1.):
+        self.path = path
+        self.source_path = source_path
+        self.start_offset = start_offset
+        self.prelude = list(prelude)
+        self.start_line = start_line # lines done in front of start_offset, eg. when resuming
+        self.interval = interval
+        self.size = os.path.getsize(source_path)
+
+        # Machine state, following the acknowledged lines
+        self._state = LayerIndex.MachineState()
+        for line in self.prelude:
+            self._state.update(line.encode("utf-8"))
+        self._layer = -1
+        self._parsed_offset = start_offset
+        self._source_file = None
+
+        # Written by the send loop, taken by the writer thread
+        self._acknowledged = None
+        self._written = None
+
+        self._file = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        self.checkpoints = 0
+        self.syncs = 0
+        self.sync_time = 0. # s
+
+    def start(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        job = {"version": JOURNAL_VERSION,
+               "source": self.source_path,
+               "hash": sourceHash(self.source_path),
+               "size": self.size,
+               "start_offset": self.start_offset,
+               "start_line": self.start_line,
+               "prelude": self.prelude,
+               "created": time.time(),
+               }
+        self._source_file = open(self.source_path, "rb")
+        # A new job replaces the journal of the previous one
+        self._file = open(self.path, "wb")
+        self._file.write(_record(RECORD_JOB, json.dumps(job).encode("utf-8")))
+        self._sync()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+        return self
+
+    ##  Hot path: called for every acknowledged line with the lines done and the offset behind them.
+    def acknowledge(self, line, offset):
+        self._acknowledged = (line, offset)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def _advance(self, offset):
+        """Follows the machine state up to the given offset."""
+        if offset <= self._parsed_offset:
+            return
+        self._source_file.seek(self._parsed_offset)
+        data = self._source_file.read(offset - self._parsed_offset)
+        for line in data.split(b"\n"):
+            if line.startswith(LayerIndex.LAYER_MARKER):
+                layer = LayerIndex._parseLayerNumber(line)
+                if layer is not None:
+                    self._layer = layer
+            elif line:
+                self._state.update(line)
+        self._parsed_offset = offset
+
+    ##  Writes a checkpoint of the last acknowledged line now, if there is a new one.
+    def flush(self):
+        with self._lock:
+            acknowledged = self._acknowledged
+            if self._file is None or acknowledged is None or acknowledged == self._written:
+                return False
+            line, offset = acknowledged
+            self._advance(offset)
+            entry = self._state.entry(self._layer, offset, self.start_line + line)
+            self._file.write(_record(RECORD_CHECKPOINT, CHECKPOINT_TIME.pack(time.time()) + entry.tobytes()))
+            self._sync()
+            self._written = acknowledged
+            self.checkpoints += 1
+            return True
+
+    def _sync(self):
+        started = time.monotonic()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.syncs += 1
+        self.sync_time += time.monotonic() - started
+
+    def _stopThread(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    ##  Stops journaling, keeping the journal to resume from.
+    def close(self):
+        self._stopThread()
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._source_file is not None:
+                self._source_file.close()
+                self._source_file = None
+
+    ##  The job is done, nothing to resume anymore.
+    def finish(self):
+        self._stopThread()
+        with self._lock:
+            if self._file is not None:
+                self._file.write(_record(RECORD_FINISHED, b""))
+                self._sync()
+                self._file.close()
+                self._file = None
+            if self._source_file is not None:
+                self._source_file.close()
+                self._source_file = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,289 @@
+'''
+Layer offset index over memory-mapped G-code files.
+
+One pass over the file records for every ";LAYER:" marker the byte offset,
+the line number, and the machine state at that point: positions, E,
+feedrate, positioning modes, temperatures and fan speed. With the index
+a job can be started at any layer by seeking to its offset and sending
+resumeCommands() in front of it.
+
+The index is cached next to the file as "<file>.layers.npz" and is rebuilt
+when size or modification time of the file change.
+'''
+
+import mmap
+import os
+
+import numpy
+
+INDEX_VERSION = 1
+CACHE_SUFFIX = ".layers.npz"
+
+FLAG_RELATIVE_AXES = 0x1
+FLAG_RELATIVE_EXTRUSION = 0x2
+
+LAYER_DTYPE = numpy.dtype([("layer", numpy.int32),
+                           ("offset", numpy.int64),
+                           ("line", numpy.int64),
+                           ("height", numpy.float64), # first Z reached within the layer
+                           ("x", numpy.float64),
+                           ("y", numpy.float64),
+                           ("z", numpy.float64),
+                           ("e", numpy.float64),
+                           ("f", numpy.float64),
+                           ("hotend", numpy.float32),
+                           ("bed", numpy.float32),
+                           ("fan", numpy.float32),
+                           ("flags", numpy.uint8),
+                           ])
+
+LAYER_MARKER = b";LAYER:"
+
+class MachineState():
+    """Modal state tracked while reading G-code."""
+    def __init__(self):
+        self.position = {b"X": 0., b"Y": 0., b"Z": 0., b"E": 0.}
+        self.feedrate = 1500.
+        self.relative_axes = False
+        self.relative_extrusion = False
+        self.hotend = 0.
+        self.bed = 0.
+        self.fan = 0.
+
+    def flags(self):
+        return (FLAG_RELATIVE_AXES if self.relative_axes else 0) | (FLAG_RELATIVE_EXTRUSION if self.relative_extrusion else 0)
+
+    def row(self, layer, offset, line, height = numpy.nan):
+        """Fields of a LAYER_DTYPE entry describing this state."""
+        return [layer, offset, line, height,
+                self.position[b"X"], self.position[b"Y"], self.position[b"Z"], self.position[b"E"],
+                self.feedrate, self.hotend, self.bed, self.fan, self.flags()]
+
+    def entry(self, layer, offset, line):
+        return numpy.array(tuple(self.row(layer, offset, line)), LAYER_DTYPE)[()]
+
+    def update(self, line):
+        """Applies one line (bytes) to the state, returns True if Z changed."""
+        words = line.split(b";", 1)[0].split()
+        if words and words[0][:1] == b"N":
+            words = words[1:]
+        if not words:
+            return False
+        command = words[0].upper()
+        z_before = self.position[b"Z"]
+        if command in (b"G0", b"G1", b"G00", b"G01", b"G92"):
+            setting = command == b"G92"
+            for word in words[1:]:
+                axis = word[:1].upper()
+                try:
+                    value = float(word[1:])
+                except ValueError:
+                    continue
+                if axis in self.position:
+                    relative = self.relative_extrusion if axis == b"E" else self.relative_axes
+                    if relative and not setting:
+                        self.position[axis] += value
+                    else:
+                        self.position[axis] = value
+                elif axis == b"F" and not setting:
+                    self.feedrate = value
+        elif command == b"G28":
+            axes = [word[:1].upper() for word in words[1:]] or [b"X", b"Y", b"Z"]
+            for axis in axes:
+                if axis in (b"X", b"Y", b"Z"):
+                    self.position[axis] = 0.
+        elif command == b"G90":
+            self.relative_axes = self.relative_extrusion = False
+        elif command == b"G91":
+            self.relative_axes = self.relative_extrusion = True
+        elif command == b"M82":
+            self.relative_extrusion = False
+        elif command == b"M83":
+            self.relative_extrusion = True
+        elif command in (b"M104", b"M109", b"M140", b"M190", b"M106"):
+            value = None
+            for word in words[1:]:
+                if word[:1] in (b"S", b"s"):
+                    try:
+                        value = float(word[1:])
+                    except ValueError:
+                        pass
+            if value is None:
+                if command == b"M106":
+                    self.fan = 255.
+                return False
+            if command in (b"M104", b"M109"):
+                self.hotend = value
+            elif command in (b"M140", b"M190"):
+                self.bed = value
+            else:
+                self.fan = value
+        elif command == b"M107":
+            self.fan = 0.
+        return self.position[b"Z"] != z_before
+
+def _parseLayerNumber(line):
+    try:
+        return int(line[len(LAYER_MARKER):].strip())
+    except ValueError:
+        return None
+
+def buildIndex(buffer):
+    """Indexes a bytes-like buffer (eg. an mmap) in a single pass."""
+    state = MachineState()
+    rows = []
+    open_row = None # layer row still waiting for its first Z
+    position = 0
+    line_number = 0
+    size = len(buffer)
+    find = buffer.find
+    while position < size:
+        end = find(b"\n", position)
+        if end == -1:
+            end = size
+        line = buffer[position:end]
+        if line[:1] == b";":
+            if line.startswith(LAYER_MARKER):
+                layer = _parseLayerNumber(line)
+                if layer is not None:
+                    open_row = state.row(layer, position, line_number)
+                    rows.append(open_row)
+        elif line:
+            if state.update(line) and open_row is not None:
+                open_row[3] = state.position[b"Z"]
+                open_row = None
+        position = end + 1
+        line_number += 1
+    index = numpy.zeros(len(rows), LAYER_DTYPE)
+    for row_index, row in enumerate(rows):
+        index[row_index] = tuple(row)
+    return index
+
+def cachePath(path):
+    return path + CACHE_SUFFIX
+
+def _fileStamp(path):
+    stat = os.stat(path)
+    return numpy.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns], numpy.int64)
+
+def _loadCache(path, stamp):
+    try:
+        with numpy.load(cachePath(path), allow_pickle = False) as cached:
+            if numpy.array_equal(cached["stamp"], stamp):
+                return cached["layers"]
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+def _saveCache(path, stamp, layers):
+    temporary = cachePath(path) + ".tmp"
+    try:
+        with open(temporary, "wb") as cache_file:
+            numpy.savez(cache_file, stamp = stamp, layers = layers)
+        os.replace(temporary, cachePath(path))
+    except OSError:
+        # Read-only location, the index just isn't cached
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+
+def mapFile(path):
+    """Read-only memory map of a file (empty files can't be mapped)."""
+    with open(path, "rb") as gcode_file:
+        if not os.fstat(gcode_file.fileno()).st_size:
+            return b""
+        return mmap.mmap(gcode_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+class LayerIndex():
+    def __init__(self, layers):
+        self.layers = layers
+        numbers = layers["layer"]
+        # Layers are usually consecutive (including negative raft layers), allowing plain arithmetic
+        self._first = int(numbers[0]) if len(numbers) else 0
+        self._consecutive = bool(len(numbers)) and numpy.array_equal(numbers, numpy.arange(self._first, self._first + len(numbers)))
+        if not self._consecutive:
+            self._rows = {int(number): row for row, number in enumerate(numbers)}
+
+    @classmethod
+    def forFile(cls, path, use_cache = True):
+        stamp = _fileStamp(path)
+        layers = _loadCache(path, stamp) if use_cache else None
+        if layers is None:
+            buffer = mapFile(path)
+            try:
+                layers = buildIndex(buffer)
+            finally:
+                if type(buffer) is mmap.mmap:
+                    buffer.close()
+            if use_cache:
+                _saveCache(path, stamp, layers)
+        return cls(layers)
+
+    @classmethod
+    def forBuffer(cls, buffer):
+        return cls(buildIndex(buffer))
+
+    def __len__(self):
+        return len(self.layers)
+
+    def getLayerNumbers(self):
+        return self.layers["layer"]
+
+    def _row(self, layer):
+        if self._consecutive:
+            row = layer - self._first
+            if 0 <= row < len(self.layers):
+                return row
+            raise KeyError("Layer %s not in index" %layer)
+        return self._rows[layer]
+
+    def getLayer(self, layer):
+        return self.layers[self._row(layer)]
+
+    def getOffset(self, layer):
+        return int(self.getLayer(layer)["offset"])
+
+    def getLineNumber(self, layer):
+        return int(self.getLayer(layer)["line"])
+
+    def layerAtOffset(self, offset):
+        """Number of the layer containing the given byte offset, None before the first layer."""
+        row = int(numpy.searchsorted(self.layers["offset"], offset, side = "right")) - 1
+        if row < 0:
+            return None
+        return int(self.layers["layer"][row])
+
+    def resumeCommands(self, layer, home_xy = True, travel_feedrate = 9000.):
+        """G-code lines restoring the machine state in front of the given layer."""
+        return resumeCommands(self.getLayer(layer), home_xy, travel_feedrate)
+
+def resumeCommands(entry, home_xy = True, travel_feedrate = 9000.):
+    """G-code lines restoring the machine state of a LAYER_DTYPE entry.
+
+    Z is not homed, the printer is expected to still know its Z position.
+    """
+    commands = []
+    if entry["bed"]:
+        commands.append("M140 S%g" %entry["bed"])
+    if entry["hotend"]:
+        commands.append("M104 S%g" %entry["hotend"])
+    if entry["bed"]:
+        commands.append("M190 S%g" %entry["bed"])
+    if entry["hotend"]:
+        commands.append("M109 S%g" %entry["hotend"])
+    if home_xy:
+        commands.append("G28 X0 Y0")
+    commands.append("G90")
+    commands.append("M83" if entry["flags"] & FLAG_RELATIVE_EXTRUSION else "M82")
+    commands.append("G92 E%.5f" %entry["e"])
+    commands.append("G0 F%g Z%.3f" %(travel_feedrate, entry["z"]))
+    commands.append("G0 X%.3f Y%.3f" %(entry["x"], entry["y"]))
+    commands.append("G0 F%g" %entry["f"])
+    if entry["fan"]:
+        commands.append("M106 S%g" %entry["fan"])
+    else:
+        commands.append("M107")
+    if entry["flags"] & FLAG_RELATIVE_AXES:
+        commands.append("G91")
+    return commands
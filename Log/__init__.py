@@ -0,0 +1,35 @@
+'''
+Logging for the parts of the plugin which run without Cura.
+
+Inside Cura this is UM's Logger. Without it, eg. for the command line
+sender, the same calls go to Python's logging module.
+'''
+
+import logging
+
+try:
+    from UM.Logger import Logger
+except ImportError:
+    Logger = None
+
+LEVELS = {"d": logging.DEBUG,
+          "i": logging.INFO,
+          "w": logging.WARNING,
+          "e": logging.ERROR,
+          "c": logging.CRITICAL,
+          }
+
+class HeadlessLogger():
+    """Replacement of UM's Logger, with the same log types."""
+    _logger = logging.getLogger("serialwifi")
+
+    @classmethod
+    def log(cls, log_type, message, *args):
+        cls._logger.log(LEVELS.get(log_type, logging.INFO), message, *args)
+
+    @classmethod
+    def logException(cls, log_type, message, *args):
+        cls._logger.log(LEVELS.get(log_type, logging.INFO), message, *args, exc_info = True)
+
+if Logger is None:
+    Logger = HeadlessLogger
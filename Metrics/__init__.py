@@ -0,0 +1,198 @@
+'''
+Low-overhead link metrics for the serial print pipeline.
+
+All storage is preallocated at construction, so recording a sample in the
+send and receive loops is a couple of array writes and never allocates.
+'''
+
+import array
+import bisect
+import time
+
+# Log-scaled bucket bounds in seconds: 100us ... ~100s
+TIME_BUCKETS = [0.0001 * (2 ** (i / 2.)) for i in range(41)]
+# Queue depth buckets: 0, 1, 2, 4, ... 2^24 lines
+DEPTH_BUCKETS = [0] + [2 ** i for i in range(25)]
+
+class Histogram():
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = array.array("Q", [0] * (len(self.bounds) + 1))
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.total = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if not self.total:
+            return None
+        return self.sum / self.total
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile."""
+        if not self.total:
+            return None
+        wanted = self.total * percent / 100.
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def buckets(self):
+        return [(bound, count) for bound, count in zip(self.bounds + [None], self.counts)]
+
+class Series():
+    """A histogram plus a ring of the most recent raw samples."""
+    def __init__(self, bounds, capacity = 1024):
+        self.histogram = Histogram(bounds)
+        self.capacity = capacity
+        self.samples = array.array("d", [0.] * capacity)
+        self.index = 0
+
+    def reset(self):
+        self.histogram.reset()
+        self.index = 0
+
+    def add(self, value):
+        self.samples[self.index % self.capacity] = value
+        self.index += 1
+        self.histogram.add(value)
+
+    def recent(self, count = None):
+        available = min(self.index, self.capacity)
+        if count is None or count > available:
+            count = available
+        start = self.index - count
+        return [self.samples[i % self.capacity] for i in range(start, self.index)]
+
+    def last(self):
+        if not self.index:
+            return None
+        return self.samples[(self.index - 1) % self.capacity]
+
+    def summary(self):
+        histogram = self.histogram
+        return {"count": histogram.total,
+                "mean": histogram.mean(),
+                "min": histogram.min,
+                "max": histogram.max,
+                "p50": histogram.percentile(50),
+                "p90": histogram.percentile(90),
+                "p99": histogram.percentile(99),
+                "last": self.last(),
+                }
+
+class LinkMetrics():
+    series_names = ("rtt", "ok_to_send", "queue_depth", "throughput", "upload_rate")
+    counter_names = ("lines_sent", "lines_received", "bytes_sent", "bytes_received", "timeouts", "resends", "write_calls", "write_time", "reconnects", "reconnect_time")
+
+    def __init__(self, capacity = 1024):
+        self.rtt = Series(TIME_BUCKETS, capacity)
+        self.ok_to_send = Series(TIME_BUCKETS, capacity)
+        self.queue_depth = Series(DEPTH_BUCKETS, capacity)
+        # bytes/s, one sample per call of sample()
+        self.throughput = Series([2 ** i for i in range(32)], 600)
+        # lines/s, one sample per upload to the SD card
+        self.upload_rate = Series([2 ** i for i in range(20)], 64)
+        self.reset()
+
+    def reset(self):
+        for name in self.series_names:
+            getattr(self, name).reset()
+        self.lines_sent = 0
+        self.lines_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timeouts = 0
+        self.resends = 0
+        self.write_calls = 0
+        self.write_time = 0. # CPU time spent in writes, s
+        self.reconnects = 0
+        self.reconnect_time = 0. # s without connection
+        self.started = time.monotonic()
+        self._sampled_time = self.started
+        self._sampled_bytes = 0
+
+    # Hot path
+    def countSent(self, size):
+        self.lines_sent += 1
+        self.bytes_sent += size
+
+    def countReceived(self, size):
+        self.lines_received += 1
+        self.bytes_received += size
+
+    def countWrite(self, calls, cpu_time):
+        self.write_calls += calls
+        self.write_time += cpu_time
+
+    def countReconnect(self, seconds):
+        self.reconnects += 1
+        self.reconnect_time += seconds
+
+    def addRoundTrip(self, seconds):
+        self.rtt.add(seconds)
+
+    def addOkToSend(self, seconds):
+        self.ok_to_send.add(seconds)
+
+    def addQueueDepth(self, depth):
+        self.queue_depth.add(depth)
+
+    def addUploadRate(self, lines_per_second):
+        self.upload_rate.add(lines_per_second)
+
+    def countTimeout(self):
+        self.timeouts += 1
+
+    def countResend(self):
+        self.resends += 1
+
+    # Slow path, eg. from an update timer
+    def sample(self, now = None):
+        """Adds a bytes/s sample covering the time since the last call."""
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self._sampled_time
+        if elapsed <= 0:
+            return None
+        rate = (self.bytes_sent - self._sampled_bytes) / elapsed
+        self._sampled_time = now
+        self._sampled_bytes = self.bytes_sent
+        self.throughput.add(rate)
+        return rate
+
+    def getSeries(self, name):
+        if name not in self.series_names:
+            raise KeyError("Unknown series: %s" %name)
+        return getattr(self, name)
+
+    def getHistogram(self, name):
+        return self.getSeries(name).histogram.buckets()
+
+    def getSummary(self):
+        summary = {name: getattr(self, name) for name in self.counter_names}
+        summary["uptime"] = time.monotonic() - self.started
+        summary["lines_per_write"] = self.lines_sent / self.write_calls if self.write_calls else 0.
+        summary["write_time_per_mb"] = self.write_time / self.bytes_sent * 1e6 if self.bytes_sent else 0.
+        for name in self.series_names:
+            summary[name] = self.getSeries(name).summary()
+        return summary
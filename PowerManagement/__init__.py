@@ -1,61 +1,107 @@
-from UM.Platform import Platform
-
-
-if Platform.isLinux():
-    import dbus
-    
-    class PowerManagement():
-        def __init__(self):
-            self.suspendInhibition = None
-            try:
-                devobj = dbus.SessionBus().get_object('org.kde.kded',
-                                                      '/org/kde/Solid/PowerManagement/PolicyAgent')
-                self.solid_session = dbus.Interface (devobj,
-                                                     "org.kde.Solid.PowerManagement.PolicyAgent")
-            except:
-                self.solid_session = None
+'''
+Keeps the computer from suspending while printing.
 
+The backend is picked by platform: D-Bus on Linux, SetThreadExecutionState
+on Windows and a no-op everywhere else. Nothing is imported or opened
+before the first call, and a backend which isn't available (eg. no dbus
+module or no session bus on a headless box) quietly does nothing.
+'''
+
+import sys
+
+class NoPowerManagement():
+    """Backend which doesn't inhibit anything, eg. on unsupported platforms."""
+    def setSuspendInhibited(self, state):
+        return None
+
+    def hasSuspendInhibition(self):
+        return False
+
+    def isSuspendInhibited(self):
+        return False
+
+class DBusPowerManagement():
+    def __init__(self):
+        self.suspendInhibition = None
+        self.solid_session = None
+        self.dbus_session = None
+        self._connected = False
+
+    def _connect(self):
+        """Opens the session bus objects on first use, returns False if there is no session bus."""
+        if self._connected:
+            return self.dbus_session is not None
+        self._connected = True
+        try:
+            import dbus
+        except ImportError:
+            return False
+        try:
+            devobj = dbus.SessionBus().get_object('org.kde.kded',
+                                                  '/org/kde/Solid/PowerManagement/PolicyAgent')
+            self.solid_session = dbus.Interface (devobj,
+                                                 "org.kde.Solid.PowerManagement.PolicyAgent")
+        except Exception:
+            self.solid_session = None
+        try:
             self.dbus_session = dbus.SessionBus().get_object("org.freedesktop.PowerManagement",
                                                              "/org/freedesktop/PowerManagement/Inhibit")
+        except Exception:
+            self.dbus_session = None
+        return self.dbus_session is not None
+
+    def setSuspendInhibited(self, state):
+        if not self._connect():
+            return None
+        if state:
+            if self.solid_session:
+                self.suspendInhibition = self.solid_session.addInhibition(1, "Cura", "Test")
+            self.suspendInhibition = self.dbus_session.Inhibit("Cura", "Printing via USB")
+        else:
+            if self.solid_session:
+                return self.solid_session.ReleaseInhibition(self.suspendInhibition)
+            return self.dbus_session.UnInhibit(self.suspendInhibition)
+
+    def hasSuspendInhibition(self):
+        if not self._connect():
+            return False
+        return self.dbus_session.HasInhibit()
+
+    def isSuspendInhibited(self):
+        return bool(self.suspendInhibition)
+
+class WindowsPowerManagement():
+    def __init__(self):
+        self.suspendInhibition = False
+
+    def setSuspendInhibited(self, state):
+        """
+        Function used to prevent the computer from going into sleep mode.
+        :param prevent: True = Prevent the system from going to sleep from this point on.
+        :param prevent: False = No longer prevent the system from going to sleep.
+        """
+        import ctypes
+        ES_CONTINUOUS = 0x80000000
+        ES_SYSTEM_REQUIRED = 0x00000001
+        #SetThreadExecutionState returns 0 when failed, which is ignored. The function should be supported from windows XP and up.
+        if state:
+            ctypes.windll.kernel32.SetThreadExecutionState(ES_CONTINUOUS | ES_SYSTEM_REQUIRED) #@UndefinedVariable
+        else:
+            ctypes.windll.kernel32.SetThreadExecutionState(ES_CONTINUOUS) #@UndefinedVariable
+        self.suspendInhibition = state
+
+    def hasSuspendInhibition(self):
+        return self.suspendInhibition
+
+    def isSuspendInhibited(self):
+        return self.suspendInhibition
 
-        def setSuspendInhibited(self, state):
-            if state:
-                if self.solid_session:
-                    self.suspendInhibition = self.solid_session.addInhibition(1, "Cura", "Test")
-                self.suspendInhibition = self.dbus_session.Inhibit("Cura", "Printing via USB")
-            else:
-                if self.solid_session:
-                    return self.solid_session.ReleaseInhibition(self.suspendInhibition)
-                return self.dbus_session.UnInhibit(self.suspendInhibition)
-
-        def hasSuspendInhibition(self):
-            return self.dbus_session.HasInhibit()
-
-        def isSuspendInhibited(self):
-            return bool(self.suspendInhibition)
-
-elif Platform.isWindows():
-    import ctypes
-
-    class PowerManagement():
-        def __init__(self):
-            print(dir(ctypes.windll.kernel32))
-
-        def setSuspendInhibited(self, state):
-            """
-            Function used to prevent the computer from going into sleep mode.
-            :param prevent: True = Prevent the system from going to sleep from this point on.
-            :param prevent: False = No longer prevent the system from going to sleep.
-            """
-            ES_CONTINUOUS = 0x80000000
-            ES_SYSTEM_REQUIRED = 0x00000001
-            #SetThreadExecutionState returns 0 when failed, which is ignored. The function should be supported from windows XP and up.
-            if state:
-                ctypes.windll.kernel32.SetThreadExecutionState(ES_CONTINUOUS | ES_SYSTEM_REQUIRED) #@UndefinedVariable
-            else:
-                ctypes.windll.kernel32.SetThreadExecutionState(ES_CONTINUOUS) #@UndefinedVariable
+if sys.platform.startswith("linux"):
+    PowerManagement = DBusPowerManagement
+elif sys.platform == "win32":
+    PowerManagement = WindowsPowerManagement
 else:
-    raise ImportError("Your OS is currently not supported!")
+    PowerManagement = NoPowerManagement
 
 if __name__ == "__main__":
     pm = PowerManagement()
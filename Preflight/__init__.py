@@ -0,0 +1,243 @@
+'''
+Preflight analysis: streaming a job directly or uploading it to the SD card.
+
+Streamed, every move has to arrive before the planner runs dry. A job of
+tiny segments needs more lines per second than a link with a long round
+trip carries, and the printer stalls. Uploaded, the job prints from the
+SD card at full speed, but only after the whole file went over the link.
+
+LinkDemand adds up the job in blocks of BLOCK_LINES sent lines, about what
+the planner buffers: lines, bytes and estimated print time per block. It
+gets the moves in the pass of JobAnalysis.estimateJob(). LinkProfile is
+what the link carries, from the measured round trips, the send window,
+the bandwidth limits and the rates of earlier uploads (see
+StreamingEngine.getLinkProfile). analyze() simulates streaming the blocks
+through the planner buffer and compares the job time with uploading first:
+
+    demand = LinkDemand()
+    JobAnalysis.estimateJob(lines, demand = demand)
+    report = analyze(demand, engine.getLinkProfile())
+    report.mode # MODE_DIRECT or MODE_SD
+'''
+
+import collections
+
+import numpy
+
+from .. import JobAnalysis
+
+MODE_DIRECT = "direct"
+MODE_SD = "sd"
+
+BLOCK_LINES = 16 # lines, Marlin's BLOCK_BUFFER_SIZE
+BUFFERED_BLOCKS = 1 # blocks which may wait in the firmware while one is printed
+RTT_PERCENTILE = 5 # of the recent round trips, the longer ones include waiting for room in the planner
+UPLOAD_COMMANDS = 5 # round trips around an upload: M21, M28, M29, M23 and M24
+MIN_GAIN = 30. # s an upload has to save at least
+MIN_GAIN_SHARE = 0.05 # of the job time of streaming, if that's more
+TOP = 10 # stalled segments in the report
+
+class LinkDemand():
+    """Lines, bytes and print time of a job per block of block_lines sent lines."""
+    def __init__(self, block_lines = BLOCK_LINES):
+        self.block_lines = block_lines
+        self.lines = 0 # sent lines, comments and empty lines aren't sent
+        self.starts = [] # index of the first line of every block in the job
+        self.counts = []
+        self.sizes = [] # bytes
+        self.times = [] # s
+
+    ##  Adds the estimated durations of moves (see JobAnalysis.extractMoves) starting at line offset of the job.
+    def addMoves(self, moves, durations, offset):
+        if not moves.count:
+            return
+        sent = moves.opcode != 0
+        before = numpy.cumsum(sent) - sent + self.lines
+        block = before // self.block_lines
+        first = int(block[0])
+        relative = block - first
+        counts = numpy.bincount(relative, weights = sent).tolist()
+        sizes = numpy.bincount(relative, weights = numpy.where(sent, moves.lengths, 0)).tolist()
+        times = numpy.bincount(relative, weights = durations).tolist()
+        starts = (numpy.flatnonzero(numpy.diff(relative, prepend = -1)) + offset).tolist()
+        if self.starts and first == len(self.starts) - 1:
+            # The last block goes on in this chunk
+            self.counts[-1] += counts.pop(0)
+            self.sizes[-1] += sizes.pop(0)
+            self.times[-1] += times.pop(0)
+            starts.pop(0)
+        self.starts += starts
+        self.counts += counts
+        self.sizes += sizes
+        self.times += times
+        self.lines += int(numpy.count_nonzero(sent))
+
+    def getSize(self):
+        return sum(self.sizes)
+
+    def getPrintTime(self):
+        return sum(self.times)
+
+    def requiredRates(self):
+        """Lines/s the planner needs per block to keep moving."""
+        counts = numpy.array(self.counts)
+        times = numpy.array(self.times)
+        return numpy.where(times > 0., counts / numpy.maximum(times, 1e-9), numpy.inf)
+
+def measureDemand(lines, block_lines = BLOCK_LINES):
+    """LinkDemand of an iterable of lines in a pass of its own, eg. when the estimate was cached."""
+    demand = LinkDemand(block_lines)
+    JobAnalysis.estimateJob(lines, stride = 1024, demand = demand)
+    return demand
+
+class LinkProfile():
+    """What the link to a printer carries, None for what isn't known or limited."""
+    def __init__(self, rtt, window = 1, byte_rate = None, upload_rate = None):
+        self.rtt = max(rtt, 1e-4) # s for a line to be acknowledged
+        self.window = max(window, 1) # lines waiting for their "ok" at the same time
+        self.byte_rate = byte_rate # bytes/s
+        self.upload_rate = upload_rate # lines/s of earlier uploads
+
+    @classmethod
+    def fromMetrics(cls, metrics, window = 1, byte_rate = None):
+        """Profile from Metrics.LinkMetrics, None as long as no line was acknowledged."""
+        # The raw samples, the histogram's buckets are too coarse for this
+        samples = sorted(metrics.rtt.recent())
+        if not samples:
+            return None
+        rtt = samples[len(samples) * RTT_PERCENTILE // 100]
+        uploads = sorted(metrics.upload_rate.recent(8))
+        upload_rate = uploads[len(uploads) // 2] if uploads else None
+        return cls(rtt, window, byte_rate, upload_rate)
+
+    def streamRate(self):
+        """Lines/s the link carries while streaming, without a byte limit."""
+        return self.window / self.rtt
+
+    def linkTimes(self, counts, sizes):
+        """s the link needs for lines of counts and sizes (arrays) while streaming."""
+        times = numpy.asarray(counts, float) * self.rtt / self.window
+        if self.byte_rate:
+            times = numpy.maximum(times, numpy.asarray(sizes, float) / self.byte_rate)
+        return times
+
+    def uploadTime(self, lines, size):
+        if self.upload_rate:
+            upload_time = lines / self.upload_rate
+            if self.byte_rate:
+                upload_time = max(upload_time, size / self.byte_rate)
+        else:
+            # Written line by line like streaming, but never waiting for the planner
+            upload_time = float(self.linkTimes([lines], [size])[0])
+        return upload_time + UPLOAD_COMMANDS * self.rtt
+
+class Segment():
+    """Consecutive blocks which stall the planner, first_line and last_line being indexes in the job."""
+    def __init__(self, first_line, last_line, lines, print_time, stall):
+        self.first_line = first_line
+        self.last_line = last_line
+        self.lines = lines
+        self.print_time = print_time
+        self.stall = stall
+
+    def requiredRate(self):
+        return self.lines / self.print_time if self.print_time > 0. else float("inf")
+
+class PreflightReport():
+    def __init__(self, mode, reason, print_time, stall_time = 0., upload_time = None, lines = 0, size = 0,
+                 segments = (), peak_rate = None, link = None):
+        self.mode = mode # MODE_DIRECT or MODE_SD
+        self.reason = reason
+        self.print_time = print_time # s
+        self.stall_time = stall_time # s the printer waits for lines when streaming
+        self.upload_time = upload_time # s, None without SD card
+        self.lines = lines
+        self.size = size
+        self.segments = list(segments) # Segment, the longest stalls first
+        self.peak_rate = peak_rate # lines/s the job needs at most, over a tenth of its print time
+        self.link = link
+
+    def getDirectTime(self):
+        return self.print_time + self.stall_time
+
+    def getSDTime(self):
+        if self.upload_time is None:
+            return None
+        return self.upload_time + self.print_time
+
+    def getSummary(self):
+        summary = "%s: %s. Streaming %.0f s (%.0f s stalled)" %(self.mode, self.reason, self.getDirectTime(), self.stall_time)
+        if self.upload_time is not None:
+            summary += ", SD card %.0f s (%.0f s upload)" %(self.getSDTime(), self.upload_time)
+        if self.link is not None:
+            summary += ", link %.1f lines/s" %self.link.streamRate()
+        if self.peak_rate is not None:
+            summary += ", job up to %.1f lines/s" %self.peak_rate
+        return summary
+
+def simulateStreaming(link_times, print_times, buffered = BUFFERED_BLOCKS):
+    """Stall in s per block: a block goes over the link once the planner has room for it, moves once it arrived."""
+    stalls = []
+    delivered = 0.
+    finished = 0.
+    # Finish times of the blocks in the firmware, the oldest frees the room for the next block
+    previous = collections.deque([0.] * (buffered + 1), maxlen = buffered + 1)
+    for link_time, print_time in zip(link_times, print_times):
+        delivered = max(delivered, previous[0]) + link_time
+        planned = finished + print_time
+        finished = max(planned, delivered)
+        stalls.append(finished - planned)
+        previous.append(finished)
+    return stalls
+
+def _segments(demand, stalls):
+    segments = []
+    current = None
+    for index, stall in enumerate(stalls):
+        if stall <= 0.:
+            current = None
+            continue
+        if current is None:
+            current = Segment(demand.starts[index], demand.starts[index], 0, 0., 0.)
+            segments.append(current)
+        current.last_line = demand.starts[index + 1] - 1 if index + 1 < len(demand.starts) else demand.starts[index]
+        current.lines += int(demand.counts[index])
+        current.print_time += demand.times[index]
+        current.stall += stall
+    segments.sort(key = lambda segment: segment.stall, reverse = True)
+    return segments[:TOP]
+
+def _peakRate(demand):
+    """Highest rate the job needs over at least a tenth of its print time."""
+    rates = demand.requiredRates()
+    if not len(rates):
+        return None
+    order = numpy.argsort(rates)[::-1]
+    covered = numpy.cumsum(numpy.array(demand.times)[order])
+    enough = numpy.searchsorted(covered, 0.1 * covered[-1])
+    return float(rates[order[min(enough, len(order) - 1)]])
+
+def analyze(demand, link, sd_available = True):
+    """PreflightReport of a LinkDemand over a LinkProfile (None: not measured yet, streams)."""
+    print_time = demand.getPrintTime()
+    size = demand.getSize()
+    peak_rate = _peakRate(demand)
+    if link is None:
+        return PreflightReport(MODE_DIRECT, "the link wasn't measured yet", print_time,
+                               lines = demand.lines, size = size, peak_rate = peak_rate)
+    stalls = simulateStreaming(link.linkTimes(demand.counts, demand.sizes).tolist(), demand.times)
+    stall_time = sum(stalls)
+    segments = _segments(demand, stalls)
+    upload_time = link.uploadTime(demand.lines, size) if sd_available else None
+    report = PreflightReport(MODE_DIRECT, "", print_time, stall_time, upload_time, demand.lines, size,
+                             segments, peak_rate, link)
+    if upload_time is None:
+        report.reason = "the printer has no SD card"
+    elif report.getSDTime() < report.getDirectTime() - max(MIN_GAIN, MIN_GAIN_SHARE * report.getDirectTime()):
+        report.mode = MODE_SD
+        report.reason = "uploading saves %.0f s of stalls" %(report.getDirectTime() - report.getSDTime())
+    elif stall_time > 0.:
+        report.reason = "the stalls are shorter than the upload"
+    else:
+        report.reason = "the link keeps up with the job"
+    return report
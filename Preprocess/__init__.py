@@ -0,0 +1,344 @@
+'''
+Chunked preprocessing of G-code files on several cores.
+
+The file is split at line boundaries and every chunk is turned into an
+encoded buffer by a worker process: comments and whitespace stripped,
+optionally minified and dry run applied, the XOR checksum of every line
+precomputed. Workers return the buffer in shared memory, so the parent
+process doesn't copy or unpickle the encoded lines.
+
+Line numbers are the only state which crosses chunk boundaries. They are
+added while sending (Connection.ResendBuffer), where the checksum of
+"N<n> <line>" is the precomputed checksum of the line XORed with the
+checksum of the prefix.
+
+Layout of a chunk buffer, all integers little-endian uint64:
+
+    data | offsets (count + 1) | input line index (count) | input end offset (count) | checksums (count bytes)
+'''
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import struct
+
+from .. import GCodeLibrary
+from .. import JobSource
+from .. import LayerIndex
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, chunks are pickled instead
+    shared_memory = None
+
+END = JobSource.END
+
+CHUNK_SIZE = 4 * 1024 * 1024 # bytes
+FIRST_CHUNK_SIZE = 256 * 1024 # bytes, small for a short time to the first line
+
+class PreprocessSettings():
+    def __init__(self, dry_run = False, minify = False, flavor = None):
+        self.dry_run = dry_run
+        self.minify = minify
+        self.flavor = flavor # machine_gcode_flavor of the printer, None if unknown
+
+    def key(self):
+        return "dry_run=%d,minify=%d,flavor=%s" %(self.dry_run, self.minify, self.flavor)
+
+def _minifyNumber(word):
+    """b"X10.500" -> b"X10.5", b"E0.0" -> b"E0"."""
+    if b"." not in word:
+        return word
+    word = word.rstrip(b"0")
+    if word.endswith(b"."):
+        word = word[:-1]
+    if len(word) == 1:
+        # Letter only, the value was 0
+        word += b"0"
+    return word
+
+def transformLine(line, settings):
+    """Encoded line without comment and whitespace around it, None if nothing is left."""
+    comment = line.find(b";")
+    if comment != -1:
+        line = line[:comment]
+    line = line.strip()
+    if not line:
+        return None
+    if settings.dry_run:
+        line = GCodeLibrary.applyDryRun(line)
+    if settings.minify:
+        words = line.split()
+        line = b" ".join([words[0]] + [_minifyNumber(word) for word in words[1:]])
+    return line
+
+def splitFile(path, start_offset = 0, chunk_size = CHUNK_SIZE, first_chunk_size = FIRST_CHUNK_SIZE):
+    """(start, end) byte ranges of about chunk_size, ending behind a line break."""
+    size = os.path.getsize(path)
+    ranges = []
+    start = start_offset
+    with open(path, "rb") as gcode_file:
+        while start < size:
+            end = min(start + (first_chunk_size if not ranges else chunk_size), size)
+            if end < size:
+                gcode_file.seek(end)
+                gcode_file.readline()
+                end = gcode_file.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def _encodeChunk(data, start, settings):
+    """Returns (buffer in the layout above, count, input lines)."""
+    pieces = data.split(b"\n")
+    if data.endswith(b"\n"):
+        pieces.pop()
+    encoded = []
+    line_indexes = []
+    input_ends = []
+    checksums = bytearray()
+    position = start
+    checksum = GCodeLibrary.checksum
+    for index, piece in enumerate(pieces):
+        position += len(piece) + 1
+        line = transformLine(piece, settings)
+        if line is None:
+            continue
+        encoded.append(line)
+        line_indexes.append(index)
+        input_ends.append(position)
+        checksums.append(checksum(line))
+    count = len(encoded)
+    offsets = [0] * (count + 1)
+    total = 0
+    for index, line in enumerate(encoded):
+        total += len(line) + 1
+        offsets[index + 1] = total
+    if encoded:
+        encoded.append(b"")
+    buffer = b"\n".join(encoded)
+    end = start + len(data)
+    # The last line may miss its line break
+    input_ends = [min(value, end) for value in input_ends]
+    arrays = struct.pack("<%dQ" %(3 * count + 1), *(offsets + line_indexes + input_ends))
+    return buffer + arrays + bytes(checksums), len(buffer), count, len(pieces)
+
+def _processChunk(path, start, end, settings, use_shared_memory):
+    """Worker: encodes a chunk of the file, returns where to find it."""
+    with open(path, "rb") as gcode_file:
+        gcode_file.seek(start)
+        data = gcode_file.read(end - start)
+    buffer, data_size, count, input_lines = _encodeChunk(data, start, settings)
+    if not use_shared_memory:
+        return buffer, data_size, count, input_lines
+    block = shared_memory.SharedMemory(create = True, size = max(len(buffer), 1))
+    block.buf[:len(buffer)] = buffer
+    name = block.name
+    _untrack(block)
+    block.close()
+    return name, data_size, count, input_lines
+
+def _untrack(block):
+    """The receiving process owns the block, it must survive this one."""
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, "shared_memory")
+    except (ImportError, AttributeError, KeyError):
+        pass
+
+# Chunks of closed sources which were still in use
+_unclosed = []
+
+class EncodedChunk():
+    """Lines of a buffer in the layout above, lines[i] being the input lines start to end."""
+    def __init__(self, buffer, data_size, count, input_lines, start, end, block = None):
+        self.start = start
+        self.end = end
+        self.count = count
+        self.input_lines = input_lines
+        self._block = block # shared memory or mapping owning the buffer, closed with the chunk
+        self.data = buffer[:data_size]
+        arrays = buffer[data_size:data_size + 8 * (3 * count + 1)].cast("Q")
+        self.offsets = arrays[:count + 1]
+        self.line_indexes = arrays[count + 1:2 * count + 1]
+        self.input_ends = arrays[2 * count + 1:]
+        self.checksums = buffer[data_size + 8 * (3 * count + 1):data_size + 8 * (3 * count + 1) + count]
+        self._views = (self.data, arrays, self.offsets, self.line_indexes, self.input_ends, self.checksums, buffer)
+
+    @classmethod
+    def fromResult(cls, result, start, end):
+        """Chunk of what _processChunk returned."""
+        source, data_size, count, input_lines = result
+        if type(source) is str:
+            block = shared_memory.SharedMemory(name = source)
+            # Gone from the namespace right away, the mapping stays until closed
+            block.unlink()
+            return cls(block.buf, data_size, count, input_lines, start, end, block)
+        return cls(memoryview(source), data_size, count, input_lines, start, end)
+
+    def line(self, index):
+        return GCodeLibrary.EncodedLine(self.data[self.offsets[index]:self.offsets[index + 1] - 1], self.checksums[index])
+
+    def close(self):
+        """Returns False while lines of the chunk are still referenced."""
+        if self._block is None:
+            return True
+        try:
+            for view in self._views:
+                view.release()
+            self._block.close()
+        except BufferError:
+            return False
+        self._block = None
+        return True
+
+# Packages whose functions run in worker processes, none of them imports Uranium or Qt
+WORKER_MODULES = ("Preprocess", "JobCache")
+
+def _context():
+    """Multiprocessing context of the worker processes, which never forks Cura itself.
+
+    A forked Cura would take the locks of Qt and of its other threads along,
+    held by threads which don't exist in the worker. The fork server is a
+    fresh interpreter which only imports WORKER_MODULES and forks the
+    workers from itself, elsewhere (Windows) they are spawned. Either way
+    every worker runs the main module of the application again as
+    "__mp_main__", so workers are only started if the user configured some.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        package = __name__.rpartition(".")[0]
+        context.set_forkserver_preload([package + "." + name for name in WORKER_MODULES])
+        return context
+    return multiprocessing.get_context("spawn")
+
+def encodeChunks(path, start_offset = 0, settings = None, workers = 0, chunk_size = CHUNK_SIZE, lookahead = None):
+    """Yields the EncodedChunks of a file in order.
+
+    workers = 0 encodes in this process. Otherwise at most lookahead chunks
+    are processed ahead of the consumer, bounding the memory use.
+    """
+    settings = settings or PreprocessSettings()
+    ranges = splitFile(path, start_offset, chunk_size)
+    if not workers:
+        for start, end in ranges:
+            yield EncodedChunk.fromResult(_processChunk(path, start, end, settings, False), start, end)
+        return
+    use_shared_memory = shared_memory is not None
+    lookahead = lookahead or 2 * workers
+    executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context = _context())
+    pending = collections.deque()
+    try:
+        remaining = iter(ranges)
+        for start, end in remaining:
+            pending.append((executor.submit(_processChunk, path, start, end, settings, use_shared_memory), start, end))
+            if len(pending) >= lookahead:
+                break
+        while pending:
+            future, start, end = pending.popleft()
+            chunk = EncodedChunk.fromResult(future.result(), start, end)
+            for start, end in remaining:
+                pending.append((executor.submit(_processChunk, path, start, end, settings, use_shared_memory), start, end))
+                break
+            yield chunk
+    finally:
+        for future, start, end in pending:
+            if future.cancel():
+                continue
+            try:
+                EncodedChunk.fromResult(future.result(), start, end).close()
+            except Exception:
+                pass
+        executor.shutdown(wait = False)
+
+class PreprocessedJobSource(JobSource.FileJobSource):
+    """FileJobSource handing out lines of encoded chunks instead of parsing them one by one.
+
+    Input lines without a command still count as None items, so line
+    counts, estimates and the journal see the same numbers as for
+    FileJobSource.
+    """
+    def __init__(self, path, start_offset = 0, prelude = (), settings = None, workers = 0, chunk_size = CHUNK_SIZE):
+        JobSource.FileJobSource.__init__(self, path, start_offset, prelude)
+        self.settings = settings or PreprocessSettings()
+        self._chunks = encodeChunks(path, start_offset, self.settings, workers, chunk_size)
+        self._chunk = None
+        self._index = 0 # next encoded line of the chunk
+        self._input_line = 0 # next input line of the chunk
+        self._retired = []
+
+    def _closeRetired(self):
+        self._retired = [chunk for chunk in self._retired if not chunk.close()]
+
+    def _nextChunk(self):
+        if self._chunk is not None:
+            self.position = self._chunk.end
+            self._retired.append(self._chunk)
+        self._closeRetired()
+        self._chunk = next(self._chunks, None)
+        self._index = self._input_line = 0
+        return self._chunk
+
+    def next(self):
+        if self.prelude:
+            return GCodeLibrary.identifyLine(self.prelude.popleft())
+        chunk = self._chunk
+        while True:
+            if chunk is None:
+                chunk = self._nextChunk()
+                if chunk is None:
+                    return END
+            if self._index < chunk.count:
+                index = self._index
+                self._input_line += 1
+                if self._input_line <= chunk.line_indexes[index]:
+                    return None
+                self._index += 1
+                self.position = chunk.input_ends[index]
+                return chunk.line(index)
+            if self._input_line < chunk.input_lines:
+                self._input_line += 1
+                return None
+            chunk = self._nextChunk()
+            if chunk is None:
+                return END
+
+    def close(self):
+        self._chunks.close()
+        if self._chunk is not None:
+            self._retired.append(self._chunk)
+            self._chunk = None
+        self._closeRetired()
+        # Lines still waiting for their "ok" keep their chunk, it is closed with the next job
+        _unclosed.extend(self._retired)
+        _unclosed[:] = [chunk for chunk in _unclosed if not chunk.close()]
+        self._retired = []
+        JobSource.FileJobSource.close(self)
+
+def openFile(path, start_layer = None, settings = None, workers = 0):
+    """PreprocessedJobSource for a file, seeking to a layer like JobSource.openFile."""
+    if start_layer is None:
+        return PreprocessedJobSource(path, settings = settings, workers = workers)
+    index = LayerIndex.LayerIndex.forFile(path)
+    return PreprocessedJobSource(path, index.getOffset(start_layer), index.resumeCommands(start_layer), settings, workers)
+
+def spoolData(lines):
+    """Yields the bytes spoolLines() writes for the lines."""
+    for entry in lines:
+        if entry and not entry.endswith("\n"):
+            entry += "\n"
+        yield entry.encode("utf-8")
+
+def spoolLines(lines, path):
+    """Writes lines (eg. Cura's gcode_list) to a file, so it can be streamed like one."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as spool_file:
+        for data in spoolData(lines):
+            spool_file.write(data)
+    os.replace(temporary, path)
+    return path
@@ -0,0 +1,234 @@
+'''
+On-demand profiling of the print pipeline.
+
+A JobProfile runs along with one job while profiling is switched on (see
+StreamingEngine.setProfiling and StreamingEngine.profileNextJob) and writes
+a JSON report when the job is done:
+
+- "threads": a sampling profile of every thread of the process, also the
+  QThreads of the device and Zeroconf's. Every interval seconds the stack
+  of each thread is taken. "cpu" counts the seconds of the samples in which
+  the thread was running (or ready to run), so threads waiting for the
+  printer don't count. Where the platform doesn't tell (only Linux does),
+  every sample counts. "stacks" are folded like for flame graphs.
+- "memory": tracemalloc snapshots at the start of the fill, at the peak and
+  at the end of the job, with the lines which allocated the most.
+- "spans": wall time spent in the send loop per step: parse (taking lines
+  from the queue), encode (line numbers and checksums), send (writing) and
+  wait (for "ok"s or lines).
+
+Switched off, the send loop only checks for the profile being None.
+'''
+
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from .. import Journal
+from ..Log import Logger
+
+SAMPLE_INTERVAL = 0.005 # s
+MAX_DEPTH = 64 # frames per sampled stack
+TOP = 30 # entries per table of the report
+PEAK_GROWTH = 1.1 # traced memory grew by this factor since the last snapshot: new peak snapshot
+
+REPORT_SUFFIX = ".profile.json"
+
+def profilePath(directory, name):
+    """Report file of a job of printer name started now."""
+    return os.path.join(directory, "%s-%s%s" %(Journal.safeName(name), time.strftime("%Y%m%d-%H%M%S"), REPORT_SUFFIX))
+
+def runningThreads():
+    """Native ids of the threads of this process which run or are ready to, None where the platform doesn't tell."""
+    try:
+        tasks = os.listdir("/proc/self/task")
+    except OSError:
+        return None
+    running = set()
+    for task in tasks:
+        try:
+            with open("/proc/self/task/%s/stat" %task, "rb") as stat_file:
+                # The state follows the name in parentheses, which may contain spaces
+                if stat_file.read().rpartition(b")")[2][1:2] == b"R":
+                    running.add(int(task))
+        except OSError:
+            continue
+    return running
+
+def _functionName(code):
+    return "%s (%s:%d)" %(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+class ThreadSampler():
+    """Takes the stacks of all threads but its own, see the module's description."""
+    def __init__(self, interval = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.threads = {} # name: {stack of code objects, outermost first: [samples, CPU s]}
+        self._names = {} # ident: name, kept for threads which are gone at the end
+
+    def sample(self):
+        own = threading.get_ident()
+        known = {thread.ident: thread for thread in threading.enumerate()}
+        running = runningThreads()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while not frame is None and len(stack) < MAX_DEPTH:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if not stack:
+                continue
+            stack.reverse()
+            name = self._names.get(ident)
+            if name is None:
+                thread = known.get(ident)
+                if thread is not None and not isinstance(thread, threading._DummyThread):
+                    name = thread.name
+                else:
+                    # Started outside of threading, eg. a QThread: named by what it runs
+                    name = "%s [%x]" %(stack[0].co_name, ident)
+                self._names[ident] = name
+            cpu = self.interval
+            if running is not None and not getattr(known.get(ident), "native_id", None) in running:
+                cpu = 0.
+            stacks = self.threads.setdefault(name, {})
+            entry = stacks.get(tuple(stack))
+            if entry is None:
+                stacks[tuple(stack)] = [1, cpu]
+            else:
+                entry[0] += 1
+                entry[1] += cpu
+        self.samples += 1
+
+    def report(self):
+        threads = {}
+        for name, stacks in self.threads.items():
+            samples = sum(entry[0] for entry in stacks.values())
+            cpu = sum(entry[1] for entry in stacks.values())
+            functions = {} # code: [self samples, total samples, self CPU s, total CPU s]
+            for stack, (count, time_used) in stacks.items():
+                for code in set(stack):
+                    function = functions.setdefault(code, [0, 0, 0., 0.])
+                    function[1] += count
+                    function[3] += time_used
+                function = functions[stack[-1]]
+                function[0] += count
+                function[2] += time_used
+            folded = {} # "outer;inner": [samples, CPU s], names only
+            for stack, (count, time_used) in stacks.items():
+                entry = folded.setdefault(";".join(code.co_name for code in stack), [0, 0.])
+                entry[0] += count
+                entry[1] += time_used
+            ranked = sorted(functions.items(), key = lambda item: (item[1][2], item[1][0]), reverse = True)
+            folded = sorted(folded.items(), key = lambda item: (item[1][1], item[1][0]), reverse = True)
+            threads[name] = {"samples": samples,
+                             "cpu": cpu,
+                             "functions": [{"function": _functionName(code),
+                                            "self_samples": values[0],
+                                            "total_samples": values[1],
+                                            "self_cpu": values[2],
+                                            "total_cpu": values[3],
+                                            } for code, values in ranked[:TOP]],
+                             "stacks": dict(folded[:TOP]),
+                             }
+        return threads
+
+class JobProfile():
+    """Profile of one job, started with start() and written to path by finish()."""
+    def __init__(self, name, path, interval = SAMPLE_INTERVAL, memory = True):
+        self.name = name
+        self.path = path
+        self.memory = memory
+        self.sampler = ThreadSampler(interval)
+        self.spans = {} # name: [count, total s, longest s]
+        self.snapshots = [] # dicts, see snapshotMemory()
+        self.started = None
+        self._started_tracing = False
+        self._peak_size = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.monotonic()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.snapshotMemory("fill start")
+        self._thread = threading.Thread(target = self._run, name = "profiler %s" %self.name, daemon = True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.sampler.interval):
+            self.sampler.sample()
+            if self.memory and tracemalloc.is_tracing() and tracemalloc.get_traced_memory()[0] > self._peak_size * PEAK_GROWTH:
+                self.snapshotMemory("peak")
+
+    ##  Adds the wall time of one step, eg. "send". Not locked, the steps of a job don't run at the same time.
+    def addSpan(self, name, seconds):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [1, seconds, seconds]
+            return
+        span[0] += 1
+        span[1] += seconds
+        if seconds > span[2]:
+            span[2] = seconds
+
+    def snapshotMemory(self, label):
+        """Adds a tracemalloc snapshot, a "peak" replaces the one before."""
+        if not tracemalloc.is_tracing():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        statistics = snapshot.statistics("lineno")
+        entry = {"label": label,
+                 "time": time.monotonic() - self.started,
+                 "current": current,
+                 "peak": peak,
+                 "top": [{"line": "%s:%s" %(statistic.traceback[0].filename, statistic.traceback[0].lineno),
+                          "size": statistic.size,
+                          "count": statistic.count,
+                          } for statistic in statistics[:TOP]],
+                 }
+        self._peak_size = max(self._peak_size, current)
+        if label == "peak":
+            self.snapshots = [other for other in self.snapshots if other["label"] != "peak"]
+        self.snapshots.append(entry)
+
+    def report(self, outcome, details = None):
+        elapsed = time.monotonic() - self.started
+        return {"printer": self.name,
+                "outcome": outcome,
+                "elapsed": elapsed,
+                "interval": self.sampler.interval,
+                "samples": self.sampler.samples,
+                "spans": {name: {"count": count, "total": total, "mean": total / count, "max": longest}
+                          for name, (count, total, longest) in self.spans.items()},
+                "threads": self.sampler.report(),
+                "memory": self.snapshots,
+                "details": details or {},
+                }
+
+    ##  Stops sampling and writes the report, returns its path (None if it couldn't be written).
+    def finish(self, outcome = "done", details = None):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.snapshotMemory("end")
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            with open(self.path, "w") as report_file:
+                json.dump(self.report(outcome, details), report_file, indent = 2)
+        except OSError:
+            Logger.logException("w", "Could not write the profile to %s!", self.path)
+            return None
+        Logger.log("i", "Wrote the profile of %s to %s", self.name, self.path)
+        return self.path
@@ -3,114 +3,145 @@
 
 from UM.i18n import i18nCatalog
 from UM.Application import Application
+from UM.Backend.Backend import BackendState
 from UM.Logger import Logger
 from UM.Signal import signalemitter
 
 from UM.Message import Message
+from UM.Resources import Resources
 
 from cura.PrinterOutputDevice import PrinterOutputDevice, ConnectionState
 
-from PyQt5.QtCore import QUrl, QTimer, QThread, pyqtSignal, pyqtProperty, pyqtSlot, QCoreApplication #@UnresolvedImport
-from PyQt5.QtWidgets import QMessageBox #@UnresolvedImport
+from PyQt5.QtCore import QTimer, QThread, pyqtSignal, pyqtProperty #@UnresolvedImport
 
+import os
 import time
-import socket
-import queue
-import collections
+import threading
+import weakref
 
+from . import Capabilities
 from . import GCodeLibrary
+from . import JobAnalysis
+from . import JobCache
+from . import JobValidation
+from . import Journal
+from . import JobSource
+from . import Preflight
+from . import Preprocess
+from . import Speculation
+from . import StreamingEngine
+from . import Trace
+from . import UpdateAggregator
 
 i18n_catalog = i18nCatalog("cura")
 
-class WifiConnectionFactory():
-    connection = None
-    buffer = ""
+_publish_timer = None
+
+def _startPublishing():
+    """Publishes the coalesced updates of all devices from Qt's thread, see UpdateAggregator."""
+    global _publish_timer
+    if _publish_timer is None:
+        aggregator = UpdateAggregator.getAggregator()
+        _publish_timer = QTimer()
+        _publish_timer.setInterval(int(aggregator.interval * 1000))
+        _publish_timer.timeout.connect(aggregator.flush)
+        _publish_timer.start()
+
+_speculating_devices = weakref.WeakSet()
+_speculation_connected = False
+
+def _startSpeculating(device):
+    """Preprocesses every slice result in the background for device, see Speculation."""
+    global _speculation_connected
+    if not _speculation_connected:
+        backend = Application.getInstance().getBackend()
+        if backend is None or not hasattr(backend, "backendStateChange"):
+            return
+        backend.backendStateChange.connect(_onBackendStateChange)
+        _speculation_connected = True
+    _speculating_devices.add(device)
+
+def _onBackendStateChange(state):
+    speculator = Speculation.getSpeculator()
+    if state != BackendState.Done:
+        # Slicing again or not at all, what was preprocessed is stale
+        speculator.invalidate()
+        return
+    gcode_list = getattr(Application.getInstance().getController().getScene(), "gcode_list", None)
+    if not gcode_list:
+        return
+    # Devices sharing the cache and the settings share the job
+    targets = {}
+    for device in list(_speculating_devices):
+        target = device._speculationTarget()
+        if target is not None:
+            targets.setdefault((target[0].directory, target[1].key()), target)
+    if targets:
+        speculator.sliced(gcode_list, targets.values())
+
+class SerialOutputDevice(PrinterOutputDevice, StreamingEngine.StreamingEngine):
+    metricsChanged = pyqtSignal()
 
-    def isConnected(self):
-        return bool(self.connection)
-    
-    def connect(self, ip, port):
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connection.connect((ip, port),)
-        self.connection.setblocking(0)
-        #print("FAMILY: ", self.connection.family)
-        #print("PROTO: ", self.connection.proto)
-        #print("TYPE: ", self.connection.type)
-        return self.connection
-            
-    def disconnect(self):
-        self.connection.close()
-        self.connection = None
-        
-    def send(self, data):
-        #Logger.log("e", "Sending: %s", data)
-        #if type(data) == str:
-        #    data = data.encode("utf-8")
-        if not type(data) is bytes:
-            data = bytes(data)
-        
-        if b'\n' not in data:
-            data += b'\n'
-        
-        try:
-            self.connection.send(data)
-            return True
-        except Exception:
-            Logger.logException("e", "An exception occured while sending data!")
-            self.connection = None
-            return False
-    
-    def receive(self):
-        try:
-            return self.connection.recv(1).decode("utf-8")
-        except BlockingIOError:
-            return None
-        except Exception:
-            Logger.logException("e", "An exception occured while receiving data!")
-            self.connection = None
-            return None
-    
-    def receiveLine(self):
-        data = self.receive()
-        if data:
-            self.buffer += data
-        
-        if "\n" in self.buffer:
-            line = self.buffer[:self.buffer.find("\n")]
-            self.buffer = self.buffer[self.buffer.find("\n")+1:]
-            return line
+    _temp_file_name = "temp.gco"
+    _sd_card_slot = 0
 
-class SerialOutputDevice(PrinterOutputDevice):
     def __init__(self, name):
         super().__init__(name)
         self.setName(name)
         self.setIconName("print")
 
-        self.serial_connection = None
-        self.serial_connector = None
-        
-        # Send and receive
-        self._sent_lines_since_injected = 0
-        self._sent_command = None
-        self._sent_command_time = None
-        self._send_timeout = 10 # s
-        self._send_injected_every = 4 # lines
-        self._send_is_blocked = False
-        self._send_is_blocked_since = None
-        self._receive_mode = "normal"
-
-        # Cached status
-        self._sd_card_status = None
+        # Send and receive loops, line numbers, flow control and capabilities
+        StreamingEngine.StreamingEngine.__init__(self, name)
+        self._metrics_summary = {}
+
+        # State changes of the worker threads reach the UI once per frame
+        self._progress_interval = UpdateAggregator.INTERVAL # s
+        _startPublishing()
+
+        # Progress by estimated print time
+        self._job_file = None
+        self._job_start_layer = None
+        self._job_lines = None
+
+        # Journal of the streamed job file, for resuming after crashes
+        self._journal_enabled = True
+        self._journal_interval = 1. # s between checkpoints
+        self._job_resume = None # Journal.JournalState of the job to continue
+
+        # Preprocessing of job files on several cores, 0 workers reads them line by line
+        self._preprocess_workers = 0
+        # Dry run like the send loop applies it (see _nextBatch)
+        self._preprocess_settings = Preprocess.PreprocessSettings(dry_run = self._dry_run)
+
+        # Encoded jobs kept on disk across jobs, 0 bytes disables the cache (see setJobCache)
+        self._job_cache = None
+        self._job_cache_size = 0
+        self._job_cache_entry = None # JobCache.CacheEntry the job is read from
+        self._job_cache_key = None # key to store the job under, once it is estimated
+        self._job_cached_estimate = None
+        self._job_cached_demand = None
+        self._resume_message = None
+
+        # Preprocessing slice results into the cache before printing them, see Speculation
+        self._speculation_enabled = False
+
+        # Offline validation of jobs, in the pass of the estimate
+        self._validation = "warn" # "off", "warn" or "reject", which checks before sending anything
+        self._validation_limits = None # JobValidation.ValidationLimits, None takes the machine settings
+        self._job_report = None # JobValidation.ValidationReport of the last job
+        self._job_analyzed = False
+        self._validation_message = None
+
+        # Streaming jobs or uploading them to the SD card first, see setModeSelection()
+        self._mode_selection = Preflight.MODE_DIRECT
+        self._job_mode = Preflight.MODE_DIRECT # of the current job
+        self._job_demand = None # Preflight.LinkDemand, measured in the pass of the estimate
+        self._preflight_report = None
+        self._preflight_message = None
+        self._sd_printing = False
+        self._sd_printing_seen = False
+        self._sd_status_command = None
 
-        # Queues
-        #self.queue_gcode = queue.Queue()
-        self.queue_gcode = collections.deque()
-        self.queue_gcode_size = None
-        self.queue_gcode_begin = None
-        self.queue_injected = queue.Queue()
-        self.queue_frequently = []
-        self.queue_frequently_last = None
-        
         # Connect thread
         self._connect_thread = QThread()
         self._connect_thread.run = self._connect
@@ -152,12 +183,26 @@ class SerialOutputDevice(PrinterOutputDevice):
         Logger.log("d", "Connection with printer %s with ip %s stopped", self._key, self._address)
         self.serial_connection.disconnect()
         self.serial_connection = None
+        self._closeJournal()
+        self._releaseBandwidth()
         self.setConnectionState(ConnectionState.closed)
         self.close()
 
     def connect(self):
         if not self._connect_thread.isRunning():
             self._connect_thread.start()
+        if not self._update_timer.isActive():
+            self._update_timer.start()
+
+    ##  Replaces the link to the printer with a recorded trace. speed = None replays without delays.
+    def replayTrace(self, path, speed = 1.):
+        self.serial_connector = Trace.createReplayConnector(path, speed)
+        self.connect()
+
+    ##  Summary of counters and histograms as plain dict, eg. for QML.
+    @pyqtProperty("QVariantMap", notify = metricsChanged)
+    def metrics(self):
+        return self._metrics_summary
     
     def _connect(self):
         if self.serial_connector is None:
@@ -171,97 +216,55 @@ class SerialOutputDevice(PrinterOutputDevice):
         Logger.log("e", "Starting connection with %s at %s:%s" %(self.getName(), self.getAddressIp(), self.getAddressPort()))
 
         # Establish connection to printer...
-        self.serial_connection = self.serial_connector()
-        self.serial_connection.connect(self.getAddressIp(), self.getAddressPort())
+        self._openConnection(self.getAddressIp(), self.getAddressPort())
         self.setConnectionState(ConnectionState.connected)
         Logger.log("e", "Connected with %s at %s:%s" %(self.getName(), self.getAddressIp(), self.getAddressPort()))
 
         # Start send/receive threads
         self._receive_thread.start()
         self._send_thread.start()
+
+        self._negotiateCapabilities()
         
         # IO threads are up. Ready for printing...
         self._updateJobState("ready")
+        self._offerResume()
 
-    def _receive(self):
-        while self.connectionState == ConnectionState.connected:
-            received_line = self.serial_connection.receiveLine()
-            
-            if received_line:
-                Logger.log("d", "Received new line: %s", repr(received_line))
-                
-                if not self._sent_command is None:
-                    self._sent_command.parseAnswer(received_line)
-
-                # Different answers
-                if received_line == "echo:SD card ok":
-                    self._sd_card_status = "ok"
-
-                if received_line in ("echo:SD init fail", "Error:volume.init failed"):
-                    self._sd_card_status = "failed"
-
-            if self._sent_command and self._sent_command_time:
-                timeout = self._send_timeout
-                if self._sent_command.recommendedTimeOut:
-                    timeout = self._sent_command.recommendedTimeOut
-                if timeout != -1:
-                    if timeout <= time.time() - self._sent_command_time:
-                        self._sent_command.hasTimedOut(True)
-
-            #print_information = Application.getInstance().getPrintInformation()
-
-    def _send(self):
-        while self.connectionState == ConnectionState.connected:
-            if not self._sent_command is None:
-                if not (self._sent_command.hasFinished() or self._sent_command.hasTimedOut()):
-                    #Logger.log("d", "Wait for command to be processed...")
-                    continue
-            
-            # First: injected lines, eg. for changing temperature
-            if not self.queue_injected.empty():
-                    self._sent_command = self.queue_injected.get()
-                    self.serial_connection.send(self._sent_command)
-                    self._sent_command_time = time.time()
-                    continue
-            
-            # Regulary: GCode queue
-            if self.queue_gcode and not self._send_is_blocked:
-                self._updateJobState("printing")
-                
-                if self.queue_gcode_size == len(self.queue_gcode):
-                    self.queue_gcode_begin = time.time()
-
-                #self._sent_command = self.queue_gcode.get()
-                self._sent_command = self.queue_gcode.popleft()
-                if self._sent_command:
-                    self._sent_command.setDryRun(True)
-                    if self._receive_mode == "ok" and not type(self._sent_command) in (GCodeLibrary.RepRapCommands().M28, GCodeLibrary.RepRapCommands().M29):
-                        self._sent_command.isOkCommand(True)
-                    self.serial_connection.send(self._sent_command)
-                    if type(self._sent_command) is GCodeLibrary.RepRapCommands().M28:
-                        Logger.log("d", "Writing file. All answers are now 'ok'")
-                        self._receive_mode = "ok"
-                    if type(self._sent_command) is GCodeLibrary.RepRapCommands().M29:
-                        Logger.log("d", "Writing file has finished. All answers are now normal")
-                        self._receive_mode = "normal"
-                    self._sent_command_time = time.time()
-                if not self.queue_gcode_size is None:
-                    Logger.log("d", "Sending line from G-Code queue: %s/%s", len(self.queue_gcode), self.queue_gcode_size)
-                    self.setProgress(100.-100./self.queue_gcode_size*len(self.queue_gcode))
-                    self._updateJobState("ready")
-            else:
-                if not self.queue_gcode_begin is None:
-                    Logger.log("d", "Sending the G-Code queue took: %ss", time.time() - self.queue_gcode_begin)
-                self.queue_gcode_begin = None
-                self.queue_gcode_size = None
-    
-            #print_information = Application.getInstance().getPrintInformation()
-    
-    def injectCommand(self, command, wait = False):
-        self.queue_injected.put(command)
-        if wait:
-            while not (command.hasFinished() or command.hasTimedOut()):
-                time.sleep(0.125)
+    def _isConnected(self):
+        return self.connectionState == ConnectionState.connected
+
+    def _connectionLost(self):
+        self.setConnectionState(ConnectionState.closed)
+
+    def _capabilityStore(self):
+        if self._capability_store is None:
+            self._capability_store = Capabilities.CapabilityStore(os.path.join(Resources.getDataStoragePath(), "serialwifi_capabilities.json"))
+        return self._capability_store
+
+    def _setJobProgress(self, sent_lines):
+        estimate = self._job_estimate
+        if estimate is None or self._job_mode == Preflight.MODE_SD:
+            # While uploading, the progress is the uploaded share of the queue
+            self._postUpdate("progress", 100. * min(self.queue_gcode_sent / self.queue_gcode_size, 1.))
+            return
+        self._postUpdate("progress", 100. * estimate.progressAt(sent_lines))
+        self._postUpdate("time_elapsed", int(estimate.elapsedAt(sent_lines)))
+
+    def _updateJobState(self, job_state):
+        self._postUpdate("job_state", job_state)
+
+    ##  Changes the state shown in the UI with the next frame, from any thread. See UpdateAggregator.
+    def _postUpdate(self, field, value):
+        UpdateAggregator.getAggregator().post(self, field, value)
+
+    ##  Applies the coalesced changes of the UpdateAggregator, called in Qt's thread.
+    def applyUpdates(self, changes):
+        if "job_state" in changes:
+            PrinterOutputDevice._updateJobState(self, changes["job_state"])
+        if "progress" in changes:
+            self.setProgress(changes["progress"])
+        if "time_elapsed" in changes:
+            self.setTimeElapsed(changes["time_elapsed"])
 
     def requestWrite(self, nodes, file_name = None, filter_by_machine = False, file_handler = None):
         if self._progress != 0:
@@ -290,6 +293,226 @@ class SerialOutputDevice(PrinterOutputDevice):
 
         self._print_thread.start()
         
+    ##  Prints a G-code file from disk instead of the scene, optionally starting at a layer.
+    def printFile(self, path, start_layer = None):
+        self._job_file = path
+        self._job_start_layer = start_layer
+        self.requestWrite(None)
+
+    ##  Preprocesses job files in chunks on the given number of worker processes, 0 disables it.
+    #   Jobs from the scene are then spooled to a file first.
+    def setPreprocessing(self, workers, minify = False):
+        self._preprocess_workers = max(int(workers), 0)
+        self._preprocess_settings = Preprocess.PreprocessSettings(dry_run = self._dry_run, minify = minify)
+
+    ##  See StreamingEngine.setDryRun, preprocessed and cached lines have it applied already.
+    def setDryRun(self, enabled):
+        StreamingEngine.StreamingEngine.setDryRun(self, enabled)
+        self._preprocess_settings.dry_run = self._dry_run
+
+    ##  Keeps up to max_size bytes (eg. JobCache.DEFAULT_MAX_SIZE) of encoded jobs, so sending a job again
+    #   starts right away. 0, the default, disables it.
+    def setJobCache(self, max_size):
+        self._job_cache_size = max(int(max_size), 0)
+        if self._job_cache is not None:
+            self._job_cache.max_size = self._job_cache_size
+
+    ##  Preprocesses every slice result into the job cache while waiting for it to be printed.
+    #   Off by default, it needs the job cache and runs on the preprocessing workers if there are any.
+    def setSpeculation(self, enabled):
+        self._speculation_enabled = bool(enabled)
+        if self._speculation_enabled:
+            _startSpeculating(self)
+        else:
+            Speculation.getSpeculator().invalidate()
+
+    def _speculationTarget(self):
+        """(JobCache, PreprocessSettings, spool directory, workers) to preprocess slice results for, None for none."""
+        if not self._speculation_enabled or not self._job_cache_size:
+            return None
+        settings = Preprocess.PreprocessSettings(self._preprocess_settings.dry_run,
+                                                 self._preprocess_settings.minify,
+                                                 self._gcodeFlavor())
+        return (self._jobCache(), settings, os.path.dirname(self._spoolPath()), self._preprocess_workers)
+
+    ##  How jobs get to the printer: Preflight.MODE_DIRECT streams them, Preflight.MODE_SD uploads them
+    #   to the SD card and prints them from there. "recommend" streams, but suggests uploading where the
+    #   preflight analysis expects it to finish sooner. "auto" picks the faster one before sending.
+    def setModeSelection(self, mode):
+        if mode not in (Preflight.MODE_DIRECT, Preflight.MODE_SD, "recommend", "auto"):
+            raise ValueError("Unknown mode selection %r" %(mode,))
+        self._mode_selection = mode
+
+    ##  Preflight.PreflightReport of the last job, None if it wasn't analyzed.
+    def getPreflightReport(self):
+        return self._preflight_report
+
+    def _jobCache(self):
+        if self._job_cache is None:
+            self._job_cache = JobCache.JobCache(os.path.join(Resources.getDataStoragePath(), "serialwifi_cache"), self._job_cache_size)
+        return self._job_cache
+
+    ##  How to validate jobs: "off", "warn" after the job has started or "reject" bad jobs before sending them.
+    #   limits is a JobValidation.ValidationLimits, by default built from the machine settings.
+    def setValidation(self, mode, limits = None):
+        if mode not in ("off", "warn", "reject"):
+            raise ValueError("Unknown validation mode %r" %(mode,))
+        self._validation = mode
+        self._validation_limits = limits
+
+    ##  JobValidation.ValidationReport of the last job, None if it wasn't validated (yet).
+    def getValidationReport(self):
+        return self._job_report
+
+    def _validationLimits(self):
+        if self._validation_limits is not None:
+            return self._validation_limits
+        stack = Application.getInstance().getGlobalContainerStack()
+        if stack is None:
+            return JobValidation.ValidationLimits()
+        volume = JobValidation.BuildVolume.fromMachine(stack.getProperty("machine_width", "value"),
+                                                       stack.getProperty("machine_depth", "value"),
+                                                       stack.getProperty("machine_height", "value"),
+                                                       stack.getProperty("machine_center_is_zero", "value"))
+        return JobValidation.ValidationLimits(volume)
+
+    def _gcodeFlavor(self):
+        stack = Application.getInstance().getGlobalContainerStack()
+        if stack is None:
+            return None
+        return stack.getProperty("machine_gcode_flavor", "value")
+
+    def _lookupJobCache(self):
+        """Reads the job from the cache if it was sent before, otherwise remembers to store it."""
+        self._preprocess_settings.flavor = self._gcodeFlavor()
+        try:
+            if self._job_file is None:
+                content_hash = JobCache.linesHash(getattr(Application.getInstance().getController().getScene(), "gcode_list"))
+            else:
+                content_hash = JobCache.fileHash(self._job_file)
+        except OSError:
+            Logger.logException("w", "Could not hash the job for the cache!")
+            return
+        key = JobCache.entryKey(content_hash, self._preprocess_settings)
+        # Usually preprocessed since slicing was done
+        speculation = Speculation.getSpeculator().claim(key)
+        entry = self._jobCache().lookup(key)
+        if entry is None:
+            if speculation is None or speculation.isDone():
+                self._job_cache_key = key
+            else:
+                Logger.log("d", "Job %s is still being preprocessed, sending it as it is", key)
+            return
+        try:
+            estimate = demand = None
+            if self._job_start_layer is None:
+                estimate = entry.estimate()
+                demand = entry.demand()
+        except (OSError, ValueError, KeyError):
+            Logger.logException("w", "Cached job %s is damaged!", key)
+            self._job_cache_key = key
+            return
+        Logger.log("d", "Sending cached job %s", key)
+        self._job_cache_entry = entry
+        self._job_cached_estimate = estimate
+        self._job_cached_demand = demand
+        self._job_file = entry.source_path
+
+    def _storeJobCache(self):
+        key = self._job_cache_key
+        source = self._job_source
+        self._job_cache_key = None
+        if key is None or source is None:
+            return
+        # A job started at a layer is only estimated from there on
+        estimate = demand = None
+        if source.start_offset == 0:
+            estimate = self._job_estimate
+            demand = self._job_demand
+        settings = Preprocess.PreprocessSettings(self._preprocess_settings.dry_run,
+                                                 self._preprocess_settings.minify,
+                                                 self._preprocess_settings.flavor)
+        thread = threading.Thread(target = self._storeJob, args = (key, source.path, settings, estimate, demand), daemon = True)
+        thread.start()
+
+    def _storeJob(self, key, path, settings, estimate, demand):
+        try:
+            # Encoded by the preprocessing workers, if the user configured some
+            entry = self._jobCache().store(key, path, settings, self._preprocess_workers, estimate, demand = demand)
+        except Exception:
+            Logger.logException("w", "Could not store the job in the cache!")
+            return
+        if entry is not None:
+            Logger.log("d", "Stored job in the cache as %s", key)
+
+    def _openJobFile(self, path, start_offset = 0, prelude = (), start_layer = None):
+        if self._job_cache_entry is not None:
+            return self._job_cache_entry.open(start_offset, prelude, start_layer)
+        if not start_layer is None:
+            if self._preprocess_workers:
+                return Preprocess.openFile(path, start_layer, self._preprocess_settings, self._preprocess_workers)
+            return JobSource.openFile(path, start_layer)
+        if self._preprocess_workers:
+            return Preprocess.PreprocessedJobSource(path, start_offset, prelude, self._preprocess_settings, self._preprocess_workers)
+        return JobSource.FileJobSource(path, start_offset, prelude)
+
+    def _spoolPath(self):
+        return os.path.join(Resources.getDataStoragePath(), "serialwifi_spool", Journal.safeName(self.getName()) + ".gcode")
+
+    def _profileDirectory(self):
+        return os.path.join(Resources.getDataStoragePath(), "serialwifi_profiles")
+
+    def _journalDirectory(self):
+        return os.path.join(Resources.getDataStoragePath(), "serialwifi_journals")
+
+    def _startJournal(self, start_line = 0):
+        self._closeJournal()
+        self._journal_complete = False
+        if not self._journal_enabled:
+            return
+        source = self._job_source
+        try:
+            self._journal = Journal.JobJournal(Journal.journalPath(self._journalDirectory(), self.getName()),
+                                               source.path, source.start_offset, source.prelude, start_line,
+                                               self._journal_interval).start()
+        except OSError:
+            Logger.logException("w", "Could not start the job journal!")
+            self._journal = None
+
+    ##  Offers to continue a job file whose streaming was interrupted, eg. by a crash of Cura.
+    def _offerResume(self):
+        if not self._journal_enabled:
+            return
+        state = Journal.findUnfinished(self._journalDirectory(), self.getName())
+        if state is None or not state.matchesSource():
+            return
+        Logger.log("i", "Found interrupted job %s at line %s", state.getSourcePath(), state.getLine())
+        self._resume_message = Message(i18n_catalog.i18nc("@info:status",
+                                                          "Printing %s was interrupted after line %s. Do you want to resume it?") %(os.path.basename(state.getSourcePath()), state.getLine()),
+                                       lifetime = 0)
+        self._resume_message.addAction("resume", i18n_catalog.i18nc("@action:button", "Resume"), "", "")
+        self._resume_message.actionTriggered.connect(self._onResumeMessageAction)
+        self._resume_message.show()
+
+    def _onResumeMessageAction(self, message, action):
+        message.hide()
+        if action == "resume":
+            self.resumeInterruptedJob()
+
+    ##  Continues the interrupted job file from its last checkpoint, without reading it from the start.
+    def resumeInterruptedJob(self):
+        state = Journal.findUnfinished(self._journalDirectory(), self.getName())
+        if state is None:
+            Logger.log("w", "There is no interrupted job to resume")
+            return False
+        if not state.matchesSource():
+            Logger.log("w", "%s has changed since it was printed, not resuming it", state.getSourcePath())
+            return False
+        self._job_file = state.getSourcePath()
+        self._job_resume = state
+        self.requestWrite(None)
+        return True
+
     def _print(self):
         """ # - shouldn't happen
         while self._connect_thread.isAlive():
@@ -300,32 +523,91 @@ class SerialOutputDevice(PrinterOutputDevice):
         if self.queue_gcode:
             Logger.log("w", "Queue is not empty! Clearing...")
             self.queue_gcode.clear()
+        if self._job_source is not None:
+            self._job_source.close()
+            self._job_source = None
+        self._dropHeatWait()
+        self._job_mode = Preflight.MODE_SD if self._mode_selection == Preflight.MODE_SD else Preflight.MODE_DIRECT
+        self._job_demand = self._preflight_report = None
         
         # Procedure before filling the queue
         self._print_pre_fill_gcode()
         
         # Threads are very fastttt....
         self._send_is_blocked = True
+        self._startProfile()
         
         # Fill queue with lines
+        filled_at = time.perf_counter()
         self._print_fill_with_gcode()
-        
+        if self._profile is not None:
+            self._profile.addSpan("fill", time.perf_counter() - filled_at)
+        if self._job_mode == Preflight.MODE_SD:
+            self._queueUpload()
+        
+        # Bad jobs don't get sent at all, "auto" picks the mode by the job
+        self._job_analyzed = False
+        if self._validation == "reject" or self._mode_selection == "auto":
+            self._analyzeJob()
+            if self._job_report is not None and not self._job_report.isValid() and self._validation == "reject":
+                self._rejectJob()
+                return
+        self._selectJobMode()
+
+        self.queue_gcode_sent = 0
+        self.queue_gcode_size = len(self.queue_gcode)
+        if self._job_source is not None:
+            # The source itself is a queue item, but stands for all its lines
+            self.queue_gcode_size += self._job_source.lineCount() - 1
+
         # Let get Thread send our lines!
         self._send_is_blocked = False
+        self._send_wakeup.set()
         
         # Procedure after filling the queue
         self._print_post_fill_gcode()
 
     def _print_pre_fill_gcode(self):
         Logger.log("w", "SerialOutputDevice._print_pre_fill_gcode")
+        if self._job_mode == Preflight.MODE_SD:
+            self._initializeSdCard(self._sd_card_slot)
 
     def _print_fill_with_gcode(self):
         Logger.log("w", "SerialOutputDevice._print_fill_with_gcode")
+        self._job_line_offset = len(self.queue_gcode)
+        self._job_lines = None
+
+        self._job_cache_entry = self._job_cache_key = self._job_cached_estimate = self._job_cached_demand = None
+        if self._job_resume is None and self._job_cache_size:
+            self._lookupJobCache()
+
+        if self._job_file is None and (self._preprocess_workers or self._job_cache_key is not None):
+            # Spooled, then preprocessed, cached and journaled like any job file
+            gcode_list = getattr(Application.getInstance().getController().getScene(), "gcode_list")
+            self._job_file = Preprocess.spoolLines(gcode_list, self._spoolPath())
+
+        if self._job_file is not None:
+            # Files are read line by line while sending
+            start_line = 0
+            if self._job_resume is not None:
+                resume = self._job_resume
+                Logger.log("d", "Resume G-Code file %s at byte %s", self._job_file, resume.getOffset())
+                self._job_source = self._openJobFile(self._job_file, resume.getOffset(), resume.resumeCommands())
+                start_line = resume.getLine()
+            else:
+                Logger.log("d", "Queue G-Code file %s starting at layer %s", self._job_file, self._job_start_layer)
+                self._job_source = self._openJobFile(self._job_file, start_layer = self._job_start_layer)
+            self._job_file = self._job_start_layer = self._job_resume = None
+            self.queue_gcode.append(self._job_source)
+            self._startJournal(start_line)
+            return
+
         # Get G-Code from application
         gcode_list = getattr(Application.getInstance().getController().getScene(), "gcode_list")
         
         # Fill queue with G-Code
         Logger.log("d", "Fill queue with G-Code")
+        self._job_lines = []
         for entry in gcode_list:
             splitted_entries = entry.split("\n")
             for splitted_entry in splitted_entries:
@@ -335,14 +617,191 @@ class SerialOutputDevice(PrinterOutputDevice):
                     #Logger.log("w", "Adding to queue: %s", repr(splitted_entry))
                     #self.queue_gcode.put(splitted_entry)
                     self.queue_gcode.append(GCodeLibrary.identifyLine(splitted_entry))
+                    self._job_lines.append(splitted_entry)
         
     def _print_post_fill_gcode(self):
         Logger.log("w", "SerialOutputDevice._print_pre_fill_gcode")
-        self.queue_gcode_size = len(self.queue_gcode)
+        if not self._job_analyzed:
+            self._analyzeJob()
+        self._storeJobCache()
+        self._reportValidation()
+        if self._job_mode == Preflight.MODE_SD:
+            self._sd_printing = True
+            self._sd_printing_seen = False
+            self._sd_status_command = None
+        elif self._mode_selection == "recommend":
+            self._recommendUpload()
+
+    ##  Wraps the filled queue into writing it to the SD card, printing it from there afterwards.
+    def _queueUpload(self):
+        begin, end = StreamingEngine.uploadCommands(self._temp_file_name)
+        self.queue_gcode.extendleft(reversed(begin))
+        self._job_line_offset += len(begin)
+        # Behind the lines the file removes itself at its end, is closed, selected and started
+        self.queue_gcode.extend(end)
+        if self._journal is not None:
+            # An upload can't be continued in the middle of the file
+            self._journal.finish()
+            self._journal = None
+
+    ##  Analyzes how long the job takes streamed and uploaded over the link measured so far.
+    def _preflight(self):
+        if self._job_demand is None:
+            return None
+        self._preflight_report = Preflight.analyze(self._job_demand, self.getLinkProfile(), self._supportsSdCard())
+        Logger.log("d", "Preflight analysis: %s", self._preflight_report.getSummary())
+        return self._preflight_report
+
+    ##  Switches a job of the "auto" selection to uploading it if that's expected to finish sooner.
+    def _selectJobMode(self):
+        if self._mode_selection != "auto" or self._job_mode != Preflight.MODE_DIRECT:
+            return
+        report = self._preflight()
+        if report is None or report.mode != Preflight.MODE_SD:
+            return
+        try:
+            self._initializeSdCard(self._sd_card_slot)
+        except Exception:
+            Logger.logException("w", "Could not use the SD card, streaming the job instead")
+            return
+        Logger.log("i", "Uploading the job to the SD card first: %s", report.reason)
+        self._job_mode = Preflight.MODE_SD
+        self._queueUpload()
+
+    ##  Suggests picking the mode automatically if uploading would have been faster than this stream.
+    def _recommendUpload(self):
+        report = self._preflight()
+        if report is None or report.mode != Preflight.MODE_SD:
+            return
+        self._preflight_message = Message(i18n_catalog.i18nc("@info:status",
+                                                             "Streaming this job is expected to stall the printer for %d min waiting for lines. Uploading it to the SD card first would finish about %d min sooner.")
+                                          %(round(report.stall_time / 60.), round((report.getDirectTime() - report.getSDTime()) / 60.)))
+        self._preflight_message.addAction("auto", i18n_catalog.i18nc("@action:button", "Pick the faster way from now on"), "", "")
+        self._preflight_message.actionTriggered.connect(self._onPreflightMessageAction)
+        self._preflight_message.show()
+
+    def _onPreflightMessageAction(self, message, action):
+        message.hide()
+        if action == "auto":
+            self.setModeSelection("auto")
+
+    ##  Estimates the job and validates it in the same pass over its lines.
+    def _analyzeJob(self):
+        self._job_analyzed = True
+        self._job_estimate = None
+        self._job_report = None
+        lines = self._job_lines
+        stride = 1
+        if self._job_source is not None:
+            # Sample huge jobs coarsely, unless rejecting it runs while the job is already streaming
+            lines = self._job_source.lines()
+            stride = 64
+        validator = None
+        if self._validation != "off":
+            validator = JobValidation.JobValidator(self._validationLimits())
+        demand = None
+        if self._mode_selection in ("recommend", "auto") and self._job_mode == Preflight.MODE_DIRECT:
+            demand = Preflight.LinkDemand()
+        if self._job_cached_estimate is not None:
+            self._job_estimate = self._job_cached_estimate
+            self._job_cached_estimate = None
+            self.setTimeTotal(int(self._job_estimate.total))
+            Logger.log("d", "Cached print time: %ss", self._job_estimate.total)
+            if validator is not None and lines:
+                try:
+                    self._job_report = JobValidation.validateJob(lines, validator.limits)
+                except Exception:
+                    Logger.logException("w", "Could not validate the job!")
+            if demand is not None and self._job_cached_demand is not None:
+                self._job_demand = self._job_cached_demand
+                self._job_cached_demand = None
+            elif demand is not None and self._mode_selection == "auto" and lines:
+                # Not cached with the estimate, a pass of its own before the job starts
+                try:
+                    self._job_demand = Preflight.measureDemand(lines)
+                except Exception:
+                    Logger.logException("w", "Could not analyze the job for the link!")
+        elif lines:
+            try:
+                self._job_estimate = JobAnalysis.estimateJob(lines, stride = stride, validator = validator, demand = demand)
+                self._job_demand = demand
+                self.setTimeTotal(int(self._job_estimate.total))
+                Logger.log("d", "Estimated print time: %ss", self._job_estimate.total)
+                if validator is not None:
+                    self._job_report = validator.getReport()
+            except Exception:
+                Logger.logException("w", "Could not estimate the print time!")
+        self._job_lines = None
+
+    def _validationText(self, report):
+        return "\n".join(issue.getMessage() for issue in report.getErrors() + report.getWarnings())
+
+    def _reportValidation(self):
+        report = self._job_report
+        if report is None or not report.issues:
+            return
+        for issue in report.issues:
+            Logger.log("w", "Job validation: %s", issue.getMessage())
+        if report.getErrors():
+            self._validation_message = Message(i18n_catalog.i18nc("@info:status",
+                                                                  "The print job looks faulty:\n%s") %self._validationText(report))
+            self._validation_message.show()
+
+    ##  Drops the filled queue of a job which didn't pass the validation.
+    def _rejectJob(self):
+        while self.queue_gcode:
+            item = self.queue_gcode.popleft()
+            if isinstance(item, JobSource.FileJobSource):
+                item.close()
+        self._job_source = None
+        self._job_cache_key = None
+        self.queue_gcode_size = None
+        self._finishProfile("rejected")
+        # Nothing was printed, there is nothing to resume
+        if self._journal is not None:
+            self._journal.finish()
+            self._journal = None
+        Logger.log("w", "Rejected the print job: %s", self._validationText(self._job_report).replace("\n", "; "))
+        self._validation_message = Message(i18n_catalog.i18nc("@info:status",
+                                                              "The print job was not sent, it failed the validation:\n%s") %self._validationText(self._job_report))
+        self._validation_message.show()
 
     ##  Request data from the connected device.
     def _update(self):
-        return
+        if self._journal is not None and self._journal_complete and not self._in_flight:
+            self._journal.finish()
+            self._journal = None
+        self._metrics.sample()
+        self._metrics_summary = self._metrics.getSummary()
+        self.metricsChanged.emit()
+        self._updateSDPrint()
+
+    ##  Polls the SD print position once the upload has finished and maps it to the print time.
+    def _updateSDPrint(self):
+        if not self._sd_printing or self.queue_gcode or not self.queue_gcode_size is None:
+            return
+
+        status = self._sd_status_command
+        if status is not None:
+            if not (status.hasFinished() or status.hasTimedOut()):
+                return
+            if status.isSDPrinting():
+                self._sd_printing_seen = True
+                position, size = status.getSDPosition()
+                if self._job_estimate is not None:
+                    sent_lines = self._job_estimate.linesAtByte(position, size)
+                    self._postUpdate("progress", 100. * self._job_estimate.progressAt(sent_lines))
+                    self._postUpdate("time_elapsed", int(self._job_estimate.elapsedAt(sent_lines)))
+                elif size:
+                    self._postUpdate("progress", 100. * position / size)
+            elif status.isSDPrinting() is False and self._sd_printing_seen:
+                Logger.log("i", "SD print has finished")
+                self._postUpdate("progress", 100.)
+                self._sd_printing = False
+                return
+
+        self._sd_status_command = GCodeLibrary.RepRapCommands().M27()
+        self.injectCommand(self._sd_status_command)
 
 @signalemitter
 class SerialWifiCommonOutputDevice(SerialOutputDevice):
@@ -358,13 +817,28 @@ class SerialWifiCommonOutputDevice(SerialOutputDevice):
         self.setConnectionText(i18n_catalog.i18nc("@properties:tooltip", "Connected to '%s'") %name)
 
         # Serial connector
-        self.serial_connector = WifiConnectionFactory
+        self.setTransport("tcp")
 
         self._error_message = None
     
     def getProperties(self):
         return self._properties
 
+    def _advertisedFirmware(self):
+        firmware = (self._properties or {}).get(b"firmware")
+        if not firmware:
+            return None
+        return firmware.decode("utf-8")
+
+    def _bridgeProperties(self):
+        return self._properties or {}
+
+    ##  The capabilities become properties of the device like the ones from Zeroconf, eg. b"cap_advanced_ok".
+    def _applyCapabilities(self, capabilities):
+        super()._applyCapabilities(capabilities)
+        if self._properties is not None:
+            self._properties.update(capabilities.toProperties())
+
     def getProperty(self, key):
         if type(key) is bytes:
             key = key.encode("utf-8")
@@ -385,90 +859,12 @@ class SerialWifiOutputDevice(SerialWifiCommonOutputDevice):
     def __init__(self, name, address, properties):
         super().__init__(name, address, properties)
         self.setShortDescription(i18n_catalog.i18nc("@action:button Preceded by 'Ready to'.", "Print via WiFi"))
+        self._mode_selection = "recommend"
 
 class SerialWifiSDOutputDevice(SerialWifiCommonOutputDevice):
-    _temp_file_name = "temp.gco"
-    _sd_card_slot = 0
-    
     def __init__(self, name, address, properties):
         super().__init__(name, address, properties)
         self.setShortDescription(i18n_catalog.i18nc("@action:button Preceded by 'Ready to'.", "Print via WiFi (cached)"))
-    
-    def _print_pre_fill_gcode(self):
-        Logger.log("w", "SerialWifiOutputDevice._print_pre_fill_gcode")
-        sd_init_tries = 0
-        
-        initializeSDcard = GCodeLibrary.RepRapCommands().M21()
-        initializeSDcard.setSdSlot(self._sd_card_slot)
-        
-        while not initializeSDcard.isSDCardInitialized() and not sd_init_tries >= 3:
-            initializeSDcard.reset()
-            self.injectCommand(initializeSDcard, wait = True)
-            if initializeSDcard.isSDCardInitialized() is None:
-                Logger.log("i", "Printer seems to be in write mode. Trying to close the file..")
-                self.injectCommand(GCodeLibrary.RepRapCommands().M29(), wait = True)
-            sd_init_tries += 1
-            
-        if self._sd_card_status != "ok":
-            raise Exception("Problems initializing SD card")
-        
-        super()._print_pre_fill_gcode()
-    
-    def _print_fill_with_gcode(self):
-        Logger.log("w", "SerialWifiOutputDevice._print_fill_with_gcode")
-
-        # Begin writing
-        beginWriteFile = GCodeLibrary.RepRapCommands().M28()
-        beginWriteFile.setFile(self._temp_file_name)
-        #self.queue_gcode.put(beginWriteFile)
-        self.queue_gcode.append(beginWriteFile)
-        
-        # Fill in the original GCode lines
-        super()._print_fill_with_gcode()
-        
-        # Let the temp file remove itself
-        removeFile = GCodeLibrary.RepRapCommands().M30()
-        removeFile.setFile(self._temp_file_name)
-        #self.queue_gcode.put(removeFile)
-        self.queue_gcode.append(removeFile)
-        
-        # Stop writing to SD
-        endWriteFile = GCodeLibrary.RepRapCommands().M29()
-        endWriteFile.setFile(self._temp_file_name)
-        #self.queue_gcode.put(endWriteFile)
-        self.queue_gcode.append(endWriteFile)
-        
-        # Select the temp file
-        selectFile = GCodeLibrary.RepRapCommands().M23()
-        selectFile.setFile(self._temp_file_name)
-        #self.queue_gcode.put(selectFile)
-        self.queue_gcode.append(selectFile)
-        
-        # Start SD printing
-        startPausePrint = GCodeLibrary.RepRapCommands().M24()
-        #self.queue_gcode.put(startPausePrint)
-        self.queue_gcode.append(startPausePrint)
-        
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        self._mode_selection = Preflight.MODE_SD
+        # An upload can't be continued in the middle of the file
+        self._journal_enabled = False
@@ -1,58 +1,102 @@
 from UM.OutputDevice.OutputDevicePlugin import OutputDevicePlugin
-from . import SerialWifiOutputDevice #@UnresolvedImport
+# SerialWifiOutputDevice, StreamingEngine and zeroconf are imported on first use, off Cura's startup
 
-from zeroconf import Zeroconf, ServiceBrowser, ServiceStateChange, ServiceInfo
 from UM.Logger import Logger
 from UM.Signal import Signal, signalemitter
 #from UM.Application import Application
-#from UM.Preferences import Preferences
+from UM.Preferences import Preferences
 
+import threading
 import time
 
 import socket
 
+# kB/s all printers together may send at most (see Bandwidth), 0 doesn't limit them
+BANDWIDTH_LIMIT_PREFERENCE = "serialwifi/bandwidth_limit"
+
 @signalemitter
 class SerialWifiOutputDevicePlugin(OutputDevicePlugin):
-    _mdnsName = u'_cura-serialwifi._tcp.local.'
-    
     def __init__(self):
         super().__init__()
         self._zero_conf = None
         self._browser = None
         self._printers = {}
 
+        # Discovery starts in the background, start() returns right away
+        self._discovery_lock = threading.Lock()
+        self._discovery_generation = 0
+
         # Because the model needs to be created in the same thread as the QMLEngine, we use a signal.
         self.addPrinterSignal.connect(self.addOutputDevice)
         self.removePrinterSignal.connect(self.removePrinter)
 
         # Get list of manual printers from preferences
-        #self._preferences = Preferences.getInstance()
+        self._preferences = Preferences.getInstance()
+
+        # Rate of all printers together, applied to the scheduler of Bandwidth
+        self._preferences.addPreference(BANDWIDTH_LIMIT_PREFERENCE, 0)
+        self._preferences.preferenceChanged.connect(self._onPreferenceChanged)
+        self._applyBandwidthLimit()
 
     addPrinterSignal = Signal()
     removePrinterSignal = Signal()
 
+    def _onPreferenceChanged(self, name):
+        if name == BANDWIDTH_LIMIT_PREFERENCE:
+            self._applyBandwidthLimit()
+
+    ##  Caps the rate of all printers together, so they leave room on a shared access point.
+    def _applyBandwidthLimit(self):
+        from . import Bandwidth
+        try:
+            limit = float(self._preferences.getValue(BANDWIDTH_LIMIT_PREFERENCE) or 0)
+        except ValueError:
+            Logger.log("w", "Ignoring the bandwidth limit %r, it isn't a number", self._preferences.getValue(BANDWIDTH_LIMIT_PREFERENCE))
+            limit = 0
+        Bandwidth.getScheduler().setRate(limit * 1e3 if limit > 0 else None)
+
     ##  Start looking for devices on network.
     def start(self):
         # Make sure we start a new session.
         self.stop()
-        
+
+        # Importing zeroconf and opening its sockets takes a while, Cura's startup doesn't wait for it
+        with self._discovery_lock:
+            generation = self._discovery_generation
+        threading.Thread(target = self._startDiscovery, args = (generation,), daemon = True).start()
+
+    def _startDiscovery(self, generation):
+        from zeroconf import Zeroconf, ServiceBrowser
+        # Loaded now as well, the first printer shows up faster
+        from . import StreamingEngine
+
         # After network switching, one must make a new instance of Zeroconf
         # On windows, the instance creation is very fast (unnoticable). Other platforms?
-        self._zero_conf = Zeroconf()
-        self._browser = ServiceBrowser(self._zero_conf, self._mdnsName, [self._onServiceChanged])
+        zero_conf = Zeroconf()
+        with self._discovery_lock:
+            if generation != self._discovery_generation:
+                # Stopped meanwhile
+                zero_conf.close()
+                return
+            self._zero_conf = zero_conf
+            self._browser = ServiceBrowser(self._zero_conf, StreamingEngine.SERVICE_TYPE, [self._onServiceChanged])
 
     ##  Stop looking for devices on network
     def stop(self):
-        # ZeroconfBrowser
-        if self._browser:
-            self._browser.cancel()
-            self._browser = None
-            self._old_printers = [printer_name for printer_name in self._printers]
-            self._printers = {}
-        
-        # Zeroconf
-        if self._zero_conf is not None:
-            self._zero_conf.close()
+        with self._discovery_lock:
+            self._discovery_generation += 1
+
+            # ZeroconfBrowser
+            if self._browser:
+                self._browser.cancel()
+                self._browser = None
+                self._old_printers = [printer_name for printer_name in self._printers]
+                self._printers = {}
+
+            # Zeroconf
+            if self._zero_conf is not None:
+                self._zero_conf.close()
+                self._zero_conf = None
         
 
     def _is_valid_ip(self, address):
@@ -70,6 +114,7 @@ class SerialWifiOutputDevicePlugin(OutputDevicePlugin):
     
     ##  Handler for zeroConf detection
     def _onServiceChanged(self, zeroconf, service_type, name, state_change):
+        from zeroconf import ServiceStateChange, ServiceInfo
         if state_change == ServiceStateChange.Added:
             Logger.log("d", "Bonjour service added: %s" % name)
 
@@ -112,6 +157,7 @@ class SerialWifiOutputDevicePlugin(OutputDevicePlugin):
     ##  Because the model needs to be created in the same thread as the QMLEngine, we use a signal.
     def addOutputDevice(self, name, address, properties):
         if not name in self._printers.keys():
+            from . import SerialWifiOutputDevice #@UnresolvedImport
             printer = SerialWifiOutputDevice.SerialWifiOutputDevice(name, address, properties)
             printer.connect()
             self._printers[printer.getName()] = printer
@@ -122,4 +168,6 @@ class SerialWifiOutputDevicePlugin(OutputDevicePlugin):
         if printer:
             if printer.isConnected():
                 printer.disconnect()
+            from . import UpdateAggregator
+            UpdateAggregator.getAggregator().forget(printer)
             self.getOutputDeviceManager().removeOutputDevice(printer)
@@ -0,0 +1,186 @@
+'''
+Speculative preprocessing of slice results, before anyone asked to print them.
+
+Between the end of slicing and pressing "Print" there is usually plenty of
+idle time. Once the slicer is done, the Speculator hands its G-code to a
+SpeculativeJob per cache. Each job runs in a thread of its own and does
+what the first print of the job would otherwise do before and while
+sending: hash it, spool it, encode it, index its layers and estimate it
+(with the link demand of Preflight). The result is a JobCache entry under
+the same key the device looks up, so the print starts from the cache
+right away.
+
+Speculating is off unless a device turns it on. The thread runs at the
+lowest CPU priority where the platform allows to lower it per thread
+(Linux). Without preprocessing workers it encodes in this process, the
+workers come from Preprocess's fork server and keep their priority.
+
+Slicing again makes the result stale: the running jobs are cancelled
+between chunks and the entries nobody printed are removed from the cache.
+Entries which were already there before aren't touched, neither are those
+of jobs claimed by a print.
+'''
+
+import os
+import sys
+import threading
+import time
+
+from .. import JobCache
+from .. import Preprocess
+from ..Log import Logger
+
+NICENESS = 19 # the lowest priority on Linux
+
+def lowerPriority():
+    """Lowers the CPU priority of the calling thread, if the platform allows it."""
+    if not sys.platform.startswith("linux"):
+        # Elsewhere setpriority() takes process ids, not thread ids
+        return False
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), NICENESS)
+    except (AttributeError, OSError):
+        return False
+    return True
+
+class SpeculativeJob():
+    """Stores lines (eg. Cura's gcode_list) in cache with settings, see the module's description."""
+    def __init__(self, lines, cache, settings, spool_path, workers = 0, claimed = None):
+        self.lines = lines
+        self.cache = cache
+        self.settings = settings
+        self.spool_path = spool_path
+        self.workers = workers
+        self.key = None # known once the lines are hashed
+        self.entry = None # JobCache.CacheEntry once it's stored
+        self.created = False # the entry wasn't in the cache before
+        self.error = None
+        self.elapsed = None # s until the entry was there
+        self._claimed = claimed if claimed is not None else set() # keys which are printed, never discarded
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run, name = "speculative preprocessing", daemon = True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        started = time.monotonic()
+        lowerPriority()
+        try:
+            key = JobCache.entryKey(JobCache.linesHash(self.lines), self.settings)
+            with self._lock:
+                self.key = key
+            if self._cancelled.is_set():
+                return
+            entry = self.cache.lookup(key)
+            if entry is None:
+                Preprocess.spoolLines(self.lines, self.spool_path)
+                if self._cancelled.is_set():
+                    return
+                entry = self.cache.store(key, self.spool_path, self.settings, self.workers, cancelled = self._cancelled)
+                created = entry is not None
+            else:
+                created = False
+            with self._lock:
+                self.entry = entry
+                self.created = created
+                self.elapsed = time.monotonic() - started
+            if entry is not None:
+                Logger.log("d", "Preprocessed the sliced job as %s in %.1f s", key, self.elapsed)
+        except JobCache.StoreCancelled:
+            pass
+        except Exception as error:
+            self.error = error
+            Logger.logException("w", "Could not preprocess the sliced job!")
+        finally:
+            self.lines = None
+            try:
+                os.remove(self.spool_path)
+            except OSError:
+                pass
+            self._done.set()
+            if self._cancelled.is_set():
+                # Cancelled while the entry was completed
+                self._discard()
+
+    def _discard(self):
+        with self._lock:
+            if not self.created or self.key in self._claimed:
+                return
+            self.created = False
+            self.entry = None
+        self.cache.discard(self.key)
+
+    ##  Stops the job and removes its entry from the cache, unless it was claimed.
+    def cancel(self):
+        self._cancelled.set()
+        if self._done.is_set():
+            self._discard()
+
+    def isDone(self):
+        return self._done.is_set()
+
+    def wait(self, timeout = None):
+        """True once the job is done, successful or not."""
+        return self._done.wait(timeout)
+
+class Speculator():
+    """The SpeculativeJobs of the latest slice result."""
+    def __init__(self):
+        self.started = 0
+        self.claims = 0
+        self._jobs = []
+        self._claimed = set()
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    ##  Preprocesses a new slice result for targets, (JobCache, PreprocessSettings, spool directory, workers) each.
+    #   Drops what was done for the previous one.
+    def sliced(self, lines, targets):
+        # Cura keeps changing its list, eg. when post-processing
+        lines = list(lines)
+        jobs = []
+        with self._lock:
+            previous = self._jobs
+            for cache, settings, spool_directory, workers in targets:
+                self._counter += 1
+                spool_path = os.path.join(spool_directory, "speculative-%d-%d.gcode" %(os.getpid(), self._counter))
+                jobs.append(SpeculativeJob(lines, cache, settings, spool_path, workers, self._claimed))
+            self._jobs = jobs
+            self.started += len(jobs)
+        for job in previous:
+            job.cancel()
+        for job in jobs:
+            job.start()
+        return jobs
+
+    ##  Cancels the running jobs and drops their unclaimed entries, eg. when slicing starts again.
+    def invalidate(self):
+        with self._lock:
+            previous = self._jobs
+            self._jobs = []
+        for job in previous:
+            job.cancel()
+
+    def claim(self, key):
+        """SpeculativeJob of key, which keeps its entry from now on; None if there is none."""
+        with self._lock:
+            self._claimed.add(key)
+            for job in self._jobs:
+                if job.key == key:
+                    self.claims += 1
+                    return job
+        return None
+
+    def getJobs(self):
+        return list(self._jobs)
+
+_speculator = Speculator()
+
+def getSpeculator():
+    """The speculator all devices of the plugin share."""
+    return _speculator
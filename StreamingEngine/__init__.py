@@ -0,0 +1,1225 @@
+'''
+The streaming engine of the plugin, independent of Qt and Cura.
+
+StreamingEngine holds the send and receive loops: the G-code queue and
+injected commands, the send window and ADVANCED_OK flow control, line
+numbers with resends and reconnects, the command tables and the SD upload.
+SerialOutputDevice is built on it and overrides the hooks for Cura's
+connection state, job state and progress; without Cura the engine runs
+its loops in plain threads:
+
+    engine = StreamingEngine("printer")
+    engine.start(*resolvePrinter("printer")[:2])
+    engine.sendFile("job.gcode")
+    engine.waitForJob()
+    engine.stop()
+
+sendJobs() does this for several files and printers at once, also from the
+command line with "python -m <plugin folder>.StreamingEngine --help".
+
+The link is one of Connection's transports, TCP by default. All of them
+share the buffered reader and writer and this engine's flow control:
+
+    engine.setTransport("serial")
+    engine.start("/dev/ttyUSB0", 115200)
+'''
+
+import collections
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+
+from .. import Bandwidth
+from .. import Capabilities
+from .. import CommandTables
+from .. import Connection
+from .. import GCodeLibrary
+from .. import HeatWait
+from .. import JobAnalysis
+from .. import JobSource
+from .. import Metrics
+from .. import Preflight
+from .. import Preprocess
+from .. import Profiling
+from .. import Trace
+from ..Connection import WifiConnectionFactory
+from ..Log import Logger
+
+SERVICE_TYPE = "_cura-serialwifi._tcp.local."
+DEFAULT_PORT = 23
+ESTIMATE_STRIDE = 64 # lines, like the estimate of streamed jobs in the plugin
+
+def uploadCommands(file_name, remove_after_print = True, start_print = True):
+    """(commands in front of, commands behind) a job to print it from the SD card like SerialWifiSDOutputDevice."""
+    begin = GCodeLibrary.RepRapCommands().M28()
+    begin.setFile(file_name)
+    after = []
+    if remove_after_print:
+        # Written into the file, so the file removes itself at its end
+        remove = GCodeLibrary.RepRapCommands().M30()
+        remove.setFile(file_name)
+        after.append(remove)
+    end = GCodeLibrary.RepRapCommands().M29()
+    end.setFile(file_name)
+    after.append(end)
+    if start_print:
+        select = GCodeLibrary.RepRapCommands().M23()
+        select.setFile(file_name)
+        after += [select, GCodeLibrary.RepRapCommands().M24()]
+    return [begin], after
+
+def _isAddress(host):
+    try:
+        socket.inet_aton(host)
+        return True
+    except OSError:
+        return False
+
+def resolvePrinter(printer, timeout = 3.):
+    """(address, port, Zeroconf properties) of "address", "host:port" or the Zeroconf name of a bridge.
+
+    Names are looked up with Zeroconf if it is installed, then by DNS.
+    """
+    host, _, port = printer.rpartition(":")
+    if host and port.isdigit():
+        return socket.gethostbyname(host), int(port), {}
+    if _isAddress(printer):
+        return printer, DEFAULT_PORT, {}
+    try:
+        import zeroconf
+    except ImportError:
+        zeroconf = None
+    if zeroconf is not None:
+        zero_conf = zeroconf.Zeroconf()
+        try:
+            info = zero_conf.get_service_info(SERVICE_TYPE, "%s.%s" %(printer, SERVICE_TYPE), int(timeout * 1000))
+        finally:
+            zero_conf.close()
+        if info is not None:
+            addresses = info.parsed_addresses() if hasattr(info, "parsed_addresses") else [socket.inet_ntoa(info.address)]
+            if addresses:
+                return addresses[0], info.port or DEFAULT_PORT, info.properties or {}
+    return socket.gethostbyname(printer), DEFAULT_PORT, {}
+
+class StreamingEngine():
+    def __init__(self, name = None, connector = None):
+        # Arguments are optional, Qt's cooperative multi-inheritance may call this without
+        self._printer_name = name
+        self.serial_connection = None
+        self.serial_connector = connector
+
+        # Send and receive
+        self._sent_lines_since_injected = 0
+        self._sent_command = None # last written command
+        self._in_flight = collections.deque() # (command, monotonic and wall time when sent, line number, job position) waiting for "ok"
+        self._in_flight_lock = threading.Lock()
+        self._send_window = 1 # commands
+        self._send_batch_size = 64 # lines per write at most
+        self._send_timeout = 10 # s
+        self._send_injected_every = 4 # lines
+        self._send_is_blocked = False
+        self._send_is_blocked_since = None
+        self._send_wakeup = threading.Event() # set by answers and new commands
+        self._send_poll = 0.01 # s the send loop sleeps at most, eg. for queued lines
+        self._receive_mode = "normal"
+        self._command_table = CommandTables.MARLIN # replaced by the table of the negotiated firmware
+        self._last_ok_time = None
+        self._socket_options = {}
+
+        # Job lines go out without extrusion and with temperatures at 50 degrees, see setDryRun()
+        self._dry_run = True
+
+        # Line numbers and resends
+        self._line_numbers = True
+        self._sync_line_numbers = False # M110 first
+        self._resend_buffer = Connection.ResendBuffer(1024)
+        self._resend_request = None # line number the firmware asked for
+        self._last_resend = None
+        self._stale_resends = 0 # repeated requests expected for lines sent before the last resend
+        self._skip_oks = 0
+        self._last_acknowledged_line = None
+
+        # Reconnect
+        self._reconnect_delay = 0.05 # s, doubled after every failed attempt
+        self._reconnect_max_delay = 5. # s
+        self._reconnect_timeout = 120. # s, the print is given up afterwards
+
+        # Firmware capabilities, asked for with M115 once per printer and firmware
+        self._capabilities = None
+        self._capability_store = None # Capabilities.CapabilityStore, None asks on every connect
+        self._capability_handshake = True
+        self._flow_control = Capabilities.FLOW_STOP_AND_WAIT
+        self._flow_window = None # send window given by the firmware, replaces _send_window
+        self._max_flow_window = 32 # commands
+        self._firmware_buffer_size = 0 # most free command slots an ADVANCED_OK "ok" reported
+        self._gcode_flavor = None # Cura's machine_gcode_flavor, picks the command table of unknown firmwares
+        self._advertised_firmware = None # eg. from the Zeroconf properties
+
+        # Buffering in the bridge (see Bridge), which paces the "ok"s over serial itself
+        self._bridge_buffering = None # None if the bridge advertises it, True or False overrides
+        self._bridge_properties = {} # eg. the Zeroconf properties
+        self._bridge_window = None # lines the bridge buffers, replaces the other windows
+        self._bridge_acked_at = 0. # wall time of the last "@ok"
+
+        # Share of the plugin-wide bandwidth (Bandwidth.getScheduler()), registered on connect
+        self._bandwidth_share = None
+        self._bandwidth_guaranteed = Bandwidth.LIVE_GUARANTEED # bytes/s while streaming
+        self._bandwidth_limit = None # bytes/s of this printer at most
+
+        # Heat waits on the host (see HeatWait), M109 & co. don't block the link then
+        self._host_heat_waits = False
+        self._heat_tolerance = HeatWait.TOLERANCE # degrees
+        self._heat_residency = 0. # s
+        self._heat_poll_interval = 1. # s between M105 while waiting
+        self._heat_wait = None # HeatWait.HeatWait holding the G-Code queue back
+        self._heat_poll = None # last M105 and when it was sent
+        self._heat_staged = collections.deque() # (command, byte offset) taken from the G-Code queue meanwhile
+        self._heat_reports_missing = False # the firmware didn't report, waits are left to it
+
+        # Metrics and (sampled) line logging
+        self._metrics = Metrics.LinkMetrics()
+        self._log_lines = False
+        self._log_lines_every = 100 # lines
+        self._logged_sent_lines = 0
+        self._logged_received_lines = 0
+
+        # Protocol trace
+        self._trace_recorder = None
+
+        # Profiling of jobs (see Profiling), the send loop only looks at _profile while it's off
+        self._profiling = False # every job
+        self._profile_next_job = False
+        self._profile_directory = None # None is _profileDirectory()
+        self._profile_interval = Profiling.SAMPLE_INTERVAL # s
+        self._profile_memory = True
+        self._profile = None # Profiling.JobProfile of the running job
+        self._profile_path = None # report of the last profiled job
+
+        # Cached status
+        self._sd_card_status = None
+        self._upload_started = None # (monotonic time, lines sent) when writing a file began
+
+        # Progress of the queued job
+        self._job_source = None # lazily read job, queued as single item
+        self._job_line_offset = 0 # queued commands in front of the job's first line
+        self._job_estimate = None
+        self._progress_interval = 0.25 # s
+        self._progress_updated_at = 0.
+
+        # Journal of the streamed job file (Journal.JobJournal), acknowledged lines go into it
+        self._journal = None
+        self._journal_complete = False # all lines sent, finished with the last "ok"
+
+        # Queues
+        self.queue_gcode = collections.deque()
+        self.queue_gcode_size = None
+        self.queue_gcode_sent = 0
+        self.queue_gcode_begin = None
+        self.queue_injected = queue.Queue()
+        self.queue_frequently = []
+        self.queue_frequently_last = None
+
+        # Without Qt
+        self._engine_running = False
+        self._engine_threads = []
+        self._stream_state = None
+        self._stream_progress = 0. # %
+        self._stream_elapsed = 0. # s of the estimated print time
+        self._stream_started = None # (monotonic time, lines and bytes sent) when the job started
+
+    # Hooks, overridden by SerialOutputDevice for Cura
+
+    def getName(self):
+        return self._printer_name
+
+    def _isConnected(self):
+        return self._engine_running
+
+    ##  The connection is gone for good.
+    def _connectionLost(self):
+        self._engine_running = False
+
+    def _updateJobState(self, job_state):
+        self._stream_state = job_state
+
+    def _setJobProgress(self, sent_lines):
+        estimate = self._job_estimate
+        if estimate is None:
+            self._stream_progress = 100. * min(self.queue_gcode_sent / self.queue_gcode_size, 1.)
+            return
+        self._stream_progress = 100. * estimate.progressAt(sent_lines)
+        self._stream_elapsed = estimate.elapsedAt(sent_lines)
+
+    def _capabilityStore(self):
+        return self._capability_store
+
+    def _gcodeFlavor(self):
+        return self._gcode_flavor
+
+    ##  Firmware name advertised by the printer before connecting, None if unknown.
+    def _advertisedFirmware(self):
+        return self._advertised_firmware
+
+    ##  Properties advertised by the bridge, eg. Connection.BRIDGE_BUFFER_PROPERTY.
+    def _bridgeProperties(self):
+        return self._bridge_properties
+
+    ##  Where the reports of profiled jobs go, see Profiling.
+    def _profileDirectory(self):
+        return os.path.join(tempfile.gettempdir(), "serialwifi_profiles")
+
+    # Without Qt
+
+    ##  Remembers capabilities in the given JSON file (see Capabilities.CapabilityStore).
+    def setCapabilityStore(self, path):
+        self._capability_store = Capabilities.CapabilityStore(path) if path else None
+
+    ##  Connects and runs the send and receive loops in threads, returns once the capabilities are known.
+    def start(self, address, port = DEFAULT_PORT):
+        if self.serial_connector is None:
+            self.serial_connector = WifiConnectionFactory
+        self._openConnection(address, port)
+        self._engine_running = True
+        self._engine_threads = [threading.Thread(target = self._receive, name = "%s receive" %self.getName(), daemon = True),
+                                threading.Thread(target = self._send, name = "%s send" %self.getName(), daemon = True),
+                                ]
+        for thread in self._engine_threads:
+            thread.start()
+        self._negotiateCapabilities()
+        self._updateJobState("ready")
+
+    def stop(self):
+        self._engine_running = False
+        for thread in self._engine_threads:
+            thread.join()
+        self._engine_threads = []
+        self._finishProfile("stopped")
+        self._closeJournal()
+        if self.serial_connection is not None:
+            self.serial_connection.disconnect()
+            self.serial_connection = None
+        self._releaseBandwidth()
+
+    def _openConnection(self, address, port):
+        self.serial_connection = self.serial_connector()
+        self.serial_connection.metrics = self._metrics
+        self.serial_connection.trace = self._trace_recorder
+        if self._bandwidth_share is None:
+            self._bandwidth_share = Bandwidth.getScheduler().register(self.getName(), guaranteed = self._bandwidth_guaranteed,
+                                                                       limit = self._bandwidth_limit)
+        self.serial_connection.share = self._bandwidth_share
+        self.serial_connection.setSocketOptions(**self._socket_options)
+        self._in_flight.clear()
+        self._resend_request = None
+        self._skip_oks = 0
+        self._sync_line_numbers = True
+        self._flow_window = None
+        self._heat_reports_missing = False
+        self.serial_connection.connect(address, port)
+        self._startBridgeBuffering()
+
+    def _supportsSdCard(self):
+        """False if the firmware reported it has no SD card support, True if it might."""
+        capabilities = self._capabilities
+        return not (capabilities is not None and capabilities.has("SDCARD") and not capabilities.supports("SDCARD"))
+
+    ##  Asks the firmware to mount the SD card, raises if it can't.
+    def _initializeSdCard(self, slot = 0):
+        if not self._supportsSdCard():
+            raise Exception("The firmware reports no SD card support")
+        sd_init_tries = 0
+
+        initializeSDcard = GCodeLibrary.RepRapCommands().M21()
+        initializeSDcard.setSdSlot(slot)
+
+        # Set by the answers the firmware's command table knows
+        self._sd_card_status = None
+        while self._sd_card_status != "ok" and not sd_init_tries >= 3:
+            self._sd_card_status = None
+            initializeSDcard.reset()
+            self.injectCommand(initializeSDcard, wait = True)
+            if self._sd_card_status is None:
+                Logger.log("i", "Printer seems to be in write mode. Trying to close the file..")
+                self.injectCommand(GCodeLibrary.RepRapCommands().M29(), wait = True)
+            sd_init_tries += 1
+
+        if self._sd_card_status != "ok":
+            raise Exception("Problems initializing SD card")
+
+    ##  Queues a G-code file and returns while it is being sent, see waitForJob().
+    #   upload_name uploads the file to the SD card under this name and prints it from there.
+    def sendFile(self, path, upload_name = None, start_layer = None, workers = 0, settings = None):
+        if upload_name:
+            self._initializeSdCard()
+        # Dry run like the send loop applies it (see _nextBatch)
+        settings = settings or Preprocess.PreprocessSettings(dry_run = self._dry_run, flavor = self._gcodeFlavor())
+        if workers:
+            source = Preprocess.openFile(path, start_layer, settings, workers)
+        else:
+            source = JobSource.openFile(path, start_layer)
+        before, after = uploadCommands(upload_name) if upload_name else ([], [])
+
+        self._send_is_blocked = True
+        self._startProfile()
+        self.queue_gcode.extend(before)
+        self._job_line_offset = len(self.queue_gcode)
+        self._job_source = source
+        self._job_estimate = None
+        self.queue_gcode.append(source)
+        self.queue_gcode.extend(after)
+        self.queue_gcode_sent = 0
+        # The source itself is a queue item, but stands for all its lines
+        self.queue_gcode_size = len(self.queue_gcode) + source.lineCount() - 1
+        self._stream_progress = self._stream_elapsed = 0.
+        self._stream_started = (time.monotonic(), self._metrics.lines_sent, self._metrics.bytes_sent)
+        self._send_is_blocked = False
+        self._send_wakeup.set()
+
+        if not upload_name:
+            # Runs while the job is already streaming, the upload's progress is the sent share
+            estimate = JobAnalysis.estimateJob(source.lines(), stride = ESTIMATE_STRIDE)
+            if self._job_source is source or self._job_source is None:
+                self._job_estimate = estimate
+
+    ##  What the link carried so far (Preflight.LinkProfile), None before the first "ok".
+    def getLinkProfile(self):
+        rates = [rate for rate in (self._bandwidth_limit, Bandwidth.getScheduler().getRate()) if rate]
+        return Preflight.LinkProfile.fromMetrics(self._metrics, self._window(), min(rates) if rates else None)
+
+    ##  Expected job times of streaming the file and of uploading it first (Preflight.PreflightReport).
+    def preflightFile(self, path, start_layer = None):
+        source = JobSource.openFile(path, start_layer)
+        try:
+            demand = Preflight.measureDemand(source.lines())
+        finally:
+            source.close()
+        return Preflight.analyze(demand, self.getLinkProfile(), self._supportsSdCard())
+
+    def isJobDone(self):
+        return not self.queue_gcode and self.queue_gcode_size is None and not self._in_flight
+
+    ##  Waits until every line of the job is acknowledged, False if the job was aborted.
+    #   report(engine) is called every interval seconds meanwhile.
+    def waitForJob(self, report = None, interval = 1.):
+        reported_at = time.monotonic()
+        while not self.isJobDone():
+            if not self._isConnected() or self._stream_state == "error":
+                return False
+            time.sleep(0.01)
+            if report is not None and time.monotonic() - reported_at >= interval:
+                reported_at = time.monotonic()
+                report(self)
+        # Progress is only updated every _progress_interval while sending
+        self._stream_progress = 100.
+        if self._job_estimate is not None:
+            self._stream_elapsed = self._job_estimate.total
+        return True
+
+    def getJobProgress(self):
+        """Progress of the job in %, by estimated print time if there is an estimate."""
+        return self._stream_progress
+
+    def getJobElapsed(self):
+        """Estimated print time in s of the lines sent so far."""
+        return self._stream_elapsed
+
+    def getJobEstimate(self):
+        return self._job_estimate
+
+    def getThroughput(self):
+        """(lines/s, bytes/s) sent since the job started."""
+        if self._stream_started is None:
+            return 0., 0.
+        started, lines_sent, bytes_sent = self._stream_started
+        elapsed = max(time.monotonic() - started, 1e-9)
+        return (self._metrics.lines_sent - lines_sent) / elapsed, (self._metrics.bytes_sent - bytes_sent) / elapsed
+
+    # Send and receive loops
+
+    ##  Enables debug logging of every n-th sent and received line.
+    def setLineLogging(self, enabled, every = None):
+        self._log_lines = enabled
+        if every:
+            self._log_lines_every = every
+
+    ##  Starts recording the exchange with the printer into a ring-buffered trace file.
+    def startTrace(self, path, capacity = 16 * 1024 * 1024):
+        self.stopTrace()
+        self._trace_recorder = Trace.TraceRecorder(path, capacity)
+        if self.serial_connection:
+            self.serial_connection.setTraceRecorder(self._trace_recorder)
+        Logger.log("i", "Recording protocol trace of %s to %s", self.getName(), path)
+
+    def stopTrace(self):
+        if self._trace_recorder is None:
+            return
+        if self.serial_connection:
+            self.serial_connection.setTraceRecorder(None)
+        self._trace_recorder.close()
+        self._trace_recorder = None
+
+    ##  Profiles every job from now on (see Profiling), the reports go to directory (None: the default one).
+    #   interval in s between samples of the threads, memory traces allocations (slowing them down).
+    def setProfiling(self, enabled, directory = None, interval = Profiling.SAMPLE_INTERVAL, memory = True):
+        self._profiling = enabled
+        self._profile_directory = directory
+        self._profile_interval = interval
+        self._profile_memory = memory
+
+    ##  Profiles only the next job, like setProfiling.
+    def profileNextJob(self, directory = None, interval = Profiling.SAMPLE_INTERVAL, memory = True):
+        self._profile_next_job = True
+        self._profile_directory = directory
+        self._profile_interval = interval
+        self._profile_memory = memory
+
+    ##  Report of the last profiled job, None if there is none (yet).
+    def getProfilePath(self):
+        return self._profile_path
+
+    def _startProfile(self):
+        """Starts profiling the job which is about to be queued, if profiling is on."""
+        self._finishProfile("replaced")
+        if not (self._profiling or self._profile_next_job):
+            return
+        self._profile_next_job = False
+        path = Profiling.profilePath(self._profile_directory or self._profileDirectory(), self.getName())
+        self._profile = Profiling.JobProfile(self.getName(), path, self._profile_interval, self._profile_memory).start()
+
+    def _finishProfile(self, outcome):
+        profile = self._profile
+        if profile is None:
+            return
+        self._profile = None
+        self._profile_path = profile.finish(outcome, {"metrics": self._metrics.getSummary()})
+
+    ##  Returns the metrics collector of this device.
+    def getMetrics(self):
+        return self._metrics
+
+    def _receive(self):
+        while self._isConnected():
+            connection = self.serial_connection
+            if connection is None or not connection.isConnected():
+                # The send thread reconnects, answers can't arrive meanwhile
+                time.sleep(0.01)
+                continue
+            received_line = connection.receiveLine()
+            
+            if received_line:
+                # Anything may have freed the window
+                self._send_wakeup.set()
+                if self._log_lines:
+                    self._logged_received_lines += 1
+                    if self._logged_received_lines % self._log_lines_every == 1:
+                        Logger.log("d", "Received new line: %s", repr(received_line))
+
+                if not self._heat_wait is None:
+                    # Before the answer is handled, so a polled report is there when its "ok" is
+                    self._heatReport(received_line)
+
+                message = Connection.parseBridgeMessage(received_line)
+                resend = None if message else Connection.parseResend(received_line)
+                if not message is None:
+                    self._bridgeMessage(*message)
+                elif not resend is None:
+                    self._metrics.countResend()
+                    self._requestResend(resend)
+                elif self._skip_oks and received_line.startswith("ok"):
+                    # Follows every resend request, it doesn't belong to a command
+                    self._skip_oks -= 1
+                else:
+                    # Answers belong to the oldest command still waiting for its "ok"
+                    with self._in_flight_lock:
+                        if self._in_flight:
+                            sent_command, sent_at, sent_time, number, position = self._in_flight[0]
+                            sent_command.parseAnswer(received_line)
+                            if sent_command.hasFinished():
+                                self._in_flight.popleft()
+                                self._acknowledged(sent_at, number, position)
+                    if self._flow_control == Capabilities.FLOW_ADVANCED_OK:
+                        self._updateFlowWindow(received_line)
+
+                # Different answers
+                if self._command_table.isSdCardOk(received_line):
+                    self._sd_card_status = "ok"
+
+                if self._command_table.isSdCardFailed(received_line):
+                    self._sd_card_status = "failed"
+
+            with self._in_flight_lock:
+                if self._in_flight:
+                    sent_command, sent_at, sent_time, number, position = self._in_flight[0]
+                    timeout = self._command_table.timeout(sent_command.opcode(), sent_command.recommendedTimeOut or self._send_timeout)
+                    if self._bridge_window:
+                        # Waited in the bridge's buffer, the firmware has it since the last "@ok" at most
+                        sent_time = max(sent_time, self._bridge_acked_at)
+                    if timeout != -1 and timeout <= time.time() - sent_time:
+                        # Given up on, the next command may be sent
+                        sent_command.hasTimedOut(True)
+                        self._in_flight.popleft()
+                        self._metrics.countTimeout()
+                        self._send_wakeup.set()
+
+            #print_information = Application.getInstance().getPrintInformation()
+
+    def _acknowledged(self, sent_at, number, position):
+        if not position is None and not self._journal is None:
+            self._journal.acknowledge(*position)
+        self._last_ok_time = time.monotonic()
+        self._metrics.addRoundTrip(self._last_ok_time - sent_at)
+        if not number is None:
+            self._last_acknowledged_line = number
+            if not self._last_resend is None and number >= self._last_resend:
+                # Errors of lines sent before the resend are through
+                self._stale_resends = 0
+
+    ##  The firmware asks for all lines from number on again (called with _in_flight_lock free).
+    def _requestResend(self, number):
+        with self._in_flight_lock:
+            self._skip_oks += 1
+            if number == self._last_resend and self._stale_resends:
+                # Error of a line which was sent before the resend started, it's already being resent
+                self._stale_resends -= 1
+                return
+            # Everything in front of the requested line has arrived
+            while self._in_flight and not self._in_flight[0][3] is None and self._in_flight[0][3] < number:
+                sent_command, sent_at, sent_time, line_number, position = self._in_flight.popleft()
+                sent_command.parseAnswer("ok")
+                self._acknowledged(sent_at, line_number, position)
+            self._resend_request = number
+
+    ##  Sends the lines requested by the firmware again, returns False if they are gone.
+    def _resendLines(self):
+        with self._in_flight_lock:
+            number = self._resend_request
+            self._resend_request = None
+            lines = self._resend_buffer.linesFrom(number)
+            if lines is None:
+                Logger.log("e", "Line %s was requested again, but it isn't kept anymore", number)
+                return False
+            replaced = {}
+            kept = collections.deque()
+            for entry in self._in_flight:
+                if not entry[3] is None and entry[3] >= number:
+                    replaced[entry[3]] = entry
+                else:
+                    kept.append(entry)
+            self._last_resend = number
+            self._stale_resends = sum(1 for line_number in replaced if line_number > number)
+            sent_at = time.monotonic()
+            sent_time = time.time()
+            for line_number, data in enumerate(lines, number):
+                entry = replaced.get(line_number)
+                if entry is None:
+                    # Not waiting for an answer anymore (eg. timed out), but the firmware still needs it
+                    command, position = GCodeLibrary.RawLine(data), None
+                else:
+                    command, position = entry[0], entry[4]
+                command.reset()
+                kept.append((command, sent_at, sent_time, line_number, position))
+            self._in_flight = kept
+        if lines:
+            Logger.log("d", "Resending %s line(s) from line %s on", len(lines), number)
+            self.serial_connection.sendLines(lines)
+        return True
+
+    ##  Reconnects with exponential backoff and resumes streaming by line number.
+    def _reconnect(self):
+        Logger.log("w", "Lost connection to %s, reconnecting...", self.getName())
+        started = time.monotonic()
+        reconnected = Connection.reconnectWithBackoff(self.serial_connection,
+                                                      self._reconnect_delay,
+                                                      self._reconnect_max_delay,
+                                                      self._reconnect_timeout,
+                                                      lambda: self._isConnected(),
+                                                      )
+        if not reconnected:
+            Logger.log("e", "Could not reconnect to %s, giving up", self.getName())
+            self._abortJob()
+            self._connectionLost()
+            return False
+        self._metrics.countReconnect(time.monotonic() - started)
+        # The bridge starts over with every connection
+        self._startBridgeBuffering()
+        with self._in_flight_lock:
+            # Answers of the old connection are lost, so are lines without a line number
+            unnumbered = [entry for entry in self._in_flight if entry[3] is None]
+            if unnumbered:
+                Logger.log("w", "%s line(s) without line number may have been lost", len(unnumbered))
+            self._in_flight = collections.deque(entry for entry in self._in_flight if not entry[3] is None)
+            self._skip_oks = 0
+            self._stale_resends = 0
+            self._last_resend = None
+            if self._in_flight:
+                # Either the firmware has them and asks for the next line, or it takes them now
+                self._resend_request = self._in_flight[0][3]
+        return True
+
+    def _abortJob(self):
+        with self._in_flight_lock:
+            self._in_flight.clear()
+        while self.queue_gcode:
+            item = self.queue_gcode.popleft()
+            if isinstance(item, JobSource.FileJobSource):
+                item.close()
+        self._job_source = None
+        # Not done, it stays an error
+        self.queue_gcode_begin = None
+        self._dropHeatWait()
+        self._finishProfile("aborted")
+        self._resend_request = None
+        self._sync_line_numbers = True
+        # Kept, the job can be resumed from there
+        self._closeJournal()
+        self._updateJobState("error")
+
+    def _closeJournal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    ##  Number of commands which may wait for their "ok" at the same time, 1 is stop-and-wait.
+    #   All lines allowed by the window are written with a single syscall.
+    def setSendWindow(self, window):
+        self._send_window = max(int(window), 1)
+
+    def getSendWindow(self):
+        return self._send_window
+
+    def _window(self):
+        return self._bridge_window or self._flow_window or self._send_window
+
+    ##  Lets the bridge buffer the job and pace the "ok"s: None when the bridge advertises
+    #   Connection.BRIDGE_BUFFER_PROPERTY, True or False regardless. Takes effect with the next connection.
+    def setBridgeBuffering(self, enabled):
+        self._bridge_buffering = enabled
+
+    ##  Lines the bridge has in its buffer at most, None while not buffering.
+    def getBridgeWindow(self):
+        return self._bridge_window
+
+    def _startBridgeBuffering(self):
+        self._bridge_window = None
+        enabled = self._bridge_buffering
+        if enabled is None:
+            enabled = bool((self._bridgeProperties() or {}).get(Connection.BRIDGE_BUFFER_PROPERTY))
+        if enabled:
+            # Answered with "@buffer <lines>", lines sent meanwhile are buffered already
+            self.serial_connection.send(Connection.BRIDGE_BUFFER_ON)
+
+    def _bridgeMessage(self, name, arguments):
+        """Handles "@buffer <lines>" and "@ok <count>" (count "ok"s of the firmware) of a buffering bridge."""
+        try:
+            values = [int(argument) for argument in arguments]
+        except ValueError:
+            values = []
+        if name == "ok" and values:
+            with self._in_flight_lock:
+                for _ in range(min(values[0], len(self._in_flight))):
+                    sent_command, sent_at, sent_time, number, position = self._in_flight.popleft()
+                    sent_command.parseAnswer("ok")
+                    self._acknowledged(sent_at, number, position)
+            self._bridge_acked_at = time.time()
+        elif name == "buffer" and values:
+            Logger.log("i", "The bridge of %s buffers up to %s lines", self.getName(), values[0])
+            self._bridge_acked_at = time.time()
+            self._bridge_window = max(values[0], 1)
+        else:
+            Logger.log("w", "Unexpected message of the bridge: %s", " ".join(["@" + name] + arguments))
+
+    ##  Capabilities of the firmware (Capabilities.FirmwareCapabilities), None until known.
+    def getCapabilities(self):
+        return self._capabilities
+
+    ##  Whether to ask the firmware with M115 on connect, if its capabilities aren't stored yet.
+    def setCapabilityHandshake(self, enabled):
+        self._capability_handshake = enabled
+
+    ##  Drops the stored capabilities, eg. after a firmware update. They are asked for on the next connect.
+    def forgetCapabilities(self):
+        store = self._capabilityStore()
+        if store is not None:
+            store.forget(self.getName())
+        self._capabilities = None
+        self._firmware_buffer_size = 0
+
+    def _negotiateCapabilities(self):
+        """Uses the stored capabilities of this printer, asks the firmware if there are none."""
+        store = self._capabilityStore()
+        capabilities = None
+        if store is not None:
+            capabilities = store.lookup(self.getName(), self._advertisedFirmware())
+        if capabilities is None and self._capability_handshake:
+            request = GCodeLibrary.RepRapCommands().M115()
+            self.injectCommand(request, wait = True)
+            if request.hasFinished() and request.getFirmwareInfo():
+                capabilities = Capabilities.FirmwareCapabilities.fromM115(request)
+                if store is not None:
+                    try:
+                        store.store(self.getName(), capabilities)
+                    except OSError:
+                        Logger.logException("w", "Could not store the capabilities of %s!", self.getName())
+            else:
+                Logger.log("w", "%s didn't report its capabilities, assuming the basic ones", self.getName())
+        if capabilities is None:
+            capabilities = Capabilities.FirmwareCapabilities()
+        self._applyCapabilities(capabilities)
+
+    def _applyCapabilities(self, capabilities):
+        self._capabilities = capabilities
+        self._flow_control = capabilities.flowControl()
+        self._flow_window = None
+        self._command_table = (CommandTables.tableForFirmware(capabilities.getFirmwareName()) or
+                               CommandTables.tableForCuraFlavor(self._gcodeFlavor()) or
+                               CommandTables.MARLIN)
+        Logger.log("i", "%s runs %s, commands: %s, flow control: %s, SD transfer: %s", self.getName(),
+                   capabilities.getFirmwareName() or "an unknown firmware", self._command_table.name,
+                   self._flow_control, capabilities.transferMode())
+
+    def _updateFlowWindow(self, line):
+        """Sizes the send window by the free command slots of an ADVANCED_OK "ok"."""
+        values = Connection.parseAdvancedOk(line)
+        if values is None or not "B" in values:
+            return
+        # All slots are free whenever the firmware caught up, so this converges to its buffer size.
+        # Lines in flight never exceed it, they can't overflow the buffer.
+        self._firmware_buffer_size = max(self._firmware_buffer_size, values["B"])
+        self._flow_window = max(1, min(self._firmware_buffer_size, self._max_flow_window))
+
+    ##  Sends lines with line number and checksum, which allows resuming after reconnects.
+    #   Takes effect with the next connection.
+    def setLineNumbers(self, enabled):
+        self._line_numbers = enabled
+
+    ##  Sends job lines as dry run (the default): without extrusion and with temperatures at 50 degrees.
+    #   Lines of job files are copied one by one to apply it. Off, they go from the file's mapping to
+    #   the socket as they are, unless line numbers are added. Takes effect with the next job.
+    def setDryRun(self, enabled):
+        self._dry_run = bool(enabled)
+
+    ##  Link of the next connection: a name of Connection.TRANSPORTS or a callable returning a
+    #   Connection.StreamConnection, eg. Connection.createSocketPairConnector(peer).
+    def setTransport(self, transport):
+        if not callable(transport):
+            if transport not in Connection.TRANSPORTS:
+                raise ValueError("Unknown transport: %s" %transport)
+            transport = Connection.TRANSPORTS[transport]
+        self.serial_connector = transport
+
+    ##  Rate in bytes/s this printer gets in any case while streaming (not while uploading), and
+    #   the most it may use. See Bandwidth.getScheduler() for the rate of all printers together.
+    def setBandwidth(self, guaranteed = Bandwidth.LIVE_GUARANTEED, limit = None):
+        self._bandwidth_guaranteed = guaranteed
+        self._bandwidth_limit = limit
+        if self._bandwidth_share is not None:
+            self._bandwidth_share.configure(guaranteed, limit)
+
+    def _releaseBandwidth(self):
+        if self._bandwidth_share is not None:
+            Bandwidth.getScheduler().unregister(self._bandwidth_share)
+            self._bandwidth_share = None
+
+    ##  Waits for temperatures on the host: M109, M190 and M191 go out as M104, M140 and M141, the
+    #   job's following lines wait for the temperature reports. The link stays free meanwhile.
+    #   tolerance in degrees, residency in s the temperature has to stay there. See HeatWait.
+    def setHostHeatWaits(self, enabled, tolerance = HeatWait.TOLERANCE, residency = 0.):
+        self._host_heat_waits = enabled
+        self._heat_tolerance = tolerance
+        self._heat_residency = residency
+
+    ##  The HeatWait.HeatWait the job is held back by, None while not waiting.
+    def getHeatWait(self):
+        return self._heat_wait
+
+    def _startHeatWait(self, command, position):
+        """Returns the non-blocking command replacing a blocking heat wait, None if it goes as it is."""
+        rewritten = HeatWait.rewrite(command, self._heat_tolerance, self._heat_residency)
+        if rewritten is None:
+            return None
+        data, wait = rewritten
+        wait.position = position
+        self._heat_poll = None
+        self._heat_wait = wait
+        Logger.log("d", "Waiting for the temperature of %s on the host: %s", wait.heater, data.decode("utf-8", "replace"))
+        return GCodeLibrary.RawLine(data)
+
+    def _heatReport(self, line):
+        """Ends the heat wait once a temperature report shows the target (receive thread)."""
+        wait = self._heat_wait
+        if wait is None:
+            return
+        temperatures = HeatWait.parseTemperatures(line)
+        if temperatures and wait.update(temperatures):
+            Logger.log("d", "%s reached %s after %.1fs", wait.heater, wait.temperature, wait.getElapsed())
+            if not wait.position is None and not self._journal is None:
+                # Done like the firmware's wait, a resumed job doesn't skip it
+                self._journal.acknowledge(*wait.position)
+            self._heat_wait = None
+            self._send_wakeup.set()
+
+    def _heatWaitLine(self, wait):
+        """Line to send while waiting for wait (prepared by _prepareLine), if any: M105 when a report is due.
+
+        Without reports the original command is sent after all, the firmware waits then.
+        """
+        now = time.monotonic()
+        interval = wait.pollInterval(self._heat_poll_interval)
+        if not self._heat_poll is None:
+            poll, polled_at = self._heat_poll
+            if now - polled_at < interval or not (poll.hasFinished() or poll.hasTimedOut()):
+                return None
+            if wait.reported_at is None or wait.reported_at < polled_at:
+                Logger.log("w", "%s doesn't report its temperatures, leaving the heat waits to the firmware", self.getName())
+                self._heat_reports_missing = True
+                self._heat_wait = None
+                wait.command.isOkCommand(True)
+                wait.command.reset()
+                return self._prepareLine(wait.command, True, wait.position)
+        if not wait.reported_at is None and now - wait.reported_at < interval:
+            # Reported by itself, eg. with M155
+            return None
+        poll = GCodeLibrary.RawLine(b"M105")
+        self._heat_poll = (poll, now)
+        return self._prepareLine(poll)
+
+    def _stageJobLines(self):
+        """Takes the lines behind a heat wait from the G-Code queue meanwhile, they go out right after it."""
+        staged = self._heat_staged
+        while self.queue_gcode and len(staged) < self._send_batch_size:
+            source = self.queue_gcode[0]
+            if not isinstance(source, JobSource.FileJobSource):
+                staged.append((self.queue_gcode.popleft(), None))
+                continue
+            command = source.next()
+            if command is JobSource.END:
+                # Left in the queue, the job is complete once the staged lines are sent
+                break
+            staged.append((command, source.position))
+
+    def _dropHeatWait(self):
+        self._heat_wait = None
+        self._heat_poll = None
+        self._heat_staged.clear()
+
+    ##  Next command of the G-Code queue and the byte offset behind it in its job file (None for other items).
+    def _takeJobLine(self):
+        if self._heat_staged:
+            return self._heat_staged.popleft()
+        source = self.queue_gcode[0]
+        command = self._popQueue()
+        return command, source.position if isinstance(source, JobSource.FileJobSource) else None
+
+    ##  TCP options of the connection, see Connection.TcpConnection.setSocketOptions.
+    def setSocketOptions(self, **options):
+        self._socket_options.update(options)
+        if self.serial_connection:
+            self.serial_connection.setSocketOptions(**options)
+
+    def _send(self):
+        while self._isConnected():
+            # Cleared before looking, so nothing which happens meanwhile is missed
+            self._send_wakeup.clear()
+            profile = self._profile
+            connection = self.serial_connection
+            if connection is None:
+                break
+            if not connection.isConnected():
+                if not self._reconnect():
+                    break
+                continue
+
+            if not self._resend_request is None:
+                if not self._resendLines():
+                    self._abortJob()
+                continue
+
+            if len(self._in_flight) >= self._window():
+                #Logger.log("d", "Wait for command to be processed...")
+                self._waitToSend(profile)
+                continue
+
+            batch = self._nextBatch()
+            if not batch:
+                self._waitToSend(profile)
+                continue
+            sent_at = self._sendStarted()
+            sent_time = time.time()
+            with self._in_flight_lock:
+                for command, data, number, position in batch:
+                    # Registered before writing, the answer could be faster than us
+                    if not command.hasFinished():
+                        self._in_flight.append((command, sent_at, sent_time, number, position))
+            self._sent_command = batch[-1][0]
+            if self._bandwidth_share is not None:
+                # Writing a file can wait, streaming can't
+                self._bandwidth_share.setPriority(Bandwidth.PRIORITY_BULK if self._receive_mode == "ok" else Bandwidth.PRIORITY_LIVE)
+            if profile is None:
+                connection.sendLines([item[1] for item in batch])
+            else:
+                started = time.perf_counter()
+                connection.sendLines([item[1] for item in batch])
+                profile.addSpan("send", time.perf_counter() - started)
+    
+            #print_information = Application.getInstance().getPrintInformation()
+
+    def _waitToSend(self, profile):
+        """Sleeps until an answer or a new command arrives, _send_poll seconds at most."""
+        if profile is None:
+            self._send_wakeup.wait(self._send_poll)
+            return
+        started = time.perf_counter()
+        self._send_wakeup.wait(self._send_poll)
+        profile.addSpan("wait", time.perf_counter() - started)
+
+    ##  Returns (command, data to send, line number or None, job position or None).
+    #   The job position is (lines done, byte offset behind the line) for lines of a job file.
+    def _prepareLine(self, command, numbered = True, position = None):
+        if not (self._line_numbers and numbered):
+            return command, command, None, position
+        number, data = self._resend_buffer.number(command.encoded(), getattr(command, "body_checksum", None))
+        return command, data, number, position
+
+    ##  Commands which may be sent now: injected lines first, then the G-Code queue.
+    def _nextBatch(self):
+        batch = []
+        command_table = self._command_table
+        # Spans of a profiled job per batch
+        profile = self._profile
+        parse_time = encode_time = 0.
+        window = self._window() - len(self._in_flight)
+        if self._line_numbers and self._sync_line_numbers:
+            # Numbering starts over, whatever the firmware counted before
+            self._sync_line_numbers = False
+            sync = GCodeLibrary.RawLine(self._resend_buffer.reset())
+            batch.append((sync, sync, None, None))
+            window -= 1
+        while window > 0 and len(batch) < self._send_batch_size:
+            # First: injected lines, eg. for changing temperature
+            if not self.queue_injected.empty():
+                command = self.queue_injected.get()
+                batch.append(self._prepareLine(command, self._receive_mode != "ok"))
+                if command.isOkCommand():
+                    window -= 1
+                continue
+
+            # Read once, the receive thread ends the wait once the target is reached
+            heat_wait = self._heat_wait
+            if not heat_wait is None and not self._send_is_blocked:
+                # The job waits for a temperature, the link doesn't
+                line = self._heatWaitLine(heat_wait)
+                if not line is None:
+                    batch.append(line)
+                    window -= 1
+                    if self._heat_wait is None:
+                        # Left to the firmware
+                        continue
+                self._stageJobLines()
+                break
+
+            # Regulary: GCode queue
+            if (self.queue_gcode or self._heat_staged) and not self._send_is_blocked:
+                if self.queue_gcode_begin is None:
+                    self.queue_gcode_begin = time.time()
+                    self._updateJobState("printing")
+
+                #command = self.queue_gcode.get()
+                if not profile is None:
+                    started = time.perf_counter()
+                command, offset = self._takeJobLine()
+                if not profile is None:
+                    parse_time += time.perf_counter() - started
+                if command is JobSource.END:
+                    continue
+                self.queue_gcode_sent += 1
+                position = None
+                if not offset is None:
+                    position = (self.queue_gcode_sent - self._job_line_offset, offset)
+                switches_mode = False
+                if command:
+                    command.setDryRun(self._dry_run)
+                    flags = command_table.flags(command.opcode())
+                    if (flags & CommandTables.FLAG_BLOCKING and self._host_heat_waits and
+                        not self._heat_reports_missing and self._receive_mode != "ok"):
+                        replacement = self._startHeatWait(command, position)
+                        if not replacement is None:
+                            # Its position is done once the wait is
+                            command, position = replacement, None
+                            flags = command_table.flags(command.opcode())
+                    if self._receive_mode == "ok" and not flags & CommandTables.FLAGS_FILE_WRITE:
+                        # Written into the file, the firmware only confirms it
+                        command.isOkCommand(True)
+                    else:
+                        command.isOkCommand(bool(flags & CommandTables.FLAG_ACKS_OK))
+                    command.reset()
+                    # Lines written to the SD card go without line number, Marlin would store it
+                    if not profile is None:
+                        started = time.perf_counter()
+                    batch.append(self._prepareLine(command, self._receive_mode != "ok", position))
+                    if not profile is None:
+                        encode_time += time.perf_counter() - started
+                    if command.isOkCommand():
+                        window -= 1
+                    if flags & CommandTables.FLAG_ENTERS_FILE_WRITE:
+                        Logger.log("d", "Writing file. All answers are now 'ok'")
+                        self._receive_mode = "ok"
+                        self._upload_started = (time.monotonic(), self._metrics.lines_sent + len(batch))
+                        switches_mode = True
+                    elif flags & CommandTables.FLAG_LEAVES_FILE_WRITE:
+                        Logger.log("d", "Writing file has finished. All answers are now normal")
+                        self._receive_mode = "normal"
+                        self._countUpload(len(batch))
+                        switches_mode = True
+                if not self.queue_gcode_size is None:
+                    if self._log_lines:
+                        self._logged_sent_lines += 1
+                        if self._logged_sent_lines % self._log_lines_every == 1:
+                            Logger.log("d", "Sending line from G-Code queue: %s/%s", self.queue_gcode_sent, self.queue_gcode_size)
+                    self._updateProgress()
+                if switches_mode:
+                    # The printer has to see the mode change before the following lines
+                    break
+                continue
+            elif not self._send_is_blocked:
+                if not self.queue_gcode_begin is None:
+                    Logger.log("d", "Sending the G-Code queue took: %ss", time.time() - self.queue_gcode_begin)
+                    self._updateJobState("ready")
+                self.queue_gcode_begin = None
+                self.queue_gcode_size = None
+                self._finishProfile("done")
+            break
+        if not profile is None and batch:
+            profile.addSpan("parse", parse_time)
+            profile.addSpan("encode", encode_time)
+        return batch
+
+    def _countUpload(self, batched):
+        """Adds the lines/s of the finished upload to the metrics, batched lines not being sent yet."""
+        if self._upload_started is None:
+            return
+        started, lines_sent = self._upload_started
+        self._upload_started = None
+        elapsed = time.monotonic() - started
+        if elapsed > 0.:
+            self._metrics.addUploadRate((self._metrics.lines_sent + batched - lines_sent) / elapsed)
+
+    ##  Next item of the G-Code queue, pulling lines from a queued job source one by one.
+    def _popQueue(self):
+        item = self.queue_gcode[0]
+        if not isinstance(item, JobSource.FileJobSource):
+            return self.queue_gcode.popleft()
+        command = item.next()
+        if command is JobSource.END:
+            self.queue_gcode.popleft()
+            item.close()
+            self._job_source = None
+            self._journal_complete = True
+        return command
+
+    ##  Updates progress and elapsed time, at most every _progress_interval seconds.
+    def _updateProgress(self):
+        now = time.monotonic()
+        if self.queue_gcode and now - self._progress_updated_at < self._progress_interval:
+            return
+        self._progress_updated_at = now
+        self._setJobProgress(self.queue_gcode_sent - self._job_line_offset)
+
+    ##  Book-keeping right before a command goes out, returns the send timestamp.
+    def _sendStarted(self):
+        now = time.monotonic()
+        if not self._last_ok_time is None:
+            self._metrics.addOkToSend(now - self._last_ok_time)
+            self._last_ok_time = None
+        if self.queue_gcode_size is None:
+            self._metrics.addQueueDepth(len(self.queue_gcode))
+        else:
+            self._metrics.addQueueDepth(self.queue_gcode_size - self.queue_gcode_sent)
+        return now
+    
+    def injectCommand(self, command, wait = False):
+        self.queue_injected.put(command)
+        self._send_wakeup.set()
+        if wait:
+            while not (command.hasFinished() or command.hasTimedOut()):
+                time.sleep(0.125)
+
+
+def _sendPrinterJobs(engine, printer, paths, upload_name, workers, report, interval, results, baudrate = None, auto_upload = False):
+    results[printer] = False
+    try:
+        if baudrate is not None:
+            # A serial port, nothing to resolve
+            address, port, properties = printer, baudrate, {}
+        else:
+            address, port, properties = resolvePrinter(printer)
+        if properties.get(b"firmware"):
+            engine._advertised_firmware = properties[b"firmware"].decode("utf-8")
+        engine._bridge_properties = properties
+        engine.start(address, port)
+    except Exception:
+        Logger.logException("e", "Could not connect to %s!", printer)
+        return
+    try:
+        for path in paths:
+            name = upload_name
+            if auto_upload and upload_name:
+                preflight = engine.preflightFile(path)
+                Logger.log("i", "%s to %s: %s", os.path.basename(path), printer, preflight.getSummary())
+                if preflight.mode != Preflight.MODE_SD:
+                    name = None
+            engine.sendFile(path, name, workers = workers)
+            if not engine.waitForJob(lambda engine: report(engine, path) if report else None, interval):
+                Logger.log("e", "Sending %s to %s has failed", path, printer)
+                return
+            if report is not None:
+                report(engine, path)
+        results[printer] = True
+    except Exception:
+        Logger.logException("e", "Could not send the jobs to %s!", printer)
+    finally:
+        engine.stop()
+
+def sendJobs(printers, paths, upload_name = None, workers = 0, report = None, interval = 1., **options):
+    """Sends the files one after another to each printer, all printers at the same time.
+
+    printers are addresses or Zeroconf names (see resolvePrinter), or serial
+    ports with the transport "serial". upload_name uploads every file to the
+    SD card and prints it from there. report(engine, path) is called every
+    interval seconds. Options are send_window, line_numbers, capability_store
+    (a file), transport (see StreamingEngine.setTransport), baudrate,
+    bridge_buffering (see StreamingEngine.setBridgeBuffering), guaranteed
+    (bytes/s, see StreamingEngine.setBandwidth), host_heat_waits (see
+    StreamingEngine.setHostHeatWaits), dry_run (see StreamingEngine.setDryRun),
+    profile_directory (profiles every job, see StreamingEngine.setProfiling)
+    and auto_upload (uploads only the files the preflight analysis expects to
+    finish sooner from the SD card, see StreamingEngine.preflightFile).
+    Returns {printer: success}.
+    """
+    transport = options.get("transport", "tcp")
+    baudrate = options.get("baudrate", 115200) if transport == "serial" else None
+    results = {}
+    threads = []
+    for printer in printers:
+        engine = StreamingEngine(printer)
+        engine.setTransport(transport)
+        engine.setSendWindow(options.get("send_window", 1))
+        engine.setLineNumbers(options.get("line_numbers", True))
+        engine.setCapabilityStore(options.get("capability_store"))
+        engine.setBridgeBuffering(options.get("bridge_buffering"))
+        engine.setBandwidth(options.get("guaranteed", Bandwidth.LIVE_GUARANTEED))
+        engine.setHostHeatWaits(options.get("host_heat_waits", False))
+        engine.setDryRun(options.get("dry_run", True))
+        if options.get("profile_directory"):
+            engine.setProfiling(True, options["profile_directory"])
+        thread = threading.Thread(target = _sendPrinterJobs,
+                                  args = (engine, printer, paths, upload_name, workers, report, interval, results, baudrate,
+                                          options.get("auto_upload", False)),
+                                  daemon = True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,73 @@
+import argparse
+import logging
+import os
+import sys
+
+from .. import Bandwidth
+from . import sendJobs
+
+parser = argparse.ArgumentParser(description = "Sends G-code files to printers behind a WiFi serial bridge or on a serial port, without Cura.")
+parser.add_argument("files", nargs = "+", help = "G-code files, sent one after another")
+parser.add_argument("-p", "--printer", action = "append", required = True,
+                    help = "address, host:port or Zeroconf name of a printer (the device with --serial), may be given several times")
+parser.add_argument("--serial", action = "store_true", help = "the printers are serial ports, eg. /dev/ttyUSB0")
+parser.add_argument("--baudrate", type = int, default = 115200, help = "baud rate of the serial ports")
+parser.add_argument("--upload", metavar = "NAME", help = "upload to the SD card under this name and print from there")
+parser.add_argument("--auto", action = "store_true",
+                    help = "with --upload, upload only the files which finish sooner from the SD card than streamed")
+parser.add_argument("--window", type = int, default = 1, help = "commands waiting for their 'ok' at the same time")
+parser.add_argument("--no-line-numbers", action = "store_true", help = "send lines without line number and checksum")
+parser.add_argument("--no-dry-run", action = "store_true",
+                    help = "print for real: send extrusion and temperatures as they are (sent as dry run by default)")
+parser.add_argument("--workers", type = int, default = 0, help = "processes preprocessing the files, 0 reads them line by line")
+parser.add_argument("--bridge-buffer", dest = "bridge_buffering", action = "store_const", const = True,
+                    help = "let the bridge buffer the job even if it doesn't advertise it")
+parser.add_argument("--no-bridge-buffer", dest = "bridge_buffering", action = "store_const", const = False,
+                    help = "send line by line even if the bridge could buffer")
+parser.add_argument("--bandwidth", type = float, metavar = "KB/S", help = "rate of all printers together at most")
+parser.add_argument("--guaranteed", type = float, default = Bandwidth.LIVE_GUARANTEED / 1e3, metavar = "KB/S",
+                    help = "rate each printer gets in any case while streaming (uploads only get what's left)")
+parser.add_argument("--host-heat-waits", action = "store_true",
+                    help = "wait for temperatures (M109, M190) on the host, the link stays free meanwhile")
+parser.add_argument("--profile", metavar = "DIRECTORY", help = "profile every job, the reports go into this directory")
+parser.add_argument("--capabilities", metavar = "FILE", help = "remember the firmware capabilities in this file")
+parser.add_argument("--interval", type = float, default = 5., help = "seconds between progress reports")
+parser.add_argument("-v", "--verbose", action = "store_true", help = "log the details")
+options = parser.parse_args()
+if options.auto and not options.upload:
+    parser.error("--auto needs --upload")
+for path in options.files:
+    if not os.path.isfile(path):
+        parser.error("no such file: %s" %path)
+
+logging.basicConfig(level = logging.DEBUG if options.verbose else logging.WARNING,
+                    format = "%(asctime)s %(levelname)s %(message)s")
+
+def report(engine, path):
+    lines, data = engine.getThroughput()
+    estimate = engine.getJobEstimate()
+    remaining = ""
+    if estimate is not None:
+        remaining = ", %.0f of %.0f s printed" %(engine.getJobElapsed(), estimate.total)
+    print("%s: %s %5.1f%%, %.0f lines/s, %.1f kB/s%s" %(engine.getName(), os.path.basename(path), engine.getJobProgress(),
+                                                       lines, data / 1e3, remaining))
+    sys.stdout.flush()
+
+if options.bandwidth:
+    Bandwidth.getScheduler().setRate(options.bandwidth * 1e3)
+
+results = sendJobs(options.printer, options.files, options.upload, options.workers, report, options.interval,
+                   send_window = options.window,
+                   line_numbers = not options.no_line_numbers,
+                   capability_store = options.capabilities,
+                   transport = "serial" if options.serial else "tcp",
+                   baudrate = options.baudrate,
+                   bridge_buffering = options.bridge_buffering,
+                   guaranteed = options.guaranteed * 1e3,
+                   host_heat_waits = options.host_heat_waits,
+                   dry_run = not options.no_dry_run,
+                   profile_directory = options.profile,
+                   auto_upload = options.auto)
+for printer, success in results.items():
+    print("%s: %s" %(printer, "done" if success else "FAILED"))
+sys.exit(0 if all(results.values()) else 1)
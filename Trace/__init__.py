@@ -0,0 +1,290 @@
+'''
+Binary protocol trace recorder and deterministic replay.
+
+A trace file is a fixed-size ring buffer mapped into memory:
+
+    header:  magic, version, flags, capacity, head, tail, wall clock and
+             monotonic time when the trace was opened
+    records: monotonic timestamp (float64), direction (uint8),
+             length (uint16), payload
+
+Records are never split at the end of the ring. If a record does not fit
+anymore, a padding record (or nothing, if not even the record header fits)
+is written and the writer wraps to the beginning, dropping the oldest
+records.
+'''
+
+import mmap
+import struct
+import threading
+import time
+
+MAGIC = b"CSPT"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHQQQdd")
+RECORD = struct.Struct("<dBH")
+
+FLAG_WRAPPED = 0x1
+
+DIRECTION_PAD = 0
+DIRECTION_SENT = 1
+DIRECTION_RECEIVED = 2
+DIRECTION_EVENT = 3
+
+DIRECTION_NAMES = {DIRECTION_SENT: "sent",
+                   DIRECTION_RECEIVED: "received",
+                   DIRECTION_EVENT: "event",
+                   }
+
+MAX_PAYLOAD = 0xFFFF
+
+class TraceRecorder():
+    def __init__(self, path, capacity = 16 * 1024 * 1024):
+        if capacity < 4 * (RECORD.size + MAX_PAYLOAD):
+            raise ValueError("Trace capacity too small: %s bytes" %capacity)
+        self.path = path
+        self.capacity = capacity
+        self.head = 0
+        self.tail = 0
+        self.wrapped = False
+        self._lock = threading.Lock()
+
+        self._file = open(path, "w+b")
+        self._file.truncate(HEADER.size + capacity)
+        self._map = mmap.mmap(self._file.fileno(), HEADER.size + capacity)
+        self._data_offset = HEADER.size
+        self._writeHeader(time.time(), time.monotonic())
+
+    def _writeHeader(self, wall_time = None, monotonic_time = None):
+        if wall_time is not None:
+            self._times = (wall_time, monotonic_time)
+        HEADER.pack_into(self._map, 0,
+                         MAGIC, VERSION,
+                         FLAG_WRAPPED if self.wrapped else 0,
+                         self.capacity, self.head, self.tail,
+                         self._times[0], self._times[1])
+
+    def _nextRecord(self, offset):
+        """Offset of the record following the one at offset, 0 if the ring wraps."""
+        if offset + RECORD.size > self.capacity:
+            return 0
+        timestamp, direction, length = RECORD.unpack_from(self._map, self._data_offset + offset)
+        if direction == DIRECTION_PAD:
+            return 0
+        offset += RECORD.size + length
+        if offset + RECORD.size > self.capacity:
+            return 0
+        return offset
+
+    def _write(self, timestamp, direction, data):
+        size = RECORD.size + len(data)
+        if self.head + size > self.capacity:
+            if self.head + RECORD.size <= self.capacity:
+                RECORD.pack_into(self._map, self._data_offset + self.head, timestamp, DIRECTION_PAD, 0)
+            if self.wrapped and self.tail > self.head:
+                # The rest of the ring is older than what is overwritten at its beginning
+                self.tail = 0
+            self.head = 0
+            self.wrapped = True
+
+        # Drop the oldest records we are going to overwrite
+        while self.wrapped and self.head <= self.tail < self.head + size:
+            self.tail = self._nextRecord(self.tail)
+            if self.tail == 0:
+                break
+
+        offset = self._data_offset + self.head
+        RECORD.pack_into(self._map, offset, timestamp, direction, len(data))
+        self._map[offset + RECORD.size:offset + size] = data
+        self.head += size
+        self._writeHeader()
+
+    def record(self, direction, data, timestamp = None):
+        if self._map is None:
+            return
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if type(data) is str:
+            data = data.encode("utf-8")
+        with self._lock:
+            for start in range(0, max(len(data), 1), MAX_PAYLOAD):
+                self._write(timestamp, direction, data[start:start + MAX_PAYLOAD])
+
+    def recordSent(self, data):
+        self.record(DIRECTION_SENT, data)
+
+    def recordReceived(self, data):
+        self.record(DIRECTION_RECEIVED, data)
+
+    def recordEvent(self, text):
+        self.record(DIRECTION_EVENT, text)
+
+    def flush(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+
+    def close(self):
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.close()
+
+class TraceReader():
+    def __init__(self, path):
+        with open(path, "rb") as trace_file:
+            self._data = trace_file.read()
+        (magic, version, flags, self.capacity,
+         self.head, self.tail, self.wall_time, self.monotonic_time) = HEADER.unpack_from(self._data, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a trace file: %s" %path)
+        if version != VERSION:
+            raise ValueError("Unsupported trace version: %s" %version)
+        self.wrapped = bool(flags & FLAG_WRAPPED)
+
+    def _iterRange(self, start, end):
+        offset = start
+        while offset < end and offset + RECORD.size <= self.capacity:
+            timestamp, direction, length = RECORD.unpack_from(self._data, HEADER.size + offset)
+            if direction == DIRECTION_PAD:
+                return
+            payload_start = HEADER.size + offset + RECORD.size
+            yield timestamp, direction, self._data[payload_start:payload_start + length]
+            offset += RECORD.size + length
+
+    def records(self):
+        """Yields (monotonic timestamp, direction, payload) from oldest to newest."""
+        if self.wrapped and self.tail >= self.head:
+            yield from self._iterRange(self.tail, self.capacity)
+        start = self.tail if self.tail < self.head else 0
+        yield from self._iterRange(start, self.head)
+
+    def stats(self, stall_threshold = 0.5):
+        """Summary of a trace including the gaps between sent lines above the threshold."""
+        sent = received = sent_bytes = received_bytes = 0
+        first = last = last_sent = None
+        stalls = []
+        for timestamp, direction, payload in self.records():
+            if first is None:
+                first = timestamp
+            last = timestamp
+            if direction == DIRECTION_SENT:
+                if not last_sent is None and timestamp - last_sent >= stall_threshold:
+                    stalls.append((last_sent - first, timestamp - last_sent))
+                last_sent = timestamp
+                sent += 1
+                sent_bytes += len(payload)
+            elif direction == DIRECTION_RECEIVED:
+                received += 1
+                received_bytes += len(payload)
+        duration = (last - first) if not first is None else 0.
+        return {"duration": duration,
+                "sent": sent,
+                "received": received,
+                "sent_bytes": sent_bytes,
+                "received_bytes": received_bytes,
+                "lines_per_second": sent / duration if duration else None,
+                "stalls": sorted(stalls, key = lambda stall: -stall[1]),
+                }
+
+class TraceReplayConnection():
+    """Drop-in replacement for WifiConnectionFactory which answers from a trace.
+
+    Every received record is bound to the number of lines that were sent
+    before it in the recording. It is delivered once that many lines have
+    been sent again and the recorded delay, divided by speed, has passed.
+    speed = None delivers answers as fast as the sender allows.
+    """
+    connection = None
+    metrics = None
+    trace = None
+
+    def __init__(self, path, speed = 1.):
+        self.path = path
+        self.speed = speed
+        self.answers = []
+        sent = 0
+        anchor = None
+        for timestamp, direction, payload in TraceReader(path).records():
+            if direction == DIRECTION_SENT:
+                sent += 1
+                anchor = timestamp
+            elif direction == DIRECTION_RECEIVED:
+                delay = timestamp - anchor if not anchor is None else 0.
+                self.answers.append((sent, delay, payload.decode("utf-8", "replace").rstrip("\n")))
+                anchor = timestamp
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self.position = 0
+        self.anchor = None
+        self.started = None
+        self.finished = None
+
+    def isConnected(self):
+        return bool(self.connection)
+
+    def setTraceRecorder(self, recorder):
+        self.trace = recorder
+
+    def setSocketOptions(self, **options):
+        pass
+
+    def connect(self, ip = None, port = None):
+        self.reset()
+        self.connection = self
+        self.started = time.monotonic()
+        self.anchor = self.started
+        return self.connection
+
+    def disconnect(self):
+        self.connection = None
+
+    def reconnect(self):
+        return self.connection if self.connection else self.connect()
+
+    def send(self, data):
+        if not type(data) is bytes:
+            data = bytes(data)
+        self.sent += 1
+        self.sent_bytes += len(data)
+        self.anchor = time.monotonic()
+        if self.metrics:
+            self.metrics.countSent(len(data))
+        return True
+
+    def sendLines(self, lines):
+        for data in lines:
+            self.send(data)
+        return True
+
+    def receiveLine(self):
+        if self.position >= len(self.answers):
+            if self.finished is None:
+                self.finished = time.monotonic()
+            return None
+        depends_on, delay, line = self.answers[self.position]
+        if self.sent < depends_on:
+            return None
+        if self.speed:
+            if time.monotonic() < self.anchor + delay / self.speed:
+                return None
+        self.position += 1
+        self.anchor = time.monotonic()
+        if self.metrics:
+            self.metrics.countReceived(len(line) + 1)
+        return line
+
+    def getDuration(self):
+        end = self.finished if not self.finished is None else time.monotonic()
+        return end - self.started
+
+def createReplayConnector(path, speed = 1.):
+    """Returns a callable which can be used as SerialOutputDevice.serial_connector."""
+    return lambda: TraceReplayConnection(path, speed)
@@ -0,0 +1,22 @@
+import sys
+
+from .. import Trace
+
+if len(sys.argv) < 3 or sys.argv[1] not in ("dump", "stats"):
+    print("Usage: python -m %s dump|stats <trace file> [stall threshold in s]" %__package__)
+    sys.exit(1)
+reader = Trace.TraceReader(sys.argv[2])
+if sys.argv[1] == "dump":
+    first = None
+    for timestamp, direction, payload in reader.records():
+        if first is None:
+            first = timestamp
+        print("%12.6f %-8s %r" %(timestamp - first, Trace.DIRECTION_NAMES.get(direction, direction), payload))
+else:
+    threshold = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    stats = reader.stats(threshold)
+    for key in ("duration", "sent", "received", "sent_bytes", "received_bytes", "lines_per_second"):
+        print("%-16s %s" %(key, stats[key]))
+    print("stalls >= %ss: %s" %(threshold, len(stats["stalls"])))
+    for at, gap in stats["stalls"][:20]:
+        print("  at %10.3fs for %.3fs" %(at, gap))
@@ -0,0 +1,91 @@
+'''
+Coalesced state updates of all printers for the UI.
+
+The send loops change the job state, progress and elapsed time of their
+device from worker threads. Applied right away, every change is a Qt
+signal and a pass over the QML bindings, for every printer. Instead the
+devices post their changes here. The aggregator keeps the latest value of
+every field and publishes them once per interval (10 Hz) from the UI's
+thread: per device a single call of device.applyUpdates(changes) with only
+the fields which changed since the last publish.
+
+In Cura a QTimer calls flush(), without Qt start() runs a thread doing so.
+'''
+
+import threading
+
+from ..Log import Logger
+
+INTERVAL = 0.1 # s, one frame of the UI
+
+_UNSET = object()
+
+class UpdateAggregator():
+    def __init__(self, interval = INTERVAL):
+        self.interval = interval
+        self.posted = 0 # changes posted by the devices
+        self.published = 0 # fields handed to the devices
+        self.flushes = 0
+        self._pending = {} # device: {field: latest value}
+        self._published = {} # device: {field: value as last published}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    ##  Sets field of device to value with the next publish, from any thread.
+    def post(self, device, field, value):
+        with self._lock:
+            fields = self._pending.get(device)
+            if fields is None:
+                self._pending[device] = {field: value}
+            else:
+                fields[field] = value
+            self.posted += 1
+
+    ##  Publishes what changed since the last call, in the thread which may update the UI.
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        self.flushes += 1
+        for device, fields in pending.items():
+            published = self._published.setdefault(device, {})
+            changes = {field: value for field, value in fields.items() if published.get(field, _UNSET) != value}
+            if not changes:
+                continue
+            published.update(changes)
+            self.published += len(changes)
+            try:
+                device.applyUpdates(changes)
+            except Exception:
+                Logger.logException("e", "Could not update the state of %s!", device)
+
+    ##  Drops everything of a removed device.
+    def forget(self, device):
+        with self._lock:
+            self._pending.pop(device, None)
+            self._published.pop(device, None)
+
+    ##  Flushes every interval in a thread of its own, for devices without a UI thread.
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, name = "update aggregator", daemon = True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+_aggregator = UpdateAggregator()
+
+def getAggregator():
+    """The aggregator all devices of the plugin share."""
+    return _aggregator
@@ -1,10 +1,12 @@
 # Copyright (c) 2015 Ultimaker B.V.
 # Cura is released under the terms of the AGPLv3 or higher.
-from . import SerialWifiOutputDevicePlugin #@UnresolvedImport
-from UM.i18n import i18nCatalog
-catalog = i18nCatalog("cura")
+
+# Cura's modules are imported by the functions, so the packages of the plugin
+# (eg. StreamingEngine and Benchmark) can be used without Cura.
 
 def getMetaData():
+    from UM.i18n import i18nCatalog
+    catalog = i18nCatalog("cura")
     return {
         "plugin": {
             "name": "Wifi-Serial-Bridge",
@@ -16,5 +18,6 @@ def getMetaData():
     }
 
 def register(app):
+    from . import SerialWifiOutputDevicePlugin #@UnresolvedImport
     return { "output_device": SerialWifiOutputDevicePlugin.SerialWifiOutputDevicePlugin(),
-            }
\ No newline at end of file
+            }
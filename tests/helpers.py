@@ -0,0 +1,25 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import importlib
+import os
+import sys
+
+# The plugin is a package named after its folder, importable without Cura
+PLUGIN_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(PLUGIN_DIRECTORY))
+
+def load(name):
+    """A package of the plugin, eg. load("Trace")."""
+    return importlib.import_module(os.path.basename(PLUGIN_DIRECTORY) + "." + name)
+
+def writeJob(directory, lines, name = "job.gcode"):
+    """Path of a G-code file of lines in directory."""
+    path = os.path.join(str(directory), name)
+    with open(path, "w") as job_file:
+        job_file.write("\n".join(lines) + "\n")
+    return path
+
+def commandCount(lines):
+    """Lines with a command, those the firmware processes."""
+    return sum(1 for line in lines if line.split(";", 1)[0].strip())
@@ -0,0 +1,73 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import threading
+import time
+
+from helpers import load
+
+Bandwidth = load("Bandwidth")
+
+DURATION = 1. # s
+WRITE_SIZE = 256 # bytes
+
+def _write(share, rate, stop):
+    """Writes through share, paced to rate bytes/s or as fast as it may with None."""
+    started = time.monotonic()
+    written = 0
+    while not stop.is_set():
+        if rate is not None:
+            wait = started + written / rate - time.monotonic()
+            if wait > 0.:
+                time.sleep(wait)
+        share.acquire(WRITE_SIZE)
+        written += WRITE_SIZE
+
+def _run(scheduler, live_rates, bulk):
+    """Rates in bytes/s the shares got, (live, bulk)."""
+    shares = [scheduler.register("live%d" %index) for index in range(len(live_rates))]
+    shares += [scheduler.register("bulk%d" %index, Bandwidth.PRIORITY_BULK) for index in range(bulk)]
+    rates = list(live_rates) + [None] * bulk
+    stop = threading.Event()
+    threads = [threading.Thread(target = _write, args = (share, rate, stop), daemon = True) for share, rate in zip(shares, rates)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    elapsed = time.monotonic() - started
+    rates = [share.granted / elapsed for share in shares]
+    stop.set()
+    for thread in threads:
+        # Bulk shares may still wait for the debt of the live ones
+        thread.join()
+    return rates[:len(live_rates)], rates[len(live_rates):]
+
+def test_live_shares_get_their_guaranteed_rate():
+    # Too little for the guaranteed rates alone, bulk has to wait
+    scheduler = Bandwidth.BandwidthScheduler(Bandwidth.LIVE_GUARANTEED)
+    live, bulk = _run(scheduler, [None, None], 2)
+    for rate in live:
+        assert rate >= 0.8 * Bandwidth.LIVE_GUARANTEED
+    assert sum(bulk) < 0.2 * Bandwidth.LIVE_GUARANTEED
+
+def test_bulk_shares_take_what_live_ones_leave():
+    link_rate = 40e3
+    live_rate = 10e3 # paced by the "ok"s, above the guaranteed rate
+    scheduler = Bandwidth.BandwidthScheduler(link_rate)
+    live, bulk = _run(scheduler, [live_rate, live_rate], 2)
+    for rate in live:
+        assert rate >= 0.9 * live_rate
+    # The full bucket of the link goes on top once, and every share may be a write in debt
+    burst = (Bandwidth.TokenBucket(link_rate).capacity + 4 * WRITE_SIZE) / DURATION
+    left = link_rate - sum(live)
+    assert 0.8 * left <= sum(bulk) <= left + burst
+    assert sum(live) + sum(bulk) <= link_rate + burst
+
+def test_unlimited_scheduler_doesnt_wait():
+    scheduler = Bandwidth.BandwidthScheduler()
+    share = scheduler.register("live")
+    started = time.monotonic()
+    for _ in range(1000):
+        share.acquire(WRITE_SIZE)
+    assert share.granted == 1000 * WRITE_SIZE
+    assert time.monotonic() - started < 0.5
@@ -0,0 +1,61 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+from helpers import commandCount, load, writeJob
+
+Benchmark = load("Benchmark")
+Bridge = load("Bridge")
+Connection = load("Connection")
+Emulator = load("Emulator")
+StreamingEngine = load("StreamingEngine")
+
+class _NoisyPrinter(Connection.SocketPairConnection):
+    """Garbles the checksum of every every-th numbered line the first time it goes to the printer."""
+    def __init__(self, peer, every):
+        super().__init__(peer)
+        self.every = every
+        self.garbled = 0
+        self._seen = set()
+
+    def send(self, data):
+        data = bytes(data)
+        number = Bridge.lineNumber(data)
+        if number is not None and number % self.every == 0 and number not in self._seen:
+            self._seen.add(number)
+            self.garbled += 1
+            data = data[:-1] + (b"0" if data[-1:] != b"0" else b"1")
+        return super().send(data)
+
+def test_bridge_answers_resends_itself(tmp_path):
+    lines = Benchmark.generateJob(layers = 2, lines_per_layer = 400)
+    path = writeJob(tmp_path, lines)
+    server = Emulator.EmulatorServer(speed = 0.)
+    printers = []
+    def connector():
+        printers.append(_NoisyPrinter(server.attach, 50))
+        return printers[-1]
+    bridge = Bridge.ReferenceBridge(connector)
+    engine = StreamingEngine.StreamingEngine("bridged")
+    engine.setBridgeBuffering(True)
+    try:
+        bridge.start()
+        engine.start(bridge.host, bridge.port)
+        before = server.firmware.lines_processed
+        engine.sendFile(path)
+        assert engine.waitForJob(interval = 0.1)
+        assert engine.getBridgeWindow()
+    finally:
+        engine.stop()
+        bridge.stop()
+        server.stop()
+    assert printers[0].garbled > 0
+    assert bridge.local_resends == printers[0].garbled
+    # The host never heard of them
+    assert engine.getMetrics().resends == 0
+    assert server.firmware.lines_processed - before == commandCount(lines)
+
+def test_line_number():
+    assert Bridge.lineNumber(b"N12 G1 X10*85") == 12
+    assert Bridge.lineNumber(memoryview(b"N7 M105*30")) == 7
+    assert Bridge.lineNumber(b"G1 X10") is None
+    assert Bridge.lineNumber(b"N G1") is None
@@ -0,0 +1,117 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import socket
+import threading
+import time
+
+import pytest
+
+from helpers import load
+
+Bandwidth = load("Bandwidth")
+Connection = load("Connection")
+GCodeLibrary = load("GCodeLibrary")
+
+@pytest.mark.parametrize("line, number", [("Resend: 12", 12),
+                                          ("Resend:7 ", 7),
+                                          ("rs 3", 3),
+                                          ("rs 3 N3", 3),
+                                          ("Resend: ", None),
+                                          ("Resend: N12", None),
+                                          ("ok", None),
+                                          ("Error:Line Number is not Last Line Number+1, Last Line: 4", None),
+                                          ])
+def test_parseResend(line, number):
+    assert Connection.parseResend(line) == number
+
+def test_resend_buffer_numbers_from_reset():
+    resend_buffer = Connection.ResendBuffer()
+    assert resend_buffer.reset(41) == b"M110 N41"
+    number, numbered = resend_buffer.number(b"G1 X1")
+    assert number == 42
+    assert numbered == GCodeLibrary.numberLine(42, b"G1 X1")
+    assert numbered.startswith(b"N42 G1 X1*")
+
+def test_resend_buffer_lines_from():
+    resend_buffer = Connection.ResendBuffer()
+    resend_buffer.reset()
+    numbered = [resend_buffer.number(b"G1 X%d" %index)[1] for index in range(5)]
+    assert resend_buffer.linesFrom(3) == numbered[2:]
+    # The firmware asking for the next line gets nothing to resend
+    assert resend_buffer.linesFrom(6) == []
+    assert resend_buffer.linesFrom(7) is None
+    assert resend_buffer.linesFrom(0) is None
+
+def test_resend_buffer_forgets_the_oldest_lines():
+    resend_buffer = Connection.ResendBuffer(size = 4)
+    resend_buffer.reset()
+    numbered = [resend_buffer.number(b"G1 X%d" %index)[1] for index in range(10)]
+    assert not resend_buffer.has(6)
+    assert resend_buffer.linesFrom(6) is None
+    assert resend_buffer.linesFrom(7) == numbered[6:]
+
+class _ChokedConnection(Connection.StreamConnection):
+    """Writes chunk bytes per call at most, every other call finds the transport full."""
+    def __init__(self, chunk):
+        super().__init__()
+        self.chunk = chunk
+        self.written = bytearray()
+        self.full = False
+        # Always writable, for the select() after a full transport
+        self._sockets = socket.socketpair()
+
+    def _open(self, address, port):
+        return self._sockets[0]
+
+    def _close(self, connection):
+        pass
+
+    def _write(self, buffers):
+        self.full = not self.full
+        if self.full:
+            raise BlockingIOError()
+        data = b"".join(bytes(buffer) for buffer in buffers)[:self.chunk]
+        self.written += data
+        return len(data)
+
+LINES = [b"G1 X%d Y%d E%d" %(index, index * 2, index) for index in range(200)]
+
+@pytest.mark.parametrize("chunk", [1, 7, 64, 100000])
+def test_flush_survives_partial_writes_and_full_buffers(chunk):
+    connection = _ChokedConnection(chunk)
+    connection.connect(None, None)
+    connection.share = Bandwidth.BandwidthScheduler().register("choked")
+    assert connection.sendLines(LINES)
+    expected = b"".join(line + b"\n" for line in LINES)
+    assert bytes(connection.written) == expected
+    assert not connection.outgoing
+    # What was acquired but couldn't be written went back to the share
+    assert connection.share.granted == len(expected)
+
+def test_flush_waits_for_a_full_socket():
+    peers = []
+    connection = Connection.SocketPairConnection(peers.append)
+    connection.connect(None, None)
+    connection.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    peer = peers[0]
+    received = bytearray()
+    expected = b"".join(b"G1 X%d Y%d E%d\n" %(index, index, index) for index in range(50000))
+    def read():
+        time.sleep(0.1)
+        while len(received) < len(expected):
+            data = peer.recv(65536)
+            if not data:
+                break
+            received.extend(data)
+    reader = threading.Thread(target = read, daemon = True)
+    reader.start()
+    try:
+        assert connection.sendLines(expected.splitlines())
+        # The socket took it in parts while the reader caught up
+        assert connection.write_calls > 1
+        reader.join(10.)
+    finally:
+        connection.disconnect()
+        peer.close()
+    assert bytes(received) == expected
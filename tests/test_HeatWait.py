@@ -0,0 +1,103 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import time
+
+from helpers import commandCount, load, writeJob
+
+Emulator = load("Emulator")
+GCodeLibrary = load("GCodeLibrary")
+HeatWait = load("HeatWait")
+StreamingEngine = load("StreamingEngine")
+
+def test_parse_temperatures():
+    assert HeatWait.parseTemperatures("ok T:209.8 /210.0 B:60.0 /60.0 @:0 B@:0") == {"T": (209.8, 210.), "B": (60., 60.)}
+    assert HeatWait.parseTemperatures("T1:24.0 /0.0") == {"T1": (24., 0.)}
+    assert HeatWait.parseTemperatures("ok") == {}
+
+def test_rewrite():
+    assert HeatWait.rewrite(b"G1 X10") is None
+    data, wait = HeatWait.rewrite(b"M109 S210 ; hot end")
+    assert data == b"M104 S210"
+    assert (wait.heater, wait.target, wait.cooling) == ("T", 210., False)
+    data, wait = HeatWait.rewrite(b"M190 R40")
+    assert data == b"M140 R40"
+    assert (wait.heater, wait.target, wait.cooling) == ("B", 40., True)
+    data, wait = HeatWait.rewrite(b"M109 T1 S200")
+    assert wait.heater == "T1"
+
+def test_heating_waits_for_residency():
+    data, wait = HeatWait.rewrite(b"M109 S210", tolerance = 1., residency = 2.)
+    assert not wait.update({"T": (150., 210.)}, now = 10.)
+    assert not wait.update({"T": (209.5, 210.)}, now = 11.)
+    assert not wait.update({"T": (209.8, 210.)}, now = 12.)
+    assert wait.update({"T": (210., 210.)}, now = 13.)
+
+def test_heating_ignores_other_heaters_and_overshoot():
+    data, wait = HeatWait.rewrite(b"M190 S60")
+    assert not wait.update({"T": (210., 210.)}, now = 1.)
+    assert wait.update({"B": (70., 60.)}, now = 2.)
+
+def test_single_extruder_reports_t():
+    data, wait = HeatWait.rewrite(b"M109 T0 S200")
+    assert wait.heater == "T0"
+    assert wait.update({"T": (200., 200.)})
+
+def test_cooling_waits_for_the_target():
+    data, wait = HeatWait.rewrite(b"M109 R100")
+    assert not wait.update({"T": (150., 100.)}, now = 1.)
+    assert wait.update({"T": (100.5, 100.)}, now = 2.)
+
+def test_poll_interval_shrinks_close_to_the_target():
+    data, wait = HeatWait.rewrite(b"M109 S210")
+    assert wait.pollInterval(1.) == 1.
+    wait.update({"T": (100., 210.)}, now = 0.)
+    wait.update({"T": (200., 210.)}, now = 1.) # 100 degrees/s, 9 to go
+    assert abs(wait.pollInterval(1.) - 0.09) < 1e-6
+    wait.update({"T": (208.95, 210.)}, now = 1.1)
+    assert wait.pollInterval(1.) == HeatWait.MIN_POLL_INTERVAL
+
+def test_engine_waits_on_the_host(tmp_path):
+    moves = ["G1 X%d Y%d F6000" %(index % 50, index % 40) for index in range(100)]
+    lines = ["M140 S60", "M104 S210", "M190 S60", "M109 S210"] + moves
+    path = writeJob(tmp_path, lines)
+    # 100 degrees/s for the hot end, 25 for the bed
+    with Emulator.EmulatorServer(speed = 0., heat_rate = 0.1) as server:
+        firmware = server.firmware
+        blocking = []
+        first_move = []
+        firmware._doM109 = lambda values, line: blocking.append(line)
+        firmware._doM190 = lambda values, line: blocking.append(line)
+        move = firmware._doG1
+        def recordingMove(values, line):
+            if not first_move:
+                first_move.append((firmware.hotend.update(firmware.speed), firmware.bed.update(firmware.speed)))
+            return move(values, line)
+        firmware._doG1 = recordingMove
+        engine = StreamingEngine.StreamingEngine("host waits")
+        engine.setDryRun(False)
+        engine.setHostHeatWaits(True)
+        try:
+            engine.start(server.host, server.port)
+            before = firmware.lines_processed
+            engine.sendFile(path)
+            while engine.getHeatWait() is None:
+                time.sleep(0.01)
+            # The firmware isn't blocked, a query goes through during the wait
+            query = GCodeLibrary.RawLine(b"M105")
+            started = time.monotonic()
+            engine.injectCommand(query, wait = True)
+            assert query.hasFinished()
+            assert time.monotonic() - started < 0.5
+            assert engine.getHeatWait() is not None
+            assert engine.waitForJob(interval = 0.05)
+        finally:
+            engine.stop()
+        processed = firmware.lines_processed - before
+    assert blocking == []
+    hotend, bed = first_move[0]
+    assert hotend >= 210. - HeatWait.TOLERANCE
+    assert bed >= 60. - HeatWait.TOLERANCE
+    # The polled M105 come on top of the job
+    assert processed >= commandCount(lines)
+    assert engine.getHeatWait() is None
@@ -0,0 +1,44 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import os
+import threading
+
+import pytest
+
+from helpers import load, writeJob
+
+Benchmark = load("Benchmark")
+JobCache = load("JobCache")
+Preprocess = load("Preprocess")
+
+SETTINGS = Preprocess.PreprocessSettings(dry_run = True)
+
+@pytest.fixture
+def job_path(tmp_path):
+    return writeJob(tmp_path, Benchmark.generateJob(layers = 40, lines_per_layer = 400))
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_store_and_lookup(tmp_path, job_path, workers):
+    cache = JobCache.JobCache(os.path.join(str(tmp_path), "cache"))
+    key = JobCache.entryKey(JobCache.fileHash(job_path), SETTINGS)
+    assert cache.lookup(key) is None
+    stored = cache.store(key, job_path, SETTINGS, workers)
+    entry = cache.lookup(key)
+    assert entry.key == stored.key == key
+    with open(job_path, "rb") as job_file:
+        assert entry.getLineCount() == job_file.read().count(b"\n")
+    assert entry.estimate().total > 0.
+    assert entry.demand() is not None
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_cancelled_store_leaves_nothing(tmp_path, job_path, workers):
+    directory = os.path.join(str(tmp_path), "cache")
+    cache = JobCache.JobCache(directory)
+    cancelled = threading.Event()
+    cancelled.set()
+    key = JobCache.entryKey(JobCache.fileHash(job_path), SETTINGS)
+    with pytest.raises(JobCache.StoreCancelled):
+        cache.store(key, job_path, SETTINGS, workers, cancelled = cancelled)
+    assert os.listdir(directory) == []
+    assert cache.lookup(key) is None
@@ -0,0 +1,60 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import pytest
+
+from helpers import load
+
+Benchmark = load("Benchmark")
+JobValidation = load("JobValidation")
+
+LIMITS = JobValidation.ValidationLimits(JobValidation.BuildVolume.fromMachine(200., 200., 200.))
+
+START = ["M140 S60", "M109 S210", "G28", "G90", "M82", "G92 E0"]
+
+def _kinds(report):
+    return {issue.kind: (issue.line, issue.count) for issue in report.issues}
+
+def test_synthetic_job_is_valid():
+    report = JobValidation.validateJob(Benchmark.generateJob(layers = 5), LIMITS)
+    assert report.isValid(), report.issues
+    assert report.extrusion > 0.
+    assert report.travel > 0.
+
+@pytest.mark.parametrize("line, kind", [("G1 X250 Y10 E1", JobValidation.ISSUE_OUT_OF_BOUNDS),
+                                        ("G1 X10 Y10 Z-1 E1", JobValidation.ISSUE_OUT_OF_BOUNDS),
+                                        ("M999999", JobValidation.ISSUE_UNKNOWN_COMMAND),
+                                        ("G1 X20 Y20 E120", JobValidation.ISSUE_EXTRUSION_JUMP),
+                                        ("G1 X20 Y20 E-30", JobValidation.ISSUE_RETRACTION_JUMP),
+                                        ("M104 S400", JobValidation.ISSUE_HOTEND_TEMPERATURE),
+                                        ("M140 S150", JobValidation.ISSUE_BED_TEMPERATURE),
+                                        ])
+def test_issue_is_found_in_its_line(line, kind):
+    lines = START + ["G1 F1800 X10 Y10 Z0.2 E0.5", line, "G1 X11 Y11 Z0.2"]
+    issues = _kinds(JobValidation.validateJob(lines, LIMITS))
+    assert issues == {kind: (len(START) + 1, 1)}
+    severity = JobValidation.SEVERITIES[kind]
+    report = JobValidation.validateJob(lines, LIMITS)
+    assert report.isValid() == (severity == JobValidation.SEVERITY_WARNING)
+
+def test_cold_extrusion():
+    lines = ["M104 S150", "G28", "G92 E0", "G1 X10 Y10 Z0.2 E1", "M109 S210", "G1 X20 Y10 E2"]
+    issues = _kinds(JobValidation.validateJob(lines, LIMITS))
+    assert issues == {JobValidation.ISSUE_COLD_EXTRUSION: (3, 1)}
+
+def test_extrusion_mode_decides_about_jumps():
+    moves = ["G1 X10 Y10 Z0.2 E0.5", "G1 X11 Y10 E20", "G1 X12 Y10 E60", "G1 X13 Y10 E80"]
+    assert JobValidation.validateJob(START + moves, LIMITS).isValid()
+    # The same absolute values after M83 extrude a lot more than intended
+    issues = _kinds(JobValidation.validateJob(START + ["M83"] + moves, LIMITS))
+    assert issues == {JobValidation.ISSUE_EXTRUSION_JUMP: (len(START) + 3, 2)}
+
+def test_chunks_give_the_same_report():
+    lines = START + ["M83", "G1 X10 Y10 Z0.2 E0.5", "M104 S400"] + ["G1 X%d Y10 E%d" %(10 + index, 10 * index) for index in range(8)]
+    whole = JobValidation.validateJob(lines, LIMITS)
+    chunked = JobValidation.validateJob(lines, LIMITS, chunk_lines = 3)
+    assert _kinds(chunked) == _kinds(whole)
+    assert chunked.extrusion == pytest.approx(whole.extrusion)
+    assert chunked.travel == pytest.approx(whole.travel)
+    assert chunked.minimum == whole.minimum
+    assert chunked.maximum == whole.maximum
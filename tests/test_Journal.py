@@ -0,0 +1,88 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import os
+
+import pytest
+
+from helpers import load, writeJob
+
+Journal = load("Journal")
+
+LINES = ["G28", "G1 Z0.2", ";LAYER:0", "G1 X10 Y10 E1", ";LAYER:1", "G1 Z0.4", "G1 X20 Y20 E2"]
+
+def _offset(lines):
+    """Byte offset behind lines of LINES."""
+    return sum(len(line) + 1 for line in LINES[:lines])
+
+@pytest.fixture
+def journal_path(tmp_path):
+    """Journal of a job with checkpoints after line 4 and after line 7."""
+    source_path = writeJob(tmp_path, LINES)
+    path = os.path.join(str(tmp_path), "job" + Journal.JOURNAL_SUFFIX)
+    journal = Journal.JobJournal(path, source_path, interval = 60.).start()
+    for line in (4, 7):
+        journal.acknowledge(line, _offset(line))
+        assert journal.flush()
+    journal.close()
+    return path
+
+def _damage(path, change):
+    with open(path, "rb") as journal_file:
+        data = bytearray(journal_file.read())
+    with open(path, "wb") as journal_file:
+        journal_file.write(change(data))
+
+def _jobRecordSize(path):
+    with open(path, "rb") as journal_file:
+        length = Journal.RECORD_HEADER.unpack(journal_file.read(Journal.RECORD_HEADER.size))[0]
+    return Journal.RECORD_HEADER.size + length
+
+def test_reads_the_last_checkpoint(journal_path):
+    state = Journal.readJournal(journal_path)
+    assert state.getLine() == 7
+    assert state.getOffset() == _offset(7)
+    assert not state.finished
+    assert state.matchesSource()
+
+@pytest.mark.parametrize("cut", [1, Journal.RECORD_HEADER.size, Journal.RECORD_HEADER.size + 1])
+def test_torn_checkpoint_falls_back_to_the_previous_one(journal_path, cut):
+    _damage(journal_path, lambda data: data[:-cut])
+    state = Journal.readJournal(journal_path)
+    assert state.getLine() == 4
+    assert state.getOffset() == _offset(4)
+
+def test_corrupted_checkpoint_falls_back_to_the_previous_one(journal_path):
+    def flip(data):
+        data[-1] ^= 0xFF
+        return data
+    _damage(journal_path, flip)
+    assert Journal.readJournal(journal_path).getLine() == 4
+
+def test_damage_stops_reading(journal_path):
+    # The second checkpoint is intact, but follows a damaged one
+    size = os.path.getsize(journal_path)
+    checkpoint_size = (size - _jobRecordSize(journal_path)) // 2
+    def flip(data):
+        data[size - checkpoint_size - 1] ^= 0xFF
+        return data
+    _damage(journal_path, flip)
+    state = Journal.readJournal(journal_path)
+    assert state is not None
+    assert state.checkpoint is None
+    assert state.getOffset() == 0
+
+def test_torn_job_record_describes_no_job(journal_path):
+    size = _jobRecordSize(journal_path)
+    _damage(journal_path, lambda data: data[:size - 1])
+    assert Journal.readJournal(journal_path) is None
+
+def test_finished_journal_is_removed(tmp_path):
+    source_path = writeJob(tmp_path, LINES)
+    path = os.path.join(str(tmp_path), "job" + Journal.JOURNAL_SUFFIX)
+    journal = Journal.JobJournal(path, source_path, interval = 60.).start()
+    journal.acknowledge(len(LINES), _offset(len(LINES)))
+    journal.flush()
+    journal.finish()
+    assert not os.path.exists(path)
+    assert Journal.findUnfinished(str(tmp_path), "job") is None
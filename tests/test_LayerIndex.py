@@ -0,0 +1,73 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import os
+
+from helpers import load, writeJob
+
+LayerIndex = load("LayerIndex")
+
+LINES = ["M140 S60",
+         "M104 S210",
+         "G28",
+         "M83",
+         ";LAYER:0",
+         "G0 F9000 X10 Y10 Z0.2",
+         "G1 F1200 X20 Y10 E1.5",
+         "M106 S127",
+         ";LAYER:1",
+         "G0 X30 Y30 Z0.4",
+         "G1 F1500 X40 Y30 E2",
+         "M104 S200",
+         "M107",
+         "G91",
+         ";LAYER:2",
+         "G0 Z0.2",
+         "G1 X5 E1",
+         ]
+
+def _index():
+    return LayerIndex.LayerIndex.forBuffer("\n".join(LINES).encode("utf-8") + b"\n")
+
+def test_offsets_point_at_the_layer_markers():
+    data = "\n".join(LINES).encode("utf-8")
+    index = _index()
+    assert list(index.getLayerNumbers()) == [0, 1, 2]
+    for layer in range(3):
+        offset = index.getOffset(layer)
+        assert data[offset:].startswith(b";LAYER:%d\n" %layer)
+        assert LINES[index.getLineNumber(layer)] == ";LAYER:%d" %layer
+        assert index.layerAtOffset(offset) == layer
+    assert index.layerAtOffset(0) is None
+    assert index.getLayer(1)["height"] == 0.4
+
+def test_resume_commands_restore_the_state_in_front_of_the_layer():
+    assert _index().resumeCommands(1) == ["M140 S60",
+                                          "M104 S210",
+                                          "M190 S60",
+                                          "M109 S210",
+                                          "G28 X0 Y0",
+                                          "G90",
+                                          "M83",
+                                          "G92 E1.50000",
+                                          "G0 F9000 Z0.200",
+                                          "G0 X20.000 Y10.000",
+                                          "G0 F1200",
+                                          "M106 S127",
+                                          ]
+
+def test_resume_commands_keep_relative_axes():
+    commands = _index().resumeCommands(2, home_xy = False)
+    assert "G28 X0 Y0" not in commands
+    assert commands[:2] == ["M140 S60", "M104 S200"]
+    assert commands[-3:] == ["G0 F1500", "M107", "G91"]
+    assert "G0 X40.000 Y30.000" in commands
+    # Relative moves after the marker still give the layer's height
+    assert abs(_index().getLayer(2)["height"] - 0.6) < 1e-9
+
+def test_index_is_cached_next_to_the_file(tmp_path):
+    path = writeJob(tmp_path, LINES)
+    index = LayerIndex.LayerIndex.forFile(path)
+    assert os.path.exists(LayerIndex.cachePath(path))
+    cached = LayerIndex.LayerIndex.forFile(path)
+    assert (cached.layers == index.layers).all()
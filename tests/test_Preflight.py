@@ -0,0 +1,72 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import pytest
+
+from helpers import commandCount, load
+
+Benchmark = load("Benchmark")
+Preflight = load("Preflight")
+
+def _demand(counts, sizes, times):
+    demand = Preflight.LinkDemand()
+    demand.counts = list(counts)
+    demand.sizes = list(sizes)
+    demand.times = list(times)
+    demand.starts = [index * demand.block_lines for index in range(len(counts))]
+    demand.lines = sum(counts)
+    return demand
+
+def test_streaming_stalls_only_where_the_link_is_slower():
+    assert Preflight.simulateStreaming([0.1] * 4, [1.] * 4) == [0.] * 4
+    # The first block arrives late, the planner waits for it once
+    assert Preflight.simulateStreaming([1.5, 0.1, 0.1], [1., 1., 1.]) == pytest.approx([0.5, 0., 0.])
+    # Blocks which print faster than they arrive stall every time
+    assert Preflight.simulateStreaming([1.] * 3, [0.25] * 3) == pytest.approx([0.75, 0.75, 0.75])
+
+def test_demand_covers_every_sent_line():
+    lines = Benchmark.generateJob(layers = 3)
+    demand = Preflight.measureDemand(lines)
+    assert demand.lines == commandCount(lines)
+    assert sum(demand.counts) == demand.lines
+    assert all(count <= demand.block_lines for count in demand.counts)
+    assert demand.getPrintTime() > 0.
+    assert demand.starts == sorted(demand.starts)
+
+def test_unmeasured_link_streams():
+    report = Preflight.analyze(_demand([16] * 10, [400] * 10, [1.] * 10), None)
+    assert report.mode == Preflight.MODE_DIRECT
+    assert report.upload_time is None
+
+def test_fast_link_streams():
+    link = Preflight.LinkProfile(rtt = 0.005, window = 4)
+    report = Preflight.analyze(_demand([16] * 10, [400] * 10, [1.] * 10), link)
+    assert report.mode == Preflight.MODE_DIRECT
+    assert report.stall_time == 0.
+    assert report.segments == []
+    assert report.reason == "the link keeps up with the job"
+
+def test_slow_stream_with_fast_uploads_goes_to_the_sd_card():
+    # 10 lines/s streamed against 1000 lines/s of earlier uploads
+    link = Preflight.LinkProfile(rtt = 0.1, window = 1, upload_rate = 1000.)
+    demand = _demand([16] * 100, [400] * 100, [0.1] * 100)
+    report = Preflight.analyze(demand, link)
+    assert report.mode == Preflight.MODE_SD
+    assert report.stall_time == pytest.approx(100 * (1.6 - 0.1), rel = 0.01)
+    assert report.getSDTime() < report.getDirectTime()
+    # One stall over the whole job
+    assert len(report.segments) == 1
+    assert (report.segments[0].first_line, report.segments[0].lines) == (0, 1600)
+    assert Preflight.analyze(demand, link, sd_available = False).mode == Preflight.MODE_DIRECT
+
+def test_short_stalls_dont_pay_for_an_upload():
+    link = Preflight.LinkProfile(rtt = 0.1, window = 1, upload_rate = 1000.)
+    counts = [16] * 100
+    times = [2.] * 100
+    times[50:55] = [0.1] * 5 # a few dense blocks, more than the planner buffers
+    report = Preflight.analyze(_demand(counts, [400] * 100, times), link)
+    assert report.mode == Preflight.MODE_DIRECT
+    assert 0. < report.stall_time < Preflight.MIN_GAIN
+    assert report.reason == "the stalls are shorter than the upload"
+    assert len(report.segments) == 1
+    assert 50 * 16 <= report.segments[0].first_line <= report.segments[0].last_line < 55 * 16
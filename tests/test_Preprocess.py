@@ -0,0 +1,24 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+from helpers import load, writeJob
+
+Benchmark = load("Benchmark")
+Preprocess = load("Preprocess")
+
+def _encoded(path, workers):
+    settings = Preprocess.PreprocessSettings(dry_run = True)
+    chunks = []
+    for chunk in Preprocess.encodeChunks(path, settings = settings, workers = workers, chunk_size = 16 * 1024):
+        chunks.append((chunk.start, chunk.end, chunk.count, bytes(chunk.data)))
+        chunk.close()
+    return chunks
+
+def test_workers_never_fork_the_application():
+    assert Preprocess._context().get_start_method() != "fork"
+
+def test_workers_encode_like_this_process(tmp_path):
+    path = writeJob(tmp_path, Benchmark.generateJob(layers = 40, lines_per_layer = 400))
+    in_process = _encoded(path, 0)
+    assert len(in_process) > 1
+    assert _encoded(path, 2) == in_process
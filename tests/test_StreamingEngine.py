@@ -0,0 +1,33 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import random
+
+import pytest
+
+from helpers import commandCount, load, writeJob
+
+Benchmark = load("Benchmark")
+Emulator = load("Emulator")
+StreamingEngine = load("StreamingEngine")
+
+@pytest.mark.parametrize("window", [1, 8])
+def test_reconnects_run_every_line_once(tmp_path, window):
+    lines = Benchmark.generateJob(layers = 5, lines_per_layer = 400)
+    path = writeJob(tmp_path, lines)
+    random.seed(window)
+    server = Emulator.EmulatorServer(speed = 0.).start()
+    engine = StreamingEngine.StreamingEngine("window %d" %window)
+    engine.setSendWindow(window)
+    try:
+        engine.start(server.host, server.port)
+        before = server.firmware.lines_processed
+        server.drop = 0.01
+        engine.sendFile(path)
+        assert engine.waitForJob(interval = 0.1)
+        server.drop = 0.
+    finally:
+        engine.stop()
+        server.stop()
+    assert server.drops > 0
+    assert server.firmware.lines_processed - before == commandCount(lines)
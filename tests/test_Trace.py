@@ -0,0 +1,41 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import random
+import struct
+
+import pytest
+
+from helpers import load
+
+Trace = load("Trace")
+
+CAPACITY = 4 * (Trace.RECORD.size + Trace.MAX_PAYLOAD)
+
+def _indexes(path):
+    return [struct.unpack_from("<I", payload)[0] for _, _, payload in Trace.TraceReader(path).records()]
+
+@pytest.mark.parametrize("seed", range(8))
+def test_wraparoundKeepsNewestRecords(tmp_path, seed):
+    path = str(tmp_path / "trace.bin")
+    generator = random.Random(seed)
+    recorder = Trace.TraceRecorder(path, CAPACITY)
+    written = []
+    try:
+        for index in range(600):
+            # Mostly short lines, now and then a record about as large as they get
+            size = generator.randint(0, 60) if generator.random() < 0.7 else generator.randint(0, Trace.MAX_PAYLOAD - 4)
+            recorder.record(Trace.DIRECTION_SENT, struct.pack("<I", index) + b"x" * size)
+            written.append(index)
+            if generator.random() < 0.1:
+                recorder.flush()
+                records = _indexes(path)
+                # A contiguous suffix of what was written, up to the newest record
+                assert records
+                assert records == written[-len(records):]
+        recorder.flush()
+        assert recorder.wrapped
+        records = _indexes(path)
+        assert records == written[-len(records):]
+    finally:
+        recorder.close()
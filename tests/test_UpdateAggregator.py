@@ -0,0 +1,104 @@
+# Copyright (c) 2016 Ultimaker B.V.
+# Cura is released under the terms of the AGPLv3 or higher.
+
+import threading
+
+from helpers import load, writeJob
+
+Benchmark = load("Benchmark")
+Emulator = load("Emulator")
+StreamingEngine = load("StreamingEngine")
+UpdateAggregator = load("UpdateAggregator")
+
+class _Device():
+    def __init__(self):
+        self.updates = []
+
+    def applyUpdates(self, changes):
+        self.updates.append(changes)
+
+class _BrokenDevice():
+    def applyUpdates(self, changes):
+        raise RuntimeError("gone")
+
+def test_posts_are_coalesced_per_device():
+    aggregator = UpdateAggregator.UpdateAggregator()
+    first = _Device()
+    second = _Device()
+    for progress in range(100):
+        aggregator.post(first, "progress", progress)
+        aggregator.post(second, "progress", progress * 2)
+    aggregator.post(first, "job_state", "printing")
+    aggregator.flush()
+    assert first.updates == [{"progress": 99, "job_state": "printing"}]
+    assert second.updates == [{"progress": 198}]
+    assert aggregator.posted == 201
+    assert aggregator.published == 3
+
+def test_only_changes_are_published():
+    aggregator = UpdateAggregator.UpdateAggregator()
+    device = _Device()
+    aggregator.post(device, "progress", 10)
+    aggregator.post(device, "job_state", "printing")
+    aggregator.flush()
+    aggregator.post(device, "progress", 10)
+    aggregator.post(device, "job_state", "printing")
+    aggregator.flush()
+    aggregator.post(device, "progress", 20)
+    aggregator.post(device, "job_state", "printing")
+    aggregator.flush()
+    aggregator.flush()
+    assert device.updates == [{"progress": 10, "job_state": "printing"}, {"progress": 20}]
+
+def test_a_failing_device_doesnt_stop_the_others():
+    aggregator = UpdateAggregator.UpdateAggregator()
+    device = _Device()
+    aggregator.post(_BrokenDevice(), "progress", 1)
+    aggregator.post(device, "progress", 1)
+    aggregator.flush()
+    assert device.updates == [{"progress": 1}]
+
+def test_forgotten_devices_are_dropped():
+    aggregator = UpdateAggregator.UpdateAggregator()
+    device = _Device()
+    aggregator.post(device, "progress", 1)
+    aggregator.flush()
+    aggregator.post(device, "progress", 2)
+    aggregator.forget(device)
+    aggregator.flush()
+    # Published again once it comes back, nothing is remembered
+    aggregator.post(device, "progress", 1)
+    aggregator.flush()
+    assert device.updates == [{"progress": 1}, {"progress": 1}]
+
+def test_thread_publishes_the_latest_values():
+    aggregator = UpdateAggregator.UpdateAggregator(interval = 0.01).start()
+    device = _Device()
+    posters = [threading.Thread(target = lambda: [aggregator.post(device, "progress", value) for value in range(1000)])
+               for index in range(4)]
+    for poster in posters:
+        poster.start()
+    for poster in posters:
+        poster.join()
+    aggregator.stop()
+    assert device.updates[-1] == {"progress": 999}
+    assert aggregator.posted == 4000
+    assert len(device.updates) <= aggregator.flushes
+
+def test_engine_sets_the_job_state_once_per_job(tmp_path):
+    path = writeJob(tmp_path, Benchmark.generateJob(layers = 2))
+    states = []
+    class _RecordingEngine(StreamingEngine.StreamingEngine):
+        def _updateJobState(self, job_state):
+            states.append(job_state)
+            StreamingEngine.StreamingEngine._updateJobState(self, job_state)
+    with Emulator.EmulatorServer(speed = 0.) as server:
+        engine = _RecordingEngine("states")
+        try:
+            engine.start(server.host, server.port)
+            del states[:]
+            engine.sendFile(path)
+            assert engine.waitForJob(interval = 0.05)
+        finally:
+            engine.stop()
+    assert states == ["printing", "ready"]